@@ -2,6 +2,9 @@
 def observe_get() -> str:
     return 'do some magic!'
 
+def observe_stream_get() -> str:
+    return 'do some magic!'
+
 def perturb_battery_post(parameters = None) -> str:
     return 'do some magic!'
 
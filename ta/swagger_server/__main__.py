@@ -32,6 +32,8 @@ from rainbow_interface import RainbowInterface
 from robotcontrol.launch_utils import launch_cp1_base, init
 
 import swagger_server.resources as resources
+from swagger_server.telemetry import Telemetry, default_rate
+from swagger_server.log_uploader import default_ship_interval
 from robotcontrol.instructions_db import InstructionDB
 
 config_list_file = os.path.expanduser('~/cp1/config_list.json')
@@ -127,6 +129,11 @@ if __name__ == '__main__':
         if (not config.uuid) or (len(config.uuid) == 0):
             fail_hard("test ID undefined; cannot sequester logs")
 
+        # seconds between two uploads of the logs during the mission, 0 to
+        # upload them only when the test ends
+        log_ship_interval = float(os.environ.get('TA_LOG_SHIP_INTERVAL') or default_ship_interval)
+        if log_ship_interval > 0:
+            comms.start_log_shipping(log_ship_interval)
 
         '''
         ecs_meta = os.environ.get('ECS_CONTAINER_METADATA_FILE')
@@ -282,6 +289,11 @@ if __name__ == '__main__':
 
     config.bot_cont = bot_cont
 
+    # publish the robot state on /observe/stream
+    telemetry = Telemetry(rate=float(os.environ.get('TA_TELEMETRY_RATE', default_rate)))
+    telemetry.start()
+    config.telemetry = telemetry
+
     # check that things are actually waypoint names
     if not bot_cont.map_server.is_waypoint(ready_resp.start_loc):
         fail_hard("name of start location is not a waypoint: %s" % ready_resp.start_loc)
@@ -323,4 +335,5 @@ if __name__ == '__main__':
     print("Starting TA REST interface")
 
     # app.debug = True
-    app.run(host='0.0.0.0', port=5000)
+    # threaded, so that /observe/stream does not hold up the other requests
+    app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -10,22 +10,39 @@ from swagger_client.models.errorparams import Errorparams
 from swagger_client.models.doneparams import Doneparams
 from swagger_client.models.statusparams import Statusparams
 import swagger_server.config as config
+from swagger_server.log_uploader import LogUploader, LogShipper
+
+# the log folds sequestered to the S3 bucket, the ros logs under roslogs/
+logdirs = ["/home/mars/cp1/",
+           "/home/mars/logs/",
+           ("/home/mars/.ros/log/", "roslogs")
+           ]
+
+
+def start_log_shipping(interval):
+    # upload the logs every interval seconds while the mission runs, so
+    # that sequester() only has to upload what is changed since
+    if config.log_uploader is None:
+        config.log_uploader = LogUploader(config.s3_bucket_url + "/" + config.uuid, config.logger)
+    config.log_shipper = LogShipper(config.log_uploader, logdirs, config.logger, interval=interval)
+    config.log_shipper.start()
 
 
 def sequester():
     if config.th_connected and config.uuid is not None:
-        logdirs = ["/home/mars/cp1/",
-                   "/home/mars/logs/"
-                   ]
-
-        err = False
-        for ld in logdirs:
-            config.logger.debug("Calling aws s3 cp %s %s/%s/ --recursive",ld,config.s3_bucket_url, config.uuid)
-            res = subprocess.call(["aws", "s3", "cp", ld,
-                                   config.s3_bucket_url + "/" + config.uuid + "/",
-                                   "--recursive"])
-            if not res == 0:
-                err = True
+        if config.log_uploader is None:
+            config.log_uploader = LogUploader(config.s3_bucket_url + "/" + config.uuid, config.logger)
+
+        # the logs are not shipped any more once the test ends
+        if config.log_shipper is not None:
+            config.log_shipper.stop()
+
+        config.logger.debug("Uploading %s to %s/%s/", logdirs, config.s3_bucket_url, config.uuid)
+        try:
+            err = config.log_uploader.upload_dirs(logdirs) != 0
+        except Exception:
+            config.logger.error("failed to upload the logs", exc_info=True)
+            err = True
 
         # if any of the directories can't be copied, this test should be invalidated
         if err:
@@ -30,6 +30,10 @@ th_connected = False
 ## for log sequestration
 uuid = None
 s3_bucket_url = None
+# uploads the logs to s3_bucket_url, skipping those already uploaded
+log_uploader = None
+# uploads the logs during the mission with log_uploader, see comms.start_log_shipping
+log_shipper = None
 
 # to facilitate online DQN learning
 learner = None
@@ -41,3 +45,6 @@ plan = ""
 
 # The default value is used by status message before the robot is alive
 sim_time = 0
+
+# publisher of the robot state for /observe/stream, set once the robot is alive
+telemetry = None
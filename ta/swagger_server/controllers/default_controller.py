@@ -1,4 +1,5 @@
 import connexion
+import flask
 import asyncio
 import concurrent.futures
 from multiprocessing import Process, pool
@@ -121,6 +122,21 @@ def observe_get():
     return ret
 
 
+def observe_stream_get():
+    """
+    observe_stream_get
+    the same observations as /observe, pushed on a single long-lived connection as one json object per line. a blank line is sent when there is no new observation to keep the connection alive.
+
+    :rtype: str
+    """
+
+    config.logger.debug("observe_stream_get was called")
+    if config.telemetry is None:
+        return "the robot is not alive yet", 400
+
+    return flask.Response(config.telemetry.stream(), mimetype="application/x-ndjson")
+
+
 def perturb_battery_post(Parameters=None):
     """
     perturb_battery_post
@@ -0,0 +1,81 @@
+import json
+import threading
+
+import rospy
+from gazebo_msgs.msg import ModelStates
+
+import swagger_server.config as config
+
+# samples of the robot state published per second on /observe/stream
+default_rate = 10
+
+# a blank line is sent when no sample is published for this many seconds,
+# so that a connection closed by the TH is noticed
+keepalive_interval = 1
+
+# the robot's model in gazebo, whose pose is published
+default_model_name = "mobile_base"
+
+
+class Telemetry:
+    """
+    publishes x, y, battery and sim-time of the robot at a fixed rate.
+
+    the pose comes from the /gazebo/model_states topic, the battery and the
+    sim-time from the call backs that already update config. every
+    connection to /observe/stream gets the samples published after it is
+    opened, so the number of connections does not change how often gazebo
+    is asked for the robot state.
+    """
+
+    def __init__(self, rate=default_rate, model_name=default_model_name):
+        self.rate = rate
+        self.model_name = model_name
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.sample = None
+        self.pose = None
+        self.timer = None
+        self.sub_pose = None
+
+    def pose_cb(self, msg):
+        """call back to keep the latest pose of the robot from the ros topic"""
+        try:
+            i = msg.name.index(self.model_name)
+        except ValueError:
+            return
+        self.pose = (msg.pose[i].position.x, msg.pose[i].position.y)
+
+    def publish(self, event=None):
+        try:
+            if self.pose is None:
+                x, y, ig1, ig2 = config.bot_cont.gazebo.get_bot_state()
+            else:
+                x, y = self.pose
+            sample = {"x": x, "y": y, "battery": config.battery, "sim-time": config.sim_time}
+        except Exception as e:
+            config.logger.debug("telemetry failed to read the robot state: %s" % e)
+            return
+
+        with self.condition:
+            self.seq += 1
+            self.sample = sample
+            self.condition.notify_all()
+
+    def start(self):
+        config.logger.debug("publishing telemetry %s times per second" % self.rate)
+        self.sub_pose = rospy.Subscriber("/gazebo/model_states", ModelStates, self.pose_cb, queue_size=1)
+        self.timer = rospy.Timer(rospy.Duration(1.0 / self.rate), self.publish)
+
+    def stream(self):
+        """generator of the samples as json lines, for a streamed response"""
+        seq = self.seq
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.seq > seq, timeout=keepalive_interval)
+                new_sample = self.seq > seq
+                seq, sample = self.seq, self.sample
+            if new_sample:
+                yield json.dumps(sample) + "\n"
+            else:
+                yield "\n"
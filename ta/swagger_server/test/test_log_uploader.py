@@ -0,0 +1,173 @@
+# coding: utf-8
+
+import os
+import filecmp
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+from swagger_server import log_uploader
+from swagger_server.log_uploader import LogUploader
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    boto3 = None
+
+ta_copy = os.path.join(os.path.dirname(__file__), "..", "log_uploader.py")
+th_source = os.path.join(os.path.dirname(__file__), "..", "..", "..", "th", "log_uploader.py")
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+
+class TestLogUploader(unittest.TestCase):
+    """ LogUploader to a local directory """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.tmp_dir.name, "logs")
+        self.store_dir = os.path.join(self.tmp_dir.name, "store")
+        os.makedirs(self.log_dir)
+        self.uploader = LogUploader("file://" + self.store_dir, logger, workers=2)
+        self.mtime = 1000000000
+
+    def tearDown(self):
+        self.uploader.close()
+        self.tmp_dir.cleanup()
+
+    def write_log(self, content, mode="wb"):
+        ''' write to logs/test.log, with a later mtime than the last write '''
+        local_path = os.path.join(self.log_dir, "test.log")
+        with open(local_path, mode) as fp:
+            fp.write(content)
+        self.mtime += 1
+        os.utime(local_path, (self.mtime, self.mtime))
+        return local_path
+
+    def upload(self):
+        self.assertEqual(self.uploader.upload_dirs([(self.log_dir, "fold")]), 0)
+
+    def assertStored(self, content):
+        with open(os.path.join(self.store_dir, "fold", "test.log"), "rb") as fp:
+            self.assertEqual(fp.read(), content)
+
+    def test_skip_unchanged(self):
+        self.write_log(b"a" * 100)
+        self.upload()
+        with mock.patch.object(self.uploader.backend, "put") as put, \
+                mock.patch.object(self.uploader.backend, "append") as append:
+            self.upload()
+            # same content, only the mtime is changed
+            self.write_log(b"a" * 100)
+            self.upload()
+        put.assert_not_called()
+        append.assert_not_called()
+        self.assertStored(b"a" * 100)
+
+    def test_append_grown_file(self):
+        content = os.urandom(log_uploader.tail_size * 3)
+        self.write_log(content)
+        self.upload()
+        with mock.patch.object(self.uploader.backend, "put", wraps=self.uploader.backend.put) as put, \
+                mock.patch.object(self.uploader.backend, "append", wraps=self.uploader.backend.append) as append:
+            self.write_log(b"more", mode="ab")
+            self.upload()
+        put.assert_not_called()
+        append.assert_called_once_with(os.path.join(self.log_dir, "test.log"), "fold/test.log", len(content), len(content) + 4)
+        self.assertStored(content + b"more")
+
+    def test_upload_rewritten_file(self):
+        self.write_log(b"a" * 100)
+        self.upload()
+        with mock.patch.object(self.uploader.backend, "put", wraps=self.uploader.backend.put) as put, \
+                mock.patch.object(self.uploader.backend, "append", wraps=self.uploader.backend.append) as append:
+            # grown, but its uploaded bytes are changed
+            self.write_log(b"b" * 200)
+            self.upload()
+        append.assert_not_called()
+        put.assert_called_once_with(os.path.join(self.log_dir, "test.log"), "fold/test.log", 200)
+        self.assertStored(b"b" * 200)
+
+    def test_retry_failed_upload(self):
+        self.write_log(b"a" * 100)
+        put = self.uploader.backend.put
+        calls = []
+
+        def put_failing_once(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise IOError("connection reset")
+            return put(*args)
+
+        with mock.patch.object(log_uploader, "retry_backoff_base", 0), \
+                mock.patch.object(self.uploader.backend, "put", side_effect=put_failing_once):
+            self.upload()
+        self.assertEqual(len(calls), 2)
+        self.assertStored(b"a" * 100)
+
+    @unittest.skipUnless(os.path.exists(th_source), "th/log_uploader.py is not in this tree")
+    def test_same_as_th(self):
+        """ swagger_server/log_uploader.py is a copy of th/log_uploader.py """
+        self.assertTrue(filecmp.cmp(ta_copy, th_source, shallow=False),
+                "ta/swagger_server/log_uploader.py differs from th/log_uploader.py; copy th/log_uploader.py over it")
+
+
+@unittest.skipIf(boto3 is None, "boto3 and moto are not installed")
+class TestS3LogUploader(unittest.TestCase):
+    """ LogUploader to S3, mocked by moto """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.env = mock.patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                                                "AWS_SESSION_TOKEN": "testing", "AWS_DEFAULT_REGION": "us-east-1"})
+        self.env.start()
+        self.s3 = mock_s3()
+        self.s3.start()
+        self.client = boto3.client("s3")
+        self.client.create_bucket(Bucket="logs")
+        self.uploader = LogUploader("s3://logs/test-id", logger, workers=2)
+        self.local_path = os.path.join(self.tmp_dir.name, "test.log")
+
+    def tearDown(self):
+        self.uploader.close()
+        self.s3.stop()
+        self.env.stop()
+        self.tmp_dir.cleanup()
+
+    def write_log(self, content, mode="wb"):
+        with open(self.local_path, mode) as fp:
+            fp.write(content)
+
+    def upload(self):
+        self.assertEqual(self.uploader.upload_dirs([self.tmp_dir.name]), 0)
+
+    def assertStored(self, content):
+        stored = self.client.get_object(Bucket="logs", Key="test-id/test.log")["Body"].read()
+        self.assertEqual(len(stored), len(content))
+        self.assertTrue(stored == content)
+
+    def test_append_grown_file(self):
+        content = os.urandom(log_uploader.s3_min_part_size + 10)
+        self.write_log(content)
+        self.upload()
+        with mock.patch.object(self.uploader.backend, "put", wraps=self.uploader.backend.put) as put:
+            self.write_log(b"more", mode="ab")
+            self.upload()
+        put.assert_not_called()
+        self.assertStored(content + b"more")
+
+    def test_upload_small_grown_file(self):
+        # too small to be the first part of a multipart upload
+        self.write_log(b"a" * 100)
+        self.upload()
+        self.write_log(b"more", mode="ab")
+        self.upload()
+        self.assertStored(b"a" * 100 + b"more")
+
+
+if __name__ == '__main__':
+    unittest.main()
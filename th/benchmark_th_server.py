@@ -0,0 +1,100 @@
+'''
+    Compare the latency of TA callbacks served by the single-threaded
+    werkzeug server and by PooledWSGIServer under load.
+
+    Every client posts /status messages to a stand-in of the TH app. One
+    message in slow_every takes slow_handler_seconds to handle, like a
+    /status handler writing large debug logs; the others return at once.
+
+    python3 benchmark_th_server.py [num_clients] [requests_per_client] [workers]
+'''
+import sys
+import time
+import threading
+
+import numpy as np
+import requests
+from flask import Flask, request, make_response
+from werkzeug.serving import make_server
+
+from pooled_server import PooledWSGIServer, default_workers
+
+host = "127.0.0.1"
+port = 18081
+
+slow_every = 10
+slow_handler_seconds = 0.2
+
+
+def create_app():
+    app = Flask(__name__)
+
+    @app.route('/status', methods=['POST'])
+    def ta_status():
+        if request.json["seq"] % slow_every == 0:
+            time.sleep(slow_handler_seconds)
+        return make_response("ACK", 200)
+
+    return app
+
+
+def run_clients(num_clients, requests_per_client):
+    '''
+        Seconds each request of the clients takes, for the fast ones only
+    '''
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_num):
+        session = requests.Session()
+        for i in range(requests_per_client):
+            seq = client_num * requests_per_client + i
+            start = time.monotonic()
+            session.post(f"http://{host}:{port}/status", json={"seq": seq}, timeout=60)
+            latency = time.monotonic() - start
+            if seq % slow_every != 0:
+                with lock:
+                    latencies.append(latency)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(num_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return np.array(latencies)
+
+
+def benchmark(workers, num_clients, requests_per_client):
+    app = create_app()
+    if workers > 0:
+        server = PooledWSGIServer(host, port, app, workers)
+    else:
+        server = make_server(host, port, app)
+    t_server = threading.Thread(target=server.serve_forever)
+    t_server.start()
+
+    start = time.monotonic()
+    latencies = run_clients(num_clients, requests_per_client)
+    elapsed = time.monotonic() - start
+
+    if workers > 0:
+        server.drain()
+        print(f"  server metrics: {server.metrics()}")
+    else:
+        server.shutdown()
+        server.server_close()
+    t_server.join()
+
+    print(f"workers={workers}: {num_clients * requests_per_client} requests in {elapsed:.2f} s, "
+          f"fast callback latency p50={np.percentile(latencies, 50) * 1000:.1f} ms "
+          f"p95={np.percentile(latencies, 95) * 1000:.1f} ms "
+          f"max={latencies.max() * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    num_clients         = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    workers             = int(sys.argv[3]) if len(sys.argv) > 3 else default_workers
+
+    benchmark(0, num_clients, requests_per_client)
+    benchmark(workers, num_clients, requests_per_client)
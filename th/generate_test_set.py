@@ -8,6 +8,8 @@ import copy
 import numpy as np
 
 from mapserver import MapServer
+from obstacle_placement import infeasibility_reasons
+from perturbation_feasibility import generate_feasible_perturbation_sequences
 from test_spec import TestSpec, testRanges, generate_list_of_perturbation_sequences, perturbation_severities
 
 def usage():
@@ -102,7 +104,11 @@ def create_test_spec(separate_store, test_spec_fold, num_targets, power_model_ID
             "bp_medium": num_battery_sets_medium,
             "bp_hard": num_battery_sets_hard}
 
-    perturb_seqs = generate_list_of_perturbation_sequences(num_targets, obstacles, battery_sets)
+    # Redraw the perturbations until all the obstacle perturbations can be placed
+    perturb_seqs, infeasible = generate_feasible_perturbation_sequences(map_server, start_loc, target_loc_list, obstacles, battery_sets)
+    for p in infeasible:
+        print("[Warning] {} ({}, {}) of the mission {} -> {} can never be placed: {}".format(
+            p["target"], p["type"], p["ratio"], start_loc, target_loc_list, infeasibility_reasons[p["reason"]]))
 
     for case_level in levels:
         test_spec = TestSpec(
@@ -7,6 +7,8 @@ import json
 import copy
 
 from mapserver import MapServer
+from obstacle_placement import infeasibility_reasons
+from perturbation_feasibility import generate_feasible_perturbation_sequences
 from test_spec import TestSpec, testRanges, generate_list_of_perturbation_sequences
 
 cp1_map_fp      = sys.argv[1]
@@ -51,7 +53,11 @@ def create_test_spec(test_spec_fold, num_targets, power_model_ID, budget, levels
             "bp_medium": num_battery_sets_medium,
             "bp_hard": num_battery_sets_hard}
 
-    perturb_seqs = generate_list_of_perturbation_sequences(num_targets, obstacles, battery_sets)
+    # Redraw the perturbations until all the obstacle perturbations can be placed
+    perturb_seqs, infeasible = generate_feasible_perturbation_sequences(map_server, start_loc, target_loc_list, obstacles, battery_sets)
+    for p in infeasible:
+        print("[Warning] {} ({}, {}) of the mission {} -> {} can never be placed: {}".format(
+            p["target"], p["type"], p["ratio"], start_loc, target_loc_list, infeasibility_reasons[p["reason"]]))
 
     for level in levels:
         test_spec = TestSpec(
@@ -0,0 +1,332 @@
+'''
+    Upload the log folds of a test to its storage, in process and in
+    parallel, instead of one `aws s3 cp --recursive` per fold.
+
+    The storage is given by a URL:
+        s3://bucket/path    uploaded with boto3 if it is installed, with
+                            multipart uploads of large files and appends
+                            done in S3, or else with one `aws s3 cp` per file
+        file:///path, /path copied to a local directory, a stand-in for
+                            the object store that needs no network
+    A file whose content has not changed since it was last uploaded by the
+    same LogUploader is skipped, so a fold can be uploaded many times. When
+    the backend can append, only the bytes appended to a file since its
+    last upload are sent.
+
+    A LogShipper uploads folds in the background while the mission runs,
+    so that the upload at the end of the test only has to send the tail.
+
+    This is th/log_uploader.py. The TA image has a byte-for-byte copy of
+    it, ta/swagger_server/log_uploader.py, so it must run on python 3.5.
+    Change th/log_uploader.py and copy it over the TA's; the TA tests
+    check that the two are the same.
+'''
+import os
+import time
+import random
+import hashlib
+import threading
+import collections
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Files uploaded at once
+default_workers = 8
+
+# Files larger than part_size bytes are uploaded in parts of that size,
+# up to part_workers parts of a file at once
+part_size = 8 * 1024 * 1024
+part_workers = 4
+
+# S3 needs every part of a multipart upload but the last to be at least
+# this many bytes, so smaller objects are uploaded again instead of appended
+s3_min_part_size = 5 * 1024 * 1024
+
+# Seconds between two uploads of a LogShipper
+default_ship_interval = 30
+
+# Bytes at the end of the uploaded part of a file that are compared with
+# the file to tell whether it has only been appended to since
+tail_size = 4096
+
+# A failed upload of a file is retried up to max_retries times, after a
+# random delay of up to retry_backoff_base * 2^n seconds before the n-th retry
+max_retries = 3
+retry_backoff_base = 0.5
+
+
+class LocalBackend:
+    '''
+        Copies the files into a local directory, in parts for large files
+    '''
+    can_append = True
+
+    def __init__(self, root):
+        self.root = root
+        self.parts_executor = ThreadPoolExecutor(max_workers=part_workers)
+
+    def put(self, local_path, key, size):
+        '''
+            Copy the first size bytes of the file
+        '''
+        dest_path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = dest_path + ".part"
+        with open(tmp_path, "wb") as fp:
+            fp.truncate(size)
+        self.copy_parts(local_path, tmp_path, 0, size)
+        os.replace(tmp_path, dest_path)
+
+    def append(self, local_path, key, offset, size):
+        '''
+            Copy the bytes from offset to size of the file, whose first
+            offset bytes are already copied
+        '''
+        dest_path = os.path.join(self.root, key)
+        with open(dest_path, "r+b") as fp:
+            fp.truncate(size)
+        self.copy_parts(local_path, dest_path, offset, size)
+
+    def copy_parts(self, src_path, dest_path, start, end):
+        parts = [self.parts_executor.submit(self.copy_part, src_path, dest_path, offset, min(part_size, end - offset))
+                 for offset in range(start, end, part_size)]
+        for part in parts:
+            part.result()
+
+    @staticmethod
+    def copy_part(src_path, dest_path, offset, length):
+        with open(src_path, "rb") as src, open(dest_path, "r+b") as dest:
+            src.seek(offset)
+            dest.seek(offset)
+            dest.write(src.read(length))
+
+
+class S3Backend:
+    '''
+        Uploads the files to s3://bucket/prefix/. An object is appended to
+        by a multipart upload whose first part is copied from the object in
+        S3, so only the appended bytes are sent. Without boto3 a changed
+        file is uploaded again, and a warning is logged with logger.
+    '''
+
+    def __init__(self, url, logger):
+        self.url = url.rstrip("/")
+        bucket, _, self.prefix = self.url[len("s3://"):].partition("/")
+        self.bucket = bucket
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            self.client = None
+            logger.warning("[Log Upload] boto3 is not installed. Uploading to %s with the aws cli, "
+                    "which uploads the whole of a changed file again", self.url)
+        else:
+            self.client = boto3.client("s3")
+            self.transfer_config = TransferConfig(
+                    multipart_threshold=part_size,
+                    multipart_chunksize=part_size,
+                    max_concurrency=part_workers)
+        self.can_append = self.client is not None
+
+    def s3_key(self, key):
+        return (self.prefix + "/" + key) if self.prefix else key
+
+    def put(self, local_path, key, size):
+        if self.client is not None:
+            self.client.upload_file(local_path, self.bucket, self.s3_key(key), Config=self.transfer_config)
+            return
+        # the aws cli uploads large files in parts by itself
+        res = subprocess.call(["aws", "s3", "cp", "--only-show-errors", local_path, self.url + "/" + key])
+        if res != 0:
+            raise IOError("aws s3 cp %s exits with %s" % (local_path, res))
+
+    def append(self, local_path, key, offset, size):
+        '''
+            Upload the bytes from offset to size of the file, whose first
+            offset bytes are already uploaded
+        '''
+        if offset < s3_min_part_size:
+            self.put(local_path, key, size)
+            return
+
+        s3_key = self.s3_key(key)
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=s3_key)["UploadId"]
+        try:
+            copied = self.client.upload_part_copy(
+                    Bucket=self.bucket, Key=s3_key, UploadId=upload_id, PartNumber=1,
+                    CopySource={"Bucket": self.bucket, "Key": s3_key},
+                    CopySourceRange="bytes=0-%d" % (offset - 1))
+            parts = [{"PartNumber": 1, "ETag": copied["CopyPartResult"]["ETag"]}]
+            for part_number, start in enumerate(range(offset, size, part_size), 2):
+                uploaded = self.client.upload_part(
+                        Bucket=self.bucket, Key=s3_key, UploadId=upload_id, PartNumber=part_number,
+                        Body=read_range(local_path, start, min(start + part_size, size)))
+                parts.append({"PartNumber": part_number, "ETag": uploaded["ETag"]})
+            self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=s3_key, UploadId=upload_id,
+                    MultipartUpload={"Parts": parts})
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=s3_key, UploadId=upload_id)
+            raise
+
+
+def create_backend(url, logger):
+    if url.startswith("s3://"):
+        return S3Backend(url, logger)
+    if url.startswith("file://"):
+        return LocalBackend(url[len("file://"):])
+    return LocalBackend(url)
+
+
+def file_digest(path, size):
+    '''
+        The sha256 of the first size bytes of the file
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while size > 0:
+            chunk = fp.read(min(size, 1024 * 1024))
+            if not chunk:
+                break
+            digest.update(chunk)
+            size -= len(chunk)
+    return digest.hexdigest()
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        return fp.read(end - start)
+
+
+# What a LogUploader knows of the last upload of a file
+#   size, mtime, inode: of the file when it was uploaded
+#   digest:             sha256 of the uploaded bytes, None if they were appended
+#   tail:               the last tail_size uploaded bytes
+UploadedFile = collections.namedtuple('UploadedFile', ['size', 'mtime', 'inode', 'digest', 'tail'])
+
+
+class LogUploader:
+    '''
+        Uploads folds of files to the storage at url, with up to workers
+        files at once. It can be used by many threads at once.
+    '''
+
+    def __init__(self, url, logger, workers=default_workers):
+        self.url = url
+        self.logger = logger
+        self.backend = create_backend(url, logger)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        # {local path: UploadedFile} of the uploaded files
+        self.uploaded = {}
+        self.uploaded_lock = threading.Lock()
+        # one upload of folds at a time, so that a file is not appended twice
+        self.upload_lock = threading.Lock()
+
+    def upload_dirs(self, local_dirs):
+        '''
+            Upload the files under each of local_dirs to the root of the
+            storage, keeping their paths relative to their fold. A fold can
+            also be given as (fold, prefix) to upload it under prefix/.
+            Returns the number of files that fail to upload.
+        '''
+        files = []
+        for local_dir in local_dirs:
+            prefix = ""
+            if isinstance(local_dir, tuple):
+                local_dir, prefix = local_dir[0], local_dir[1].rstrip("/") + "/"
+            for dirpath, _, filenames in os.walk(local_dir):
+                for filename in filenames:
+                    local_path = os.path.join(dirpath, filename)
+                    files.append((local_path, prefix + os.path.relpath(local_path, local_dir).replace(os.sep, "/")))
+
+        start = time.monotonic()
+        with self.upload_lock:
+            results = list(self.executor.map(lambda f: self.upload_file(*f), files))
+        num_failed = results.count(None)
+        num_skipped = results.count(False)
+        self.logger.info("[Log Upload] %d files of %s to %s in %.2f seconds: %d unchanged, %d failed",
+                len(files), local_dirs, self.url, time.monotonic() - start, num_skipped, num_failed)
+        return num_failed
+
+    def upload_file(self, local_path, key):
+        '''
+            Returns True if the file is uploaded, False if it is unchanged
+            since its last upload or removed, and None if it fails to upload
+        '''
+        try:
+            stat = os.stat(local_path)
+            size = stat.st_size
+            with self.uploaded_lock:
+                last = self.uploaded.get(local_path)
+            if (last is not None) and (last.size, last.mtime) == (size, stat.st_mtime_ns):
+                return False
+
+            appended = (last is not None) and self.backend.can_append and (last.inode == stat.st_ino) \
+                    and (last.size < size) and (read_range(local_path, last.size - len(last.tail), last.size) == last.tail)
+            digest = None
+            if not appended:
+                digest = file_digest(local_path, size)
+                if (last is not None) and (last.digest == digest):
+                    with self.uploaded_lock:
+                        self.uploaded[local_path] = last._replace(mtime=stat.st_mtime_ns)
+                    return False
+            tail = read_range(local_path, max(0, size - tail_size), size)
+        except FileNotFoundError: # removed after being listed
+            return False
+        except OSError:
+            self.logger.error("[Log Upload] %s cannot be read", local_path, exc_info=True)
+            return None
+
+        for attempt in range(1 + max_retries):
+            try:
+                if appended:
+                    self.backend.append(local_path, key, last.size, size)
+                else:
+                    self.backend.put(local_path, key, size)
+                break
+            except Exception as e:
+                if attempt == max_retries:
+                    self.logger.error("[Log Upload] fail to upload %s to %s/%s. %s", local_path, self.url, key, e, exc_info=True)
+                    return None
+                delay = random.uniform(0, retry_backoff_base * (2 ** attempt))
+                self.logger.warning("[Log Upload] fail to upload %s. Retry in %.2f seconds. %s", local_path, delay, e)
+                time.sleep(delay)
+
+        with self.uploaded_lock:
+            self.uploaded[local_path] = UploadedFile(size, stat.st_mtime_ns, stat.st_ino, digest, tail)
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class LogShipper(threading.Thread):
+    '''
+        Uploads folds with a LogUploader every interval seconds until
+        stop() is called
+    '''
+    def __init__(self, uploader, local_dirs, logger, interval=default_ship_interval, name="log_shipper"):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.uploader = uploader
+        self.local_dirs = local_dirs
+        self.logger = logger
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.uploader.upload_dirs(self.local_dirs)
+            except Exception:
+                self.logger.error("[Log Upload] fail to ship the logs", exc_info=True)
+
+    def stop(self):
+        '''
+            Stop shipping, once the upload in progress is done
+        '''
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
@@ -1,63 +1,467 @@
 #! /usr/bin/env python
 
+import os
 import json
+import shutil
+import hashlib
+import tempfile
+import functools
 import numpy as np
 import math
-import heapq
-from operator import itemgetter
 import random
+from collections import namedtuple
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8: SharedMapServer and MapServer.attach() are not available
+    shared_memory = None
+
+# Bump when the content of the compiled map cache written by MapServer changes
+map_cache_version = 1
+
+# Number of plans whose geometry MapServer keeps, see MapServer.get_plan_geometry()
+plan_geometry_cache_size = 1024
 
 
 def distance(loc1, loc2):
     return math.sqrt((loc1[0] - loc2[0]) ** 2 + (loc1[1] - loc2[1]) ** 2)
 
 
+# Geometry of the polyline of a plan, one row per segment plan[k] -> plan[k+1]:
+#   plan_idx    waypoint indices of the plan
+#   starts      (S x 2) coordinates of plan[k]
+#   units       (S x 2) unit direction vectors from plan[k] to plan[k+1]
+#   normals     (S x 2) unit normals, units rotated by +90 degrees
+#   lengths     (S,) segment lengths
+#   cum_lengths (S+1,) arc length from plan[0] to plan[k]
+PlanGeometry = namedtuple("PlanGeometry", ["plan_idx", "starts", "units", "normals", "lengths", "cum_lengths"])
+
+
+class WaypointGrid:
+    """
+    Uniform grid over the waypoint coordinates for nearest-waypoint queries.
+
+    For every cell, and for each k that has been asked for, the grid keeps the
+    waypoints that can be among the k closest ones to some point inside the
+    cell: a waypoint is a candidate when its minimum distance to the cell is not
+    larger than the k-th smallest maximum distance to the cell. A query then
+    only compares the position against the few candidates of its cell. Points
+    outside the grid fall back to comparing against every waypoint.
+
+    The candidate lists are padded with -1 into a (n_cells x K) array so that
+    query_batch answers M positions with a handful of numpy operations.
+    """
+
+    # number of cells processed at once when building the candidate lists
+    build_chunk_size = 256
+
+    def __init__(self, coords, cell_size=None):
+        """
+        :param coords: (N x 2) array of waypoint coordinates
+        :param cell_size: side length of a grid cell; by default the grid has about N cells
+        """
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        N = len(self.coords)
+        if N == 0:
+            raise ValueError('cannot build a spatial index without waypoints')
+
+        self.origin = self.coords.min(axis=0)
+        extent = self.coords.max(axis=0) - self.origin
+        if cell_size is None:
+            cell_size = max(extent.max(), 1.0) / math.ceil(math.sqrt(N))
+        self.cell_size = float(cell_size)
+        self.shape = (np.floor(extent / self.cell_size).astype(int) + 1)
+        self.n_cells = int(self.shape[0] * self.shape[1])
+
+        # k -> (n_cells x K) int array of candidate waypoint indices, -1 padded
+        self._candidates = {}
+
+    def _cell_candidates(self, k):
+        if k in self._candidates:
+            return self._candidates[k]
+
+        nx, ny = self.shape
+        cells = np.arange(self.n_cells)
+        lower = self.origin + self.cell_size * np.stack([cells // ny, cells % ny], axis=1)
+        upper = lower + self.cell_size
+
+        candidate_rows = []
+        for start in range(0, self.n_cells, self.build_chunk_size):
+            lo = lower[start:start+self.build_chunk_size, None, :]
+            hi = upper[start:start+self.build_chunk_size, None, :]
+            p = self.coords[None, :, :]
+            gap = np.maximum(np.maximum(lo - p, p - hi), 0)
+            min_dist = np.sqrt((gap ** 2).sum(axis=2))
+            span = np.maximum(np.abs(p - lo), np.abs(p - hi))
+            max_dist = np.sqrt((span ** 2).sum(axis=2))
+            threshold = np.partition(max_dist, k-1, axis=1)[:, k-1]
+            for row in (min_dist <= threshold[:, None]):
+                candidate_rows.append(np.flatnonzero(row))
+
+        K = max(len(row) for row in candidate_rows)
+        candidates = np.full((self.n_cells, K), -1, dtype=np.int64)
+        for i, row in enumerate(candidate_rows):
+            candidates[i, :len(row)] = row
+
+        self._candidates[k] = candidates
+        return candidates
+
+    def query(self, point, k=1):
+        """
+        k closest waypoints to a single point, (x, y)
+
+        :return: (distances, indices), two arrays of length k sorted by distance
+        """
+        dists, idx = self.query_batch(np.asarray(point, dtype=float).reshape(1, 2), k)
+        return dists[0], idx[0]
+
+    def query_batch(self, points, k=1):
+        """
+        k closest waypoints to each of M points
+
+        :param points: (M x 2) array of positions
+        :return: (distances, indices), two (M x k) arrays sorted by distance.
+                 Ties are broken in favour of the waypoint that comes first in the map.
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        k = min(k, len(self.coords))
+        M = len(points)
+        dists = np.empty((M, k), dtype=float)
+        idx = np.empty((M, k), dtype=np.int64)
+
+        cell_ij = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        inside = np.all((cell_ij >= 0) & (cell_ij < self.shape), axis=1)
+
+        if inside.any():
+            candidates = self._cell_candidates(k)
+            cells = cell_ij[inside, 0] * self.shape[1] + cell_ij[inside, 1]
+            cand = candidates[cells]
+            d = np.sqrt(((self.coords[cand] - points[inside][:, None, :]) ** 2).sum(axis=2))
+            d[cand < 0] = np.inf
+            order = np.argsort(d, axis=1, kind='stable')[:, :k]
+            dists[inside] = np.take_along_axis(d, order, axis=1)
+            idx[inside] = np.take_along_axis(cand, order, axis=1)
+
+        outside = ~inside
+        if outside.any():
+            d = np.sqrt(((self.coords[None, :, :] - points[outside][:, None, :]) ** 2).sum(axis=2))
+            order = np.argsort(d, axis=1, kind='stable')[:, :k]
+            dists[outside] = np.take_along_axis(d, order, axis=1)
+            idx[outside] = order
+
+        return dists, idx
+
+
 class MapServer:
 
-    def __init__(self, map_file):
-        with open(map_file) as db:
-            data = json.load(db)
-        self.waypoint_list = data["map"]
+    # Arrays written to the compiled map cache, one .npy file each
+    cached_arrays = [
+            "coords",
+            "adj_indptr",
+            "adj_indices",
+            "adj_weights",
+            "segment_ends",
+            "segment_lengths"]
+
+    # The all-pairs shortest path tables. They are built on the first path
+    # query and only then added to the compiled map cache.
+    shortest_path_arrays = [
+            "shortest_dist",
+            "next_hop"]
+
+    def __init__(self, map_file, use_cache=True):
+        """
+        :param map_file: path to the json map
+        :param use_cache: load the map tables from the compiled sidecar next to
+                          the map file, <map_file>.cache/, and create the sidecar
+                          when it does not exist yet. See load_cache().
+        """
+        with open(map_file, 'rb') as db:
+            self.map_json = db.read()
+        self.map_file = map_file
+        self._waypoint_list = None
+
+        self.cache_dir = None
+        if use_cache:
+            self.cache_dir = os.path.join(
+                    map_file + ".cache",
+                    "v{}-{}".format(map_cache_version, hashlib.sha256(self.map_json).hexdigest()))
+
+        if not (use_cache and self.load_cache(self.cache_dir)):
+            self.build_tables(json.loads(self.map_json))
+            if use_cache:
+                self.save_cache(self.cache_dir)
+
+        self.build_lookups()
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Read-only view of a map published into shared memory by
+        SharedMapServer. The tables are used in place, without a copy, and the
+        view answers the same queries as the MapServer that was published.
+
+        :param handle: SharedMapServer.handle, e.g. passed to the initializer
+                       of the workers of a multiprocessing pool
+        """
+        if shared_memory is None:
+            raise RuntimeError("Attaching to a shared map needs multiprocessing.shared_memory (Python 3.8+).")
+
+        self = cls.__new__(cls)
+        # keeps the shared memory mapped as long as the view exists
+        self.shared_memory = shared_memory.SharedMemory(name=handle["name"])
+
+        arrays = {}
+        for name, (offset, shape, dtype) in handle["layout"].items():
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shared_memory.buf, offset=offset)
+            array.flags.writeable = False
+            arrays[name] = array
+
+        self.map_json = arrays.pop("map_json")
+        self.map_file = handle["map_file"]
+        self._waypoint_list = None
+        self.cache_dir = None
+        self.set_tables(handle["waypoint_ids"], handle["stations"], arrays)
+        self.build_lookups()
+        return self
+
+    def build_lookups(self):
+        """ the lookup structures derived from the map tables """
+        self.waypoints = self.get_waypoints()
+
+        self.spatial_index = WaypointGrid(self.coords)
+
+        self.build_segment_geometry()
+
+        # Plans repeat heavily across targets and tests, so their geometry is
+        # kept in an LRU cache keyed by the plan tuple. See get_plan_geometry().
+        self.plan_geometry_cache = functools.lru_cache(maxsize=plan_geometry_cache_size)(self.compute_plan_geometry)
+
+    @property
+    def waypoint_list(self):
+        """ the 'map' list of the json map, parsed on first use when the map is loaded from the cache """
+        if self._waypoint_list is None:
+            self._waypoint_list = json.loads(bytes(self.map_json))["map"]
+        return self._waypoint_list
+
+    def build_tables(self, data):
+        """ build the waypoint, segment and adjacency tables from the parsed json map """
+        self._waypoint_list = data["map"]
+
+        # Waypoint IDs and coordinates are stored once, in map order:
+        # waypoint_ids[i] is the node-id of the waypoint whose (x, y) is coords[i].
+        # waypoint_idx maps node-id -> i and backs every lookup by ID.
+        L = len(self.waypoint_list)
+        self.waypoint_ids = []
         self.waypoint_idx = {}
-        for i in range(len(self.waypoint_list)):
-            self.waypoint_idx[self.waypoint_list[i]['node-id']] = i
+        self.coords = np.zeros((L, 2), dtype=float)
+        for i in range(L):
+            waypoint_id = self.waypoint_list[i]['node-id']
+            if waypoint_id in self.waypoint_idx:
+                raise ValueError('non-unique waypoint identifiers in the map file: {}'.format(waypoint_id))
+            self.waypoint_ids.append(waypoint_id)
+            self.waypoint_idx[waypoint_id] = i
+            self.coords[i, 0] = self.waypoint_list[i]['coords']['x']
+            self.coords[i, 1] = self.waypoint_list[i]['coords']['y']
 
         if 'stations' in data:
             self.stations = data["stations"]
 
-        self.adj_matrix = self.get_adjacency_matrix()
-        self.waypoints = self.get_waypoints()
-
         self.segment_distances = self.get_segment_distances()
 
+        # The segments of segment_distances as arrays: segment_ends[s] holds the
+        # indices of the two waypoints of segment s in the order of its key and
+        # segment_lengths[s] its length.
+        self.segment_ends = np.array(
+                [[self.waypoint_idx[w] for w in key.split("-")] for key in self.segment_distances],
+                dtype=np.int64).reshape(-1, 2)
+        self.segment_lengths = np.array(list(self.segment_distances.values()), dtype=float)
+
+        # Adjacency in compressed sparse row form: the waypoints reachable
+        # from waypoint i are adj_indices[adj_indptr[i]:adj_indptr[i+1]] and
+        # the lengths of those segments are the same slice of adj_weights.
+        self.adj_indptr, self.adj_indices, self.adj_weights = self.get_adjacency_csr()
+
+        # All-pairs shortest path tables, built by get_shortest_path_tables()
+        # the first time a path query needs them.
+        self.shortest_dist = None
+        self.next_hop = None
+
+    def load_cache(self, cache_dir):
+        """
+        Load the tables from a compiled map cache written by save_cache().
+
+        The cache directory is named after the sha256 of the json map, so a
+        changed map file never matches a stale cache and is simply compiled
+        again. Arrays are memory-mapped read-only.
+
+        :return: True if the cache was found and loaded, False otherwise
+        """
+        tables = self.read_cache(cache_dir)
+        if tables is None:
+            return False
+
+        self.set_tables(*tables)
+        self.load_shortest_path_tables(cache_dir)
+        return True
+
+    def read_cache(self, cache_dir):
+        """
+        (waypoint_ids, stations, arrays) of a compiled map cache, or None if
+        there is none or it is broken, e.g. a truncated .npy file
+        """
+        meta_fp = os.path.join(cache_dir, "meta.json")
+        if not os.path.exists(meta_fp):
+            return None
+        try:
+            with open(meta_fp) as fp:
+                meta = json.load(fp)
+            waypoint_ids, stations = meta["waypoint_ids"], meta["stations"]
+            arrays = {}
+            for name in self.cached_arrays:
+                arrays[name] = np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode='r')
+        except (OSError, KeyError, ValueError):
+            return None
+        return waypoint_ids, stations, arrays
+
+    def load_shortest_path_tables(self, cache_dir):
+        """ load the shortest path tables if save_shortest_path_tables() has added them to the cache """
+        self.shortest_dist = None
+        self.next_hop = None
+        try:
+            shortest_dist = np.load(os.path.join(cache_dir, "shortest_dist.npy"), mmap_mode='r')
+            next_hop = np.load(os.path.join(cache_dir, "next_hop.npy"), mmap_mode='r')
+        except (OSError, ValueError):
+            return
+        self.shortest_dist, self.next_hop = shortest_dist, next_hop
+
+    def set_tables(self, waypoint_ids, stations, arrays):
+        """ set the tables loaded by load_cache() or attach() """
+        self.waypoint_ids = waypoint_ids
+        self.waypoint_idx = {w: i for i, w in enumerate(self.waypoint_ids)}
+        if stations is not None:
+            self.stations = stations
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.segment_distances = {
+                self.waypoint_ids[w1]+"-"+self.waypoint_ids[w2]: d.item()
+                for (w1, w2), d in zip(self.segment_ends, self.segment_lengths)}
+
+    def save_cache(self, cache_dir):
+        """
+        Write the compiled map cache read by load_cache(), without the
+        shortest path tables unless they are built already; see
+        save_shortest_path_tables(). The files are written into a temporary
+        directory that is then renamed into place, so concurrent processes
+        never see a partial cache. Failing to write the cache (e.g. on a
+        read-only file system) is not an error.
+        """
+        cache_root = os.path.dirname(cache_dir)
+        try:
+            os.makedirs(cache_root, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=cache_root, prefix=".tmp-")
+        except OSError:
+            return
+
+        try:
+            for name in self.cached_arrays:
+                np.save(os.path.join(tmp_dir, name + ".npy"), getattr(self, name))
+            if self.shortest_dist is not None:
+                for name in self.shortest_path_arrays:
+                    np.save(os.path.join(tmp_dir, name + ".npy"), getattr(self, name))
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as fp:
+                json.dump({
+                    "waypoint_ids": self.waypoint_ids,
+                    "stations": getattr(self, "stations", None)}, fp)
+            try:
+                os.rename(tmp_dir, cache_dir)
+            except OSError:
+                # another process has renamed its own copy into place first,
+                # or the cache in place is broken and has to be replaced
+                if (not os.path.exists(cache_dir)) or (self.read_cache(cache_dir) is not None):
+                    raise
+                self.discard_cache(cache_dir)
+                os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # the write failed, or another process has renamed its own copy
+            # into place first
+            return
+        finally:
+            # left behind only if the rename did not happen
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # the caches of earlier versions of the map file are not needed anymore
+        for old in os.listdir(cache_root):
+            old_dir = os.path.join(cache_root, old)
+            if old_dir != cache_dir and not old.startswith("."):
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+    @staticmethod
+    def discard_cache(cache_dir):
+        """
+        Remove a broken cache. It is first renamed out of the way, so that
+        concurrent processes never see it half removed.
+        """
+        broken_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix=".broken-")
+        try:
+            os.rename(cache_dir, os.path.join(broken_dir, "cache"))
+        except FileNotFoundError: # removed by another process
+            pass
+        finally:
+            shutil.rmtree(broken_dir, ignore_errors=True)
+
+    def save_shortest_path_tables(self, cache_dir):
+        """
+        Add the shortest path tables to the compiled map cache once they are
+        built. Each file is renamed into place, so load_shortest_path_tables()
+        never sees a partial one. Failing to write them is not an error.
+        """
+        if not os.path.isdir(cache_dir):
+            return
+        for name in self.shortest_path_arrays:
+            tmp_fp = None
+            try:
+                fd, tmp_fp = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+                with os.fdopen(fd, "wb") as fp:
+                    np.save(fp, getattr(self, name))
+                os.replace(tmp_fp, os.path.join(cache_dir, name + ".npy"))
+            except OSError:
+                if tmp_fp is not None and os.path.exists(tmp_fp):
+                    os.remove(tmp_fp)
+                return
+
     def waypoint_to_coords(self, waypoint_id):
         """ given a way point, produce its coordinates """
         if not self.is_waypoint(waypoint_id):
             raise KeyError('The specified waypointID does not exist')
-        waypoint_list = self.get_waypoint(waypoint_id)
-        waypoint = waypoint_list[0]
-        return waypoint['coords']
+        i = self.waypoint_idx[waypoint_id]
+        return {'x': self.coords[i, 0].item(), 'y': self.coords[i, 1].item()}
+
+    def waypoint_to_coord_array(self, waypoint_id):
+        """ given a way point, produce its coordinates as a numpy array, (x, y) """
+        if not self.is_waypoint(waypoint_id):
+            raise KeyError('The specified waypointID does not exist')
+        return self.coords[self.waypoint_idx[waypoint_id]].copy()
 
     def coords_to_waypoint(self, loc):
         """ given a location, it returns the closest waypoint id """
-        closest_waypoint = {}
-        for waypoint in self.waypoints:
-            waypoint_loc = self.waypoint_to_coords(waypoint)
-            d = distance([loc['x'], loc['y']], [waypoint_loc['x'], waypoint_loc['y']])
-            if closest_waypoint.__len__() == 0:
-                closest_waypoint['dist'] = d
-                closest_waypoint['id'] = waypoint
-            elif d < closest_waypoint['dist']:
-                closest_waypoint['dist'] = d
-                closest_waypoint['id'] = waypoint
-        return closest_waypoint
+        dists, idx = self.spatial_index.query([loc['x'], loc['y']])
+        return {'dist': dists[0].item(), 'id': self.waypoint_ids[idx[0]]}
+
+    def coords_to_waypoints(self, locs, k=1):
+        """
+        given an (M x 2) array of locations, return the ids of the k closest
+        waypoints to each of them and the corresponding distances
+
+        :return: (waypoint_ids, dists), two (M x k) arrays sorted by distance
+        """
+        dists, idx = self.spatial_index.query_batch(locs, k)
+        return np.asarray(self.waypoint_ids)[idx], dists
 
     def is_waypoint(self, waypoint_id):
         """ given a string, determine if it is actually a waypoint id """
-        waypoint_list = self.get_waypoint(waypoint_id)
-        if len(waypoint_list) > 1:
-            raise ValueError('non-unique waypoint identifiers in the map file')
-        return len(waypoint_list) == 1
+        return waypoint_id in self.waypoint_idx
 
     def is_charging_station(self, waypoint_id):
         if waypoint_id in self.stations:
@@ -69,32 +473,141 @@ class MapServer:
         return self.stations
 
     def get_waypoint(self, waypoint_id):
-        return list(filter(lambda waypoint: waypoint["node-id"] == waypoint_id, self.waypoint_list))
+        if not self.is_waypoint(waypoint_id):
+            return []
+        return [self.waypoint_list[self.waypoint_idx[waypoint_id]]]
+
+    def build_segment_geometry(self):
+        """
+        Per-segment geometry derived from the segment table, aligned with
+        segment_ends and segment_lengths:
+            segment_vectors   (E x 2) vector from the first to the second end
+            segment_units     (E x 2) unit direction vectors
+            segment_normals   (E x 2) unit normals, directions rotated by +90 degrees
+            segment_bboxes    (E x 4) bounding boxes, (min x, min y, max x, max y)
+        segment_lookup maps a pair of waypoint indices (i, j) to (s, sign),
+        where s is the segment joining them and sign is 1 if it is stored
+        as i -> j and -1 if it is stored as j -> i.
+        """
+        p1 = self.coords[self.segment_ends[:, 0]]
+        p2 = self.coords[self.segment_ends[:, 1]]
+        self.segment_vectors = p2 - p1
+        lengths = np.asarray(self.segment_lengths)[:, None]
+        self.segment_units = np.divide(self.segment_vectors, lengths,
+                out=np.zeros_like(self.segment_vectors), where=lengths > 0)
+        self.segment_normals = np.stack([-self.segment_units[:, 1], self.segment_units[:, 0]], axis=1)
+        self.segment_bboxes = np.concatenate([np.minimum(p1, p2), np.maximum(p1, p2)], axis=1)
+
+        self.segment_lookup = {}
+        for s, (i, j) in enumerate(self.segment_ends.tolist()):
+            self.segment_lookup[(i, j)] = (s, 1)
+            self.segment_lookup[(j, i)] = (s, -1)
+
+    def get_plan_geometry(self, plan):
+        """
+        Geometry of the polyline of a plan, see PlanGeometry. The result
+        comes from an LRU cache keyed by the plan, so its arrays are read-only.
+
+        :param plan: list of waypoint ids with at least two waypoints,
+                     each consecutive pair joined by a segment of the map
+        """
+        return self.plan_geometry_cache(tuple(plan))
+
+    def compute_plan_geometry(self, plan):
+        """ get_plan_geometry() without the cache """
+        if len(plan) < 2:
+            raise ValueError(f"The plan, {plan}, has no segment.")
+        plan_idx = np.array([self.waypoint_idx[w] for w in plan], dtype=np.int64)
+
+        segments = []
+        signs = []
+        for k in range(len(plan)-1):
+            key = (plan_idx[k], plan_idx[k+1])
+            if key not in self.segment_lookup:
+                raise ValueError(f"The segment, {plan[k]}-{plan[k+1]}, indicated in the plan, {plan}, is not in the map.")
+            s, sign = self.segment_lookup[key]
+            segments.append(s)
+            signs.append(sign)
+        signs = np.array(signs, dtype=float)[:, None]
+
+        lengths = np.asarray(self.segment_lengths)[segments]
+        geometry = PlanGeometry(
+                plan_idx=plan_idx,
+                starts=self.coords[plan_idx[:-1]],
+                units=self.segment_units[segments] * signs,
+                normals=self.segment_normals[segments] * signs,
+                lengths=lengths,
+                cum_lengths=np.concatenate([[0.0], np.cumsum(lengths)]))
+        for array in geometry:
+            array.setflags(write=False)
+        return geometry
+
+    def get_plan_length(self, plan):
+        """ length of the path going through the waypoints of the plan """
+        if len(plan) < 2:
+            return 0.0
+        return self.get_plan_geometry(plan).cum_lengths[-1].item()
+
+    def project_onto_plan(self, points, plan):
+        """
+        Project points onto the polyline of a plan, whatever the orientation of its segments.
+
+        :param points: (x, y) or an (M x 2) array of positions
+        :param plan: list of waypoint ids, see get_plan_geometry()
+        :return: (segment_num, offset, dist) with one entry per point:
+                 segment_num is the index k of the closest plan segment,
+                 plan[k] -> plan[k+1] (the first one in plan order on ties),
+                 offset is the arc length from plan[0] to the projected point and
+                 dist is the distance from the point to that segment.
+        """
+        points = np.asarray(points, dtype=float)
+        shape = points.shape[:-1]
+        points = points.reshape(-1, 2)
+        geometry = self.get_plan_geometry(plan)
+
+        rel = points[:, None, :] - geometry.starts[None, :, :]
+        along = (rel * geometry.units[None, :, :]).sum(axis=2)
+        across = (rel * geometry.normals[None, :, :]).sum(axis=2)
+        t = np.clip(along, 0, geometry.lengths[None, :])
+        # a zero-length segment has zero unit and normal vectors, so measure
+        # the distance to its start instead of getting 0 for every point
+        dist = np.where(geometry.lengths[None, :] > 0,
+                        np.hypot(along - t, across),
+                        np.hypot(rel[:, :, 0], rel[:, :, 1]))
+
+        segment_num = np.argmin(dist, axis=1)
+        rows = np.arange(len(points))
+        offset = geometry.cum_lengths[segment_num] + t[rows, segment_num]
+        return (segment_num.reshape(shape),
+                offset.reshape(shape),
+                dist[rows, segment_num].reshape(shape))
 
     def get_waypoints(self):
         return self.waypoint_idx.keys()
 
     def idx_to_waypoint(self, idx):
-        for k, v in self.waypoint_idx.items():
-            if v == idx:
-                return k
+        return self.waypoint_ids[idx]
+
+    def neighbors(self, waypoint_id):
+        """ ids of the waypoints that waypoint_id is connected to """
+        i = self.waypoint_idx[waypoint_id]
+        return [self.waypoint_ids[j] for j in self.adj_indices[self.adj_indptr[i]:self.adj_indptr[i+1]]]
 
     def dfs_paths(self, start, goal):
         """
         Depth first search for deriving the paths from start to goal
-        :param adj:
         :param start:
         :param goal:
         :return:
         """
         stack = [(start, [start])]
-        L = len(self.waypoint_list)
         while stack:
             (vertex, path) = stack.pop()
+            i = self.waypoint_idx[vertex]
             next_nodes = []
-            for i in range(L):
-                next_waypoint = self.idx_to_waypoint(i)
-                if self.adj_matrix[self.waypoint_idx[vertex], i] == 1 and next_waypoint not in path:
+            for j in self.adj_indices[self.adj_indptr[i]:self.adj_indptr[i+1]]:
+                next_waypoint = self.waypoint_ids[j]
+                if next_waypoint not in path:
                     next_nodes.append(next_waypoint)
             for next in next_nodes:
                 if next == goal:
@@ -119,57 +632,132 @@ class MapServer:
                 if key not in segment_distances:
                     key = connected_to[j]+"-"+waypoint_id
                     if key not in segment_distances:
-                        p1 = self.waypoint_to_coords(waypoint_id)
-                        p2 = self.waypoint_to_coords(connected_to[j])
-                        segment_distances[key] = distance([p1["x"], p1["y"]], [p2["x"], p2["y"]]) 
+                        p1 = self.coords[i]
+                        p2 = self.coords[self.waypoint_idx[connected_to[j]]]
+                        segment_distances[key] = distance(p1, p2)
         return segment_distances
 
-    def get_adjacency_matrix(self):
-        """Transform the json to adjacency matrix.
+    def get_adjacency_csr(self):
+        """Transform the json to a compressed sparse row adjacency.
 
-        :return:
+        Row i lists, in increasing index order, the waypoints in the
+        'connected-to' list of waypoint i, and the weights are the
+        corresponding segment distances.
+
+        :return: (indptr, indices, weights)
         """
         L = len(self.waypoint_list)
-        adj = np.zeros((L, L), dtype=int)
+        indptr = np.zeros(L+1, dtype=np.int64)
+        indices = []
+        weights = []
 
         for i in range(L):
             waypoint_id = self.waypoint_list[i]["node-id"]
-            waypoint_idx = self.waypoint_idx[waypoint_id]
-            connected_to = self.waypoint_list[i]["connected-to"]
-            for j in range(len(connected_to)):
-                waypoint_connected_idx = self.waypoint_idx[connected_to[j]]
-                adj[waypoint_idx, waypoint_connected_idx] = 1
+            connected_idx = sorted(set(self.waypoint_idx[w] for w in self.waypoint_list[i]["connected-to"]))
+            for j in connected_idx:
+                key = waypoint_id+"-"+self.waypoint_ids[j]
+                if key not in self.segment_distances:
+                    key = self.waypoint_ids[j]+"-"+waypoint_id
+                indices.append(j)
+                weights.append(self.segment_distances[key])
+            indptr[i+1] = len(indices)
+
+        return indptr, np.array(indices, dtype=np.int64), np.array(weights, dtype=float)
+
+    def get_adjacency_matrix(self):
+        """Dense L x L adjacency matrix built from the sparse adjacency.
+
+        Kept for code that still wants the dense form; it is rebuilt on
+        every call, so prefer adj_indptr/adj_indices/adj_weights.
 
+        :return:
+        """
+        L = len(self.waypoint_ids)
+        adj = np.zeros((L, L), dtype=int)
+        rows = np.repeat(np.arange(L), np.diff(self.adj_indptr))
+        adj[rows, self.adj_indices] = 1
         return adj
 
+    @property
+    def adj_matrix(self):
+        return self.get_adjacency_matrix()
+
+    def get_shortest_path_tables(self):
+        """
+        All-pairs shortest paths over the segment distances (Floyd-Warshall).
+
+        shortest_dist[i, j] is the length of the shortest path from waypoint i
+        to waypoint j (inf if j cannot be reached from i) and next_hop[i, j] is
+        the index of the waypoint following i on that path (-1 if there is
+        none). Both tables are computed on the first call, kept on the map
+        server and added to its compiled map cache.
+
+        :return: (shortest_dist, next_hop)
+        """
+        if self.shortest_dist is not None:
+            return self.shortest_dist, self.next_hop
+
+        L = len(self.waypoint_ids)
+        weights = np.full((L, L), np.inf)
+        rows = np.repeat(np.arange(L), np.diff(self.adj_indptr))
+        weights[rows, self.adj_indices] = self.adj_weights
+        np.fill_diagonal(weights, 0)
+
+        dist = weights
+        next_hop = np.where(np.isfinite(weights), np.arange(L)[None, :], -1)
+        via_k = np.empty((L, L))
+        shorter = np.empty((L, L), dtype=bool)
+        for k in range(L):
+            np.add(dist[:, k, None], dist[None, k, :], out=via_k)
+            np.less(via_k, dist, out=shorter)
+            np.copyto(dist, via_k, where=shorter)
+            np.copyto(next_hop, next_hop[:, k, None], where=shorter)
+
+        self.shortest_dist = dist
+        self.next_hop = next_hop
+        if self.cache_dir is not None:
+            self.save_shortest_path_tables(self.cache_dir)
+        return self.shortest_dist, self.next_hop
+
+    def shortest_path(self, start, goal):
+        """
+        Shortest path from start to goal as a list of waypoint ids,
+        including both ends. Returns [] if goal cannot be reached.
+        """
+        shortest_dist, next_hop = self.get_shortest_path_tables()
+        i, j = self.waypoint_idx[start], self.waypoint_idx[goal]
+        if next_hop[i, j] < 0:
+            return []
+        path = [start]
+        while i != j:
+            i = next_hop[i, j]
+            path.append(self.waypoint_ids[i])
+        return path
+
+    def shortest_path_length(self, start, goal):
+        """ Length of the shortest path from start to goal (inf if goal cannot be reached) """
+        shortest_dist, next_hop = self.get_shortest_path_tables()
+        return shortest_dist[self.waypoint_idx[start], self.waypoint_idx[goal]].item()
+
     def closest_charging_station(self, waypoint):
-        """Returns the closest path to s charging station
+        """Returns the shortest path to the closest charging station
 
         :param waypoint_id:
-        :return:
+        :return: list of waypoint ids; [] if no charging station can be reached
         """
-        shortest_path = []
-        for station in self.stations:
-            paths = self.dfs_paths(waypoint, station)
-            for path in paths:
-                if len(shortest_path) == 0:
-                    shortest_path = path
-                elif len(path) < len(shortest_path):
-                    shortest_path = path
-
-        return shortest_path
+        shortest_dist, next_hop = self.get_shortest_path_tables()
+        station_idx = [self.waypoint_idx[station] for station in self.stations]
+        station_dist = shortest_dist[self.waypoint_idx[waypoint], station_idx]
+        closest = np.argmin(station_dist)
+        if not np.isfinite(station_dist[closest]):
+            return []
+        return self.shortest_path(waypoint, self.stations[closest])
 
     def get_two_closest_waypoints(self, x, y):
-        distances_to_locs = {}
-        for waypoint in self.waypoints:
-            loc = self.waypoint_to_coords(waypoint)
-            d = distance([x, y], [loc['x'], loc['y']])
-            distances_to_locs[waypoint] = d
-
         #  place two obstacles on the closes waypoints to the current location of the robot
-        two_closest_locs = heapq.nsmallest(2, distances_to_locs.iteritems(), itemgetter(1))
-        loc1 = self.waypoint_to_coords(two_closest_locs[0][0])
-        loc2 = self.waypoint_to_coords(two_closest_locs[1][0])
+        dists, idx = self.spatial_index.query([x, y], k=2)
+        loc1 = self.waypoint_to_coords(self.waypoint_ids[idx[0]])
+        loc2 = self.waypoint_to_coords(self.waypoint_ids[idx[1]])
 
         return loc1, loc2
 
@@ -180,3 +768,70 @@ class MapServer:
         while waypoint in self.stations:
             waypoint = self.waypoints[random.randint(0, L-1)]
         return waypoint
+
+
+class SharedMapServer:
+    """
+    Publishes the tables of a MapServer (coordinates, CSR adjacency, segment
+    table and shortest path tables) into one block of shared memory, so that
+    worker processes attach to them with MapServer.attach() instead of each
+    loading its own copy of the map.
+
+        with SharedMapServer(map_server) as shared_map:
+            pool = multiprocessing.Pool(initializer=init_worker, initargs=(shared_map.handle,))
+
+    The block belongs to the publishing process and is removed by close().
+    Workers should be children of the publishing process, so that they share
+    its multiprocessing resource tracker.
+    """
+
+    # arrays are placed at offsets aligned to this many bytes
+    alignment = 64
+
+    def __init__(self, map_server, name=None):
+        """
+        :param map_server: the MapServer to publish
+        :param name: name of the shared memory block, a unique one by default
+        """
+        if shared_memory is None:
+            raise RuntimeError("Sharing a map needs multiprocessing.shared_memory (Python 3.8+).")
+
+        # the workers share the shortest path tables, so they are built here
+        # rather than by each worker on its first path query
+        map_server.get_shortest_path_tables()
+        arrays = {array_name: np.ascontiguousarray(getattr(map_server, array_name))
+                  for array_name in MapServer.cached_arrays + MapServer.shortest_path_arrays}
+        arrays["map_json"] = np.frombuffer(bytes(map_server.map_json), dtype=np.uint8)
+
+        layout = {}
+        size = 0
+        for array_name, array in arrays.items():
+            offset = -(-size // self.alignment) * self.alignment
+            layout[array_name] = (offset, array.shape, array.dtype.str)
+            size = offset + array.nbytes
+
+        self.shared_memory = shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+        for array_name, array in arrays.items():
+            offset, shape, dtype = layout[array_name]
+            np.ndarray(shape, dtype=dtype, buffer=self.shared_memory.buf, offset=offset)[...] = array
+
+        # Everything MapServer.attach() needs; small and picklable
+        self.handle = {
+                "name": self.shared_memory.name,
+                "layout": layout,
+                "map_file": map_server.map_file,
+                "waypoint_ids": list(map_server.waypoint_ids),
+                "stations": getattr(map_server, "stations", None)}
+
+    def close(self):
+        """ unmap and remove the shared memory block """
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
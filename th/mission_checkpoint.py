@@ -0,0 +1,194 @@
+'''
+    Crash-safe checkpoints of a mission result, so that it can be rebuilt
+    if the TH is killed before it dumps mission_result_<test_ID>.json.
+
+    In the log fold of a test, a checkpoint is made of
+        mission_result_<test_ID>.snapshot.json: the mission result as of the
+            delta seq, replaced atomically by rename
+        mission_result_<test_ID>.deltas.jsonl: the deltas since some
+            snapshot, one json line {"seq": n, "set": [[path, value], ...]}
+            per update, path being the list of keys to a leaf of the
+            mission result
+    A delta whose seq is not larger than the snapshot's is already in the
+    snapshot. A line cut short by a crash is ignored.
+
+    python3 mission_checkpoint.py <log_dir> <test_ID> [out_file] rebuilds
+    the mission result of the test and writes it to out_file
+    (mission_result_<test_ID>.json in log_dir by default).
+'''
+import os
+import sys
+import json
+import copy
+import threading
+
+# Number of deltas after which the deltas are compacted into a snapshot
+compaction_threshold = 100
+
+
+def snapshot_filepath(log_dir, test_ID):
+    return os.path.join(log_dir, f"mission_result_{test_ID}.snapshot.json")
+
+def deltas_filepath(log_dir, test_ID):
+    return os.path.join(log_dir, f"mission_result_{test_ID}.deltas.jsonl")
+
+
+def flatten(result, path=()):
+    '''
+        {path: value} of the leaves of a mission result. Lists are leaves.
+    '''
+    leaves = {}
+    for key, value in list(result.items()):
+        if isinstance(value, dict) and value:
+            leaves.update(flatten(value, path + (key,)))
+        else:
+            leaves[path + (key,)] = value
+    return leaves
+
+
+def set_leaf(result, path, value):
+    for key in path[:-1]:
+        result = result.setdefault(key, {})
+    result[path[-1]] = value
+
+
+def unflatten(leaves):
+    result = {}
+    for path, value in leaves.items():
+        set_leaf(result, path, value)
+    return result
+
+
+def write_atomically(filepath, data):
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "w") as fp:
+        json.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_filepath, filepath)
+
+
+def load_mission_result(log_dir, test_ID):
+    '''
+        The latest mission result checkpointed in log_dir for the test, or
+        None if there is no checkpoint
+    '''
+    snapshot_fp = snapshot_filepath(log_dir, test_ID)
+    deltas_fp = deltas_filepath(log_dir, test_ID)
+    if not os.path.exists(snapshot_fp):
+        return None
+
+    with open(snapshot_fp) as fp:
+        snapshot = json.load(fp)
+    result = snapshot["mission_result"]
+    if os.path.exists(deltas_fp):
+        with open(deltas_fp) as fp:
+            for line in fp:
+                try:
+                    delta = json.loads(line)
+                except ValueError: # cut short by a crash
+                    break
+                if delta["seq"] <= snapshot["seq"]:
+                    continue
+                for path, value in delta["set"]:
+                    set_leaf(result, path, value)
+    return result
+
+
+class MissionCheckpoint:
+    '''
+        Checkpoints a mission result that is changed in place. update()
+        appends the leaves changed since the last update as a delta; once
+        compaction_threshold deltas are appended, the mission result is
+        written as a new snapshot and the deltas are dropped.
+
+        A checkpoint left in log_dir by an earlier run of the test is
+        rebuilt into mission_result_<test_ID>.recovered.json first.
+    '''
+
+    def __init__(self, log_dir, test_ID, mission_result, logger):
+        self.log_dir = log_dir
+        self.test_ID = test_ID
+        self.mission_result = mission_result
+        self.logger = logger
+        self.lock = threading.Lock()
+
+        self.snapshot_fp = snapshot_filepath(log_dir, test_ID)
+        self.deltas_fp = deltas_filepath(log_dir, test_ID)
+        self.recover()
+
+        self.seq = 0
+        self.num_deltas = 0
+        self.leaves = copy.deepcopy(flatten(mission_result))
+        self.compact()
+
+    def recover(self):
+        try:
+            recovered = load_mission_result(self.log_dir, self.test_ID)
+        except Exception:
+            self.logger.error(f"[Checkpoint] fail to rebuild the mission result from the earlier checkpoint in {self.log_dir}", exc_info=True)
+            return
+        if recovered is not None:
+            recovered_fp = os.path.join(self.log_dir, f"mission_result_{self.test_ID}.recovered.json")
+            write_atomically(recovered_fp, recovered)
+            self.logger.warning(f"[Checkpoint] The mission result checkpointed by an earlier run is saved to {recovered_fp}")
+
+    def update(self):
+        '''
+            Append the changes of the mission result since the last update
+        '''
+        with self.lock:
+            try:
+                leaves = flatten(self.mission_result)
+            except RuntimeError: # changed while being read, take it next time
+                return
+            changes = [[list(path), copy.deepcopy(value)] for path, value in leaves.items() if (path not in self.leaves) or (self.leaves[path] != value)]
+            if not changes:
+                return
+
+            self.seq += 1
+            with open(self.deltas_fp, "a") as fp:
+                fp.write(json.dumps({"seq": self.seq, "set": changes}) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.leaves = {path: copy.deepcopy(value) for path, value in leaves.items()}
+            self.num_deltas += 1
+            if self.num_deltas >= compaction_threshold:
+                self.compact()
+
+    def compact(self):
+        '''
+            Write the mission result as of the last update as a snapshot
+            and drop the deltas
+        '''
+        write_atomically(self.snapshot_fp, {"seq": self.seq, "mission_result": unflatten(self.leaves)})
+        # The deltas are in the snapshot now, so a crash before they are
+        # dropped only makes them be skipped when loading
+        with open(self.deltas_fp, "w"):
+            pass
+        self.num_deltas = 0
+
+    def remove(self):
+        '''
+            Remove the checkpoint once the mission result is saved
+        '''
+        with self.lock:
+            for filepath in [self.snapshot_fp, self.deltas_fp]:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print("python3 mission_checkpoint.py log_dir test_ID [out_file]")
+        exit(1)
+    log_dir, test_ID = sys.argv[1], sys.argv[2]
+    out_fp = sys.argv[3] if len(sys.argv) == 4 else os.path.join(log_dir, f"mission_result_{test_ID}.json")
+
+    mission_result = load_mission_result(log_dir, test_ID)
+    if mission_result is None:
+        print(f"No checkpoint of the test {test_ID} in {log_dir}")
+        exit(1)
+    with open(out_fp, "w") as fp:
+        json.dump(mission_result, fp, indent=4)
+    print(f"The mission result of the test {test_ID} is rebuilt to {out_fp}")
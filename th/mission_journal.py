@@ -0,0 +1,121 @@
+'''
+    An append-only binary journal of the events of a mission, written by
+    the TH next to its log and loaded with read_journal():
+
+        journal = read_journal("mission_journal_<test_ID>.bin")
+        observations = journal[journal["event"] == event_codes["observation"]]
+        xs = observations["payload"][:, 0]
+
+    The file starts with the 8-byte header magic, version, record size.
+    Then come fixed-size little-endian records (journal_dtype):
+        time:     wall clock time in seconds since the epoch
+        sim_time: the sim-time of the robot when the event happened, or of
+                  the latest robot status observed before it
+        event:    event code, see event_types
+        payload:  num_payload numbers, whose meaning depends on the event,
+                  nan when unused
+    python3 mission_journal.py <journal_file> prints the number of events
+    of each type.
+'''
+import sys
+import time
+import struct
+import threading
+
+import numpy as np
+
+from test_spec import perturbation_types
+
+journal_magic = b"CP1J"
+journal_version = 1
+num_payload = 4
+
+journal_header = struct.Struct("<4sHH")
+journal_record = struct.Struct(f"<ddH{num_payload}d")
+
+journal_dtype = np.dtype([
+        ("time", "<f8"),
+        ("sim_time", "<f8"),
+        ("event", "<u2"),
+        ("payload", "<f8", (num_payload,))])
+
+# The events and their payloads. The code of an event is its index + 1.
+event_types = [
+        ("mission_start",       ["num_targets"]),
+        ("ta_status",           ["status_code", "target_ID"]),  # status_code: index in ta_statuses
+        ("observation",         ["x", "y", "battery", "observation_num"]),
+        ("observation_failed",  ["observation_num"]),
+        ("perturbation",        ["target_ID", "perturb_ID", "type_code", "result"]), # type_code: see perturbation_type_codes, result: 1 if it succeeds
+        ("obstacle_placed",     ["x", "y", "target_ID", "ratio"]),
+        ("obstacle_removed",    ["target_ID"]),
+        ("battery_set",         ["charge", "target_ID", "ratio"]),
+        ("target_reached",      ["target_ID", "x", "y"]),
+        ("mission_done",        ["num_targets_reached"])]
+
+event_codes = {name: code+1 for code, (name, _) in enumerate(event_types)}
+
+# The TA statuses of the ta_status events
+ta_statuses = ["live", "at-waypoint", "adapt-started", "adapt-done", "error", "done"]
+
+# The perturbation types of the perturbation events, -1 if unknown
+perturbation_type_codes = {name: code for code, name in enumerate(perturbation_types["obstacle"] + perturbation_types["battery"])}
+
+
+class MissionJournal:
+    '''
+        Writes the events of a mission to a journal file. It can be used by
+        many threads at once. The records are buffered; they are all in the
+        file once close() returns.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.fp = open(filepath, "wb")
+        self.fp.write(journal_header.pack(journal_magic, journal_version, journal_record.size))
+
+    def append(self, event, sim_time, *payload):
+        '''
+            Append an event, given by its name in event_types, with up to
+            num_payload numbers
+        '''
+        payload = list(payload) + [np.nan] * (num_payload - len(payload))
+        record = journal_record.pack(time.time(), sim_time, event_codes[event], *payload)
+        with self.lock:
+            if not self.fp.closed:
+                self.fp.write(record)
+
+    def flush(self):
+        with self.lock:
+            if not self.fp.closed:
+                self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+def read_journal(filepath):
+    '''
+        The records of a journal file as a numpy array of journal_dtype.
+        A record cut short at the end of the file is ignored.
+    '''
+    with open(filepath, "rb") as fp:
+        magic, version, record_size = journal_header.unpack(fp.read(journal_header.size))
+        if (magic != journal_magic) or (version != journal_version) or (record_size != journal_dtype.itemsize):
+            raise ValueError(f"{filepath} is not a version {journal_version} mission journal")
+        data = fp.read()
+    num_records = len(data) // record_size
+    return np.frombuffer(data, dtype=journal_dtype, count=num_records)
+
+
+def event_name(code):
+    return event_types[code-1][0]
+
+
+if __name__ == '__main__':
+    journal = read_journal(sys.argv[1])
+    print(f"{len(journal)} events")
+    codes, counts = np.unique(journal["event"], return_counts=True)
+    for code, count in zip(codes.tolist(), counts.tolist()):
+        print(f"\t{event_name(code)}: {count}")
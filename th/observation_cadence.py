@@ -0,0 +1,167 @@
+import time
+
+import numpy as np
+from numpy.linalg import norm # L2 norm
+
+from obstacle_placement import waypoint_exclusion_radius, obstacle_target_safe_distance_threshold
+
+# The TH sends /observe to the TA every base_observation_interval seconds.
+# It observes every min_observation_interval seconds while a perturbation
+# is waiting for a robot location or the robot is about to enter the zone
+# around a waypoint or the target, where an obstacle perturbation has to
+# wait for the next observation.
+min_observation_interval = 0.25
+base_observation_interval = 1
+
+# While the robot is charging or adapting, perturbations are not allowed,
+# so the interval is multiplied by observation_backoff_factor after every
+# observation up to max_observation_interval.
+max_observation_interval = 4
+observation_backoff_factor = 2
+
+# The robot is approaching a waypoint (the target) when it is within
+# approach_distance of the zone around it
+approach_distance = 1.5
+
+# Budget of /observe requests per TA: on average at most
+# observation_budget_rate requests per second, in bursts of at most
+# observation_budget_burst requests.
+observation_budget_rate = 3
+observation_budget_burst = 6
+
+
+class ObservationCadence:
+    '''
+        Decides when the TH observes the robot next.
+
+        The caller asks next_delay() how long to wait before the next
+        /observe request and calls record_observation() every time it sends
+        one. The delay is counted from the last observation, so it can be
+        asked again whenever the state of the mission changes.
+    '''
+
+    def __init__(self, test_map,
+            min_interval=min_observation_interval,
+            base_interval=base_observation_interval,
+            max_interval=max_observation_interval,
+            backoff_factor=observation_backoff_factor,
+            budget_rate=observation_budget_rate,
+            budget_burst=observation_budget_burst):
+        self.test_map       = test_map
+        self.min_interval   = min_interval
+        self.base_interval  = base_interval
+        self.max_interval   = max_interval
+        self.backoff_factor = backoff_factor
+        self.budget_rate    = budget_rate
+        self.budget_burst   = budget_burst
+
+        # token bucket of the request budget
+        self.tokens         = budget_burst
+        self.tokens_time    = time.monotonic()
+
+        # the kind of interval returned by interval(): "fast", "base" or "backoff"
+        self.mode               = "base"
+        # observations made while the robot is charging or adapting in a row
+        self.paused_streak      = 0
+        self.first_observation  = None
+        self.last_observation   = None
+        self.num_observations   = 0
+        self.num_fast_observations      = 0
+        self.num_backoff_observations   = 0
+
+    def refill(self, now):
+        self.tokens = min(self.budget_burst, self.tokens + (now - self.tokens_time) * self.budget_rate)
+        self.tokens_time = now
+
+    def approaching(self, robot_status, plan):
+        '''
+            Whether the robot is about to enter the zone around a waypoint or the target
+        '''
+        if not robot_status:
+            return False
+        closest_waypoint = self.test_map.coords_to_waypoint(robot_status)
+        if closest_waypoint['dist'] <= waypoint_exclusion_radius + approach_distance:
+            return True
+        if (len(plan) > 0) and self.test_map.is_waypoint(plan[-1]):
+            target_loc = self.test_map.waypoint_to_coord_array(plan[-1])
+            robot_loc = np.array([robot_status['x'], robot_status['y']])
+            if norm(robot_loc - target_loc) <= obstacle_target_safe_distance_threshold + approach_distance:
+                return True
+        return False
+
+    def interval(self, robot_status, armed, paused, plan, hold_until=0):
+        '''
+            The interval between the last observation and the next one
+
+            robot_status:   the last robot status, from /observe
+            armed:          a perturbation is waiting for a robot location
+            paused:         the robot is charging or adapting
+            plan:           the current plan of the robot
+            hold_until:     time.monotonic() before which a perturbation does
+                            not need a robot location. Until then the robot
+                            is observed at the base interval instead of the
+                            fast one, so that charging is still noticed.
+        '''
+        if paused:
+            self.mode = "backoff"
+            return min(self.base_interval * (self.backoff_factor ** self.paused_streak), self.max_interval)
+        elif armed or self.approaching(robot_status, plan):
+            held = hold_until - self.last_observation
+            if held > self.min_interval:
+                self.mode = "base"
+                return min(held, self.base_interval)
+            self.mode = "fast"
+            return self.min_interval
+        self.mode = "base"
+        return self.base_interval
+
+    def next_delay(self, robot_status, armed, paused, plan, hold_until=0):
+        '''
+            Seconds to wait before the next observation, 0 if it is due
+        '''
+        now = time.monotonic()
+        if self.last_observation is None:
+            return 0
+        delay = self.last_observation + self.interval(robot_status, armed, paused, plan, hold_until) - now
+
+        # wait for the budget to have a request left
+        self.refill(now)
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.budget_rate)
+
+        return max(delay, 0)
+
+    def record_observation(self):
+        '''
+            Count an /observe request sent after the last next_delay()
+        '''
+        now = time.monotonic()
+        self.refill(now)
+        self.tokens -= 1
+
+        if self.first_observation is None:
+            self.first_observation = now
+        self.last_observation = now
+        self.num_observations += 1
+
+        if self.mode == "backoff":
+            self.paused_streak += 1
+            self.num_backoff_observations += 1
+        else:
+            self.paused_streak = 0
+            if self.mode == "fast":
+                self.num_fast_observations += 1
+
+    def report(self):
+        '''
+            The observation statistics stored in the mission result
+        '''
+        duration = 0
+        if self.num_observations > 1:
+            duration = self.last_observation - self.first_observation
+        return {
+                'num_observations': self.num_observations,
+                'num_fast_observations': self.num_fast_observations,
+                'num_backoff_observations': self.num_backoff_observations,
+                'duration': duration,
+                'effective_rate': (self.num_observations - 1) / duration if duration > 0 else 0}
@@ -0,0 +1,204 @@
+import numpy as np
+
+# In cp1_controller, robotcontrol/bot_controller.py considers robot is close
+# enough to a target waypoint if their distance is smaller than 2.
+# Source:   https://github.com/cmu-mars/cp1_controllers/blob/master/robotcontrol/bot_controller.py
+#
+# line 27   distance_threshold = 2
+# line 294  elif d <= distance_threshold and not success:
+#               rospy.logwarn(
+#                   "Apparently the robot could accomplish the task but ig_server reported differently!")
+#               start = target
+# line 298      success = True
+#
+# So, place the obstacle at least 2m and 3m away from the target and the robot respectively
+obstacle_target_safe_distance_threshold = 2
+obstacle_robot_safe_distance_threshold = 3
+
+# Used when determining which segment the robot locates.
+# When the distance between the robot and a segment is smaller
+# than the threshold, consider the robot is in the segment.
+to_seg_dist_threshold = 0.5
+
+# When the robot is within this distance of a waypoint, inferring which
+# segment it is in is difficult, so obstacle perturbations wait for the robot
+# to move farther from the waypoint.
+waypoint_exclusion_radius = 1
+
+# Obstacles placed in the segments, l1-l2 and l7-l8, will trap the robot.
+# So, l1 and l8 are removed from the plan before placing an obstacle and a robot
+# in either segment is considered to be at the other end of the segment.
+dead_end_waypoints = ["l1", "l8"]
+dead_end_segments = [("l1", "l2"), ("l7", "l8")]
+
+# Reason codes returned by compute_obstacle_locations()
+placement_feasible          = 0
+empty_plan                  = 1
+single_waypoint_plan        = 2
+dead_end_plan               = 3
+invalid_plan                = 4
+robot_not_in_plan           = 5
+too_close_to_target         = 6
+target_segment_too_short    = 7
+segment_too_short           = 8
+robot_near_waypoint         = 9
+
+infeasibility_reasons = {
+        placement_feasible          : "The obstacle can be placed.",
+        empty_plan                  : "The current plan is empty.",
+        single_waypoint_plan        : "The current plan has only one target. Placing an effective obstacle will trap the robot.",
+        dead_end_plan               : "The current plan has two targets but one of them is 'l1' or 'l8'. Placing an effective obstacle will trap the robot.",
+        invalid_plan                : "The current plan does not follow the segments of the map.",
+        robot_not_in_plan           : f"The robot is not in any segment: the distance from the robot to any segment is larger than {to_seg_dist_threshold}.",
+        too_close_to_target         : f"The distance from the robot to the current target is smaller than {obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold} that is too close to place an obstacle in-between.",
+        target_segment_too_short    : f"The coming waypoint is the target, while the length of the segment where the obstacle will be placed is smaller than {obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold} that is too close to place an obstacle in-between.",
+        segment_too_short           : f"The length of the segment where the obstacle will be placed is smaller than {obstacle_robot_safe_distance_threshold} that is too close such that the robot will get stuck if the obstacle is placed on the segment.",
+        robot_near_waypoint         : f"The robot is never farther than {waypoint_exclusion_radius} from a waypoint on its way to the target."}
+
+
+def check_plan(plan):
+    '''
+        The checks made on the robot's plan before placing an obstacle.
+        Returns placement_feasible or the reason why no obstacle can be placed.
+    '''
+    if len(plan) == 0:
+        return empty_plan
+    elif len(plan) == 1:
+        return single_waypoint_plan
+    elif (len(plan) == 2) and any(w in plan for w in dead_end_waypoints):
+        return dead_end_plan
+    return placement_feasible
+
+
+def compute_obstacle_locations(test_map, positions, ratios, plan_ids, mov_plans,
+        robot_safe_distance=obstacle_robot_safe_distance_threshold,
+        target_safe_distance=obstacle_target_safe_distance_threshold,
+        seg_dist_threshold=to_seg_dist_threshold):
+    '''
+        Compute where to place obstacles for many (robot position, ratio, plan) queries at once.
+
+        The obstacle is placed on the robot's plan at ratio * (the distance
+        the robot still has to travel to the target), at least
+        robot_safe_distance away from the robot and at least
+        target_safe_distance away from the target. This is what the TH does
+        for an obstacle perturbation; the rows are processed per plan with
+        numpy operations.
+
+        positions:  (M x 2) array of robot locations
+        ratios:     (M,) array of obstacle perturbation ratios
+        plan_ids:   (M,) array of indices into mov_plans
+        mov_plans:  list of plans like the TH's cur_mov_plan,
+                    {'plan': [waypoint ids], 'sentByTAStatus': status}
+
+        Returns (obstacle_coords, reasons): an (M x 2) array of obstacle
+        locations (NaN where no obstacle can be placed) and an (M,) array of
+        reason codes, placement_feasible or a key of infeasibility_reasons.
+    '''
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    ratios = np.asarray(ratios, dtype=float).reshape(-1)
+    plan_ids = np.asarray(plan_ids, dtype=np.int64).reshape(-1)
+
+    M = len(positions)
+    obstacle_coords = np.full((M, 2), np.nan)
+    reasons = np.full(M, placement_feasible, dtype=np.int64)
+
+    for plan_id in np.unique(plan_ids):
+        rows = np.flatnonzero(plan_ids == plan_id)
+        mov_plan = mov_plans[plan_id]
+
+        plan_check = check_plan(mov_plan["plan"])
+        if plan_check != placement_feasible:
+            reasons[rows] = plan_check
+            continue
+
+        plan = [w for w in mov_plan["plan"] if w not in dead_end_waypoints]
+        try:
+            geometry = test_map.get_plan_geometry(plan)
+        except (KeyError, ValueError):
+            reasons[rows] = invalid_plan
+            continue
+
+        coords, plan_reasons = place_on_plan(
+                test_map, geometry, plan, mov_plan["sentByTAStatus"],
+                positions[rows], ratios[rows],
+                robot_safe_distance, target_safe_distance, seg_dist_threshold)
+        obstacle_coords[rows] = coords
+        reasons[rows] = plan_reasons
+
+    return obstacle_coords, reasons
+
+
+def place_on_plan(test_map, geometry, plan, sent_by_TA_status, robot_coords, ratios,
+        robot_safe_distance, target_safe_distance, seg_dist_threshold):
+    '''
+        compute_obstacle_locations() for rows that share the same plan
+    '''
+    N = len(robot_coords)
+    reasons = np.full(N, placement_feasible, dtype=np.int64)
+    plan_coords = test_map.coords[geometry.plan_idx]
+    cum = geometry.cum_lengths
+    last = len(plan) - 1
+
+    # If the robot is in either segment l1-l2 (moving to l2) or l7-l8 (moving to l7),
+    # the distance from the robot to the its current heading waypoint
+    # (l2 or l7) is not considered in the obstacle placement.
+    in_dead_end = np.zeros(N, dtype=bool)
+    for w1, w2 in dead_end_segments:
+        if test_map.is_waypoint(w1) and test_map.is_waypoint(w2):
+            segment_num, offset, dist = test_map.project_onto_plan(robot_coords, [w1, w2])
+            in_dead_end |= dist < seg_dist_threshold
+
+    # heading: index in the plan of the waypoint the robot is heading to
+    if sent_by_TA_status == "adapt-done":
+        # the first waypoint of the new plan
+        heading = np.zeros(N, dtype=np.int64)
+    else:
+        segment_num, offset, dist = test_map.project_onto_plan(robot_coords, plan)
+        heading = segment_num + 1
+        reasons[(dist >= seg_dist_threshold) & ~in_dead_end] = robot_not_in_plan
+
+    start_coords = robot_coords.copy()
+    start_coords[in_dead_end] = plan_coords[0]
+    heading[in_dead_end] = 1
+
+    # distance to the heading waypoint and then to the target along the plan
+    to_heading = np.linalg.norm(start_coords - plan_coords[heading], axis=1)
+    to_target = to_heading + cum[-1] - cum[heading]
+    reasons[(reasons == placement_feasible) & (to_target < robot_safe_distance+target_safe_distance)] = too_close_to_target
+
+    to_obstacle = np.maximum(to_target * ratios, robot_safe_distance)
+
+    # The obstacle goes on the first segment whose far end is at least
+    # to_obstacle away from the robot along the plan
+    obstacle_heading = np.where(
+            to_heading >= to_obstacle,
+            heading,
+            np.searchsorted(cum, to_obstacle - to_heading + cum[heading], side='left'))
+    obstacle_heading = np.minimum(obstacle_heading, last)
+    on_first = obstacle_heading == heading
+
+    # The starting and ending points of the segment
+    # for computing the coordinates of the obstacle
+    seg_start = np.where(on_first[:, None], start_coords, plan_coords[np.maximum(obstacle_heading-1, 0)])
+    seg_end = plan_coords[obstacle_heading]
+    seg_length = np.linalg.norm(seg_end - seg_start, axis=1)
+    to_left_point = np.where(on_first, to_obstacle, to_obstacle - to_heading - (cum[np.maximum(obstacle_heading-1, 0)] - cum[heading]))
+
+    # Keep the obstacle robot_safe_distance away from the starting point and,
+    # when the ending point is the target, target_safe_distance away from it
+    ends_at_target = geometry.plan_idx[obstacle_heading] == geometry.plan_idx[-1]
+    usable_length = np.where(
+            ends_at_target,
+            seg_length - (robot_safe_distance+target_safe_distance),
+            seg_length - robot_safe_distance)
+    feasible = reasons == placement_feasible
+    reasons[feasible & ends_at_target & (usable_length < 0)] = target_segment_too_short
+    reasons[feasible & ~ends_at_target & (usable_length < 0)] = segment_too_short
+
+    along = robot_safe_distance + np.clip(to_left_point - robot_safe_distance, 0, np.maximum(usable_length, 0))
+    units = np.divide(seg_end - seg_start, seg_length[:, None],
+            out=np.zeros_like(seg_start), where=seg_length[:, None] > 0)
+    coords = seg_start + units * along[:, None]
+    coords[reasons != placement_feasible] = np.nan
+
+    return coords, reasons
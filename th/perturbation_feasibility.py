@@ -0,0 +1,190 @@
+import sys
+import os
+import json
+import numpy as np
+
+from mapserver import MapServer
+from test_spec import perturbation_types, generate_list_of_perturbation_sequences
+from obstacle_placement import compute_obstacle_locations, check_plan, infeasibility_reasons, placement_feasible, robot_near_waypoint, waypoint_exclusion_radius
+
+# Spacing of the robot locations sampled along the path to a target
+sample_step = 0.5
+
+# How many times generate_feasible_perturbation_sequences() redraws the
+# perturbations before giving up
+max_regeneration_attempts = 100
+
+
+def sample_robot_locations(test_map, path, step=sample_step):
+    '''
+        Robot locations every step meters along the path, leaving out the
+        locations where the TH waits before placing an obstacle, i.e., those
+        within waypoint_exclusion_radius of a waypoint.
+    '''
+    geometry = test_map.get_plan_geometry(path)
+    offsets = np.arange(0, geometry.cum_lengths[-1], step)
+    segment_num = np.clip(np.searchsorted(geometry.cum_lengths, offsets, side='right') - 1, 0, len(geometry.lengths)-1)
+    locations = geometry.starts[segment_num] + geometry.units[segment_num] * (offsets - geometry.cum_lengths[segment_num])[:, None]
+    _, dists = test_map.coords_to_waypoints(locations)
+    return locations[dists[:, 0] > waypoint_exclusion_radius]
+
+
+def check_obstacle_perturbations(test_map, missions, step=sample_step):
+    '''
+        Replays the default path of each target of each mission and checks
+        whether its obstacle perturbations can ever be placed.
+
+        The robot is assumed to follow the shortest path from the previous
+        target (or the start location) to the target. Robot locations are
+        sampled along the path and the obstacle ratio is evaluated at each
+        of them with the same geometry as the TH. An obstacle perturbation
+        is infeasible if no sampled location admits an obstacle.
+
+        missions:   list of (start_loc, target_locs, perturb_seqs), where
+                    perturb_seqs is the output of generate_list_of_perturbation_sequences()
+
+        Returns a list with one entry per mission: the list of its
+        infeasible obstacle perturbations, each a dict
+        {"target": "Target1", "index": position in perturb_seqs["Target1"],
+        "type": "op_easy", "ratio": 0.1, "reason": reason code}.
+        The reason is the one at the earliest sampled location.
+    '''
+    results = [[] for _ in missions]
+
+    # Sampled robot locations are shared by the perturbations on the same path
+    paths = {}
+    mov_plans = []
+    queries = []
+    for mission_num, (start_loc, target_locs, perturb_seqs) in enumerate(missions):
+        prev_loc = start_loc
+        for target_num, target_loc in enumerate(target_locs, start=1):
+            target_ID = f"Target{target_num}"
+            for index, perturbation in enumerate(perturb_seqs.get(target_ID, [])):
+                if perturbation["type"] not in perturbation_types["obstacle"]:
+                    continue
+                if (prev_loc, target_loc) not in paths:
+                    path = test_map.shortest_path(prev_loc, target_loc)
+                    plan_check = check_plan(path)
+                    if plan_check != placement_feasible:
+                        locations = np.empty((0, 2))
+                    else:
+                        locations = sample_robot_locations(test_map, path, step)
+                    paths[(prev_loc, target_loc)] = (len(mov_plans), plan_check, locations)
+                    mov_plans.append({"plan": path, "sentByTAStatus": "live"})
+                queries.append((mission_num, target_ID, index, perturbation, paths[(prev_loc, target_loc)]))
+            prev_loc = target_loc
+
+    if len(queries) == 0:
+        return results
+
+    num_samples = np.array([len(q[4][2]) for q in queries], dtype=np.int64)
+    positions = np.concatenate([q[4][2] for q in queries] + [np.empty((0, 2))])
+    ratios = np.repeat([q[3]["ratio"] for q in queries], num_samples)
+    plan_ids = np.repeat([q[4][0] for q in queries], num_samples)
+    owners = np.repeat(np.arange(len(queries)), num_samples)
+
+    _, reasons = compute_obstacle_locations(test_map, positions, ratios, plan_ids, mov_plans)
+
+    num_feasible = np.bincount(owners[reasons == placement_feasible], minlength=len(queries))
+    first_rows = np.cumsum(num_samples) - num_samples
+    for query_num, (mission_num, target_ID, index, perturbation, (plan_id, plan_check, _)) in enumerate(queries):
+        if num_feasible[query_num] > 0:
+            continue
+        if plan_check != placement_feasible:
+            reason = plan_check
+        elif num_samples[query_num] == 0:
+            reason = robot_near_waypoint
+        else:
+            reason = reasons[first_rows[query_num]].item()
+        results[mission_num].append({
+            "target": target_ID,
+            "index": index,
+            "type": perturbation["type"],
+            "ratio": perturbation["ratio"],
+            "reason": reason})
+
+    return results
+
+
+def check_perturbation_sequences(test_map, start_loc, target_locs, perturb_seqs, step=sample_step):
+    '''
+        check_obstacle_perturbations() for a single mission
+    '''
+    return check_obstacle_perturbations(test_map, [(start_loc, target_locs, perturb_seqs)], step)[0]
+
+
+def generate_feasible_perturbation_sequences(test_map, start_loc, target_locs, obstacles, battery_sets, max_attempts=max_regeneration_attempts):
+    '''
+        generate_list_of_perturbation_sequences() that redraws the
+        perturbations until every obstacle perturbation can be placed.
+
+        Returns (perturb_seqs, infeasible); infeasible is empty unless no
+        feasible sequence is found in max_attempts draws, in which case the
+        last draw and its infeasible obstacle perturbations are returned.
+    '''
+    for _ in range(max_attempts):
+        perturb_seqs = generate_list_of_perturbation_sequences(len(target_locs), obstacles, battery_sets)
+        infeasible = check_perturbation_sequences(test_map, start_loc, target_locs, perturb_seqs)
+        if len(infeasible) == 0:
+            break
+    return perturb_seqs, infeasible
+
+
+def find_test_specs(test_spec_fold):
+    test_spec_fps = []
+    for root, dirs, files in os.walk(test_spec_fold):
+        dirs.sort()
+        for fn in sorted(files):
+            if fn.endswith(".json"):
+                test_spec_fps.append(os.path.join(root, fn))
+    return test_spec_fps
+
+
+def load_mission(test_spec_fp):
+    '''
+        (start_loc, target_locs, perturb_seqs) of a test spec written by TestSpec.writeSpecToFile()
+    '''
+    with open(test_spec_fp) as fp:
+        spec = json.load(fp)
+    test_configuration = spec["test_configuration"]
+    perturb_seqs = spec.get("perturbation", {}).get("perturbSeqs", {})
+    return (test_configuration["start-loc"], test_configuration["target-locs"], perturb_seqs)
+
+
+def usage():
+    print("=========================================================================")
+    print("python perturbation_feasibility.py <map file> <test spec file or fold>")
+    print("=========================================================================")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        usage()
+        exit(1)
+
+    cp1_map_fp      = sys.argv[1]
+    test_spec_path  = sys.argv[2]
+
+    map_server = MapServer(cp1_map_fp)
+
+    if os.path.isdir(test_spec_path):
+        test_spec_fps = find_test_specs(test_spec_path)
+    else:
+        test_spec_fps = [test_spec_path]
+
+    missions = [load_mission(test_spec_fp) for test_spec_fp in test_spec_fps]
+    results = check_obstacle_perturbations(map_server, missions)
+
+    num_infeasible_specs = 0
+    for test_spec_fp, (start_loc, target_locs, _), infeasible in zip(test_spec_fps, missions, results):
+        if len(infeasible) == 0:
+            continue
+        num_infeasible_specs += 1
+        print(test_spec_fp)
+        for p in infeasible:
+            target_num = int(p["target"][len("Target"):])
+            prev_loc = start_loc if target_num == 1 else target_locs[target_num-2]
+            print(f"    {p['target']} ({prev_loc} -> {target_locs[target_num-1]}) perturbation {p['index']} ({p['type']}, {p['ratio']}): {infeasibility_reasons[p['reason']]}")
+
+    print(f"{num_infeasible_specs} of {len(test_spec_fps)} test specs have obstacle perturbations that can never be placed.")
+    exit(1 if num_infeasible_specs > 0 else 0)
@@ -0,0 +1,92 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+# Number of threads handling the requests to the TH
+default_workers = 8
+
+# Seconds to wait for the requests accepted before a shutdown to be handled
+drain_timeout = 10
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    '''
+        A werkzeug WSGI server that handles the requests on a pool of
+        workers threads, so that a slow request does not delay the others.
+        The accepted requests wait in the queue of the pool until a worker
+        is free; the depth of that queue and the time spent in it are
+        counted, see metrics().
+
+        drain() stops accepting requests and waits for the accepted ones to
+        be handled.
+    '''
+    multithread = True
+
+    def __init__(self, host, port, app, workers=default_workers):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="th_server_worker")
+
+        # Guards the counters below and is notified when a request is handled
+        self.state = threading.Condition()
+        self.queued = 0             # accepted requests waiting for a worker
+        self.active = 0             # requests being handled
+        self.handled = 0
+        self.max_queue_depth = 0
+        self.total_queue_wait = 0.0 # seconds
+        self.max_queue_wait = 0.0   # seconds
+
+    def process_request(self, request, client_address):
+        with self.state:
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        self.executor.submit(self.process_request_in_worker, request, client_address, time.monotonic())
+
+    def process_request_in_worker(self, request, client_address, accepted_time):
+        queue_wait = time.monotonic() - accepted_time
+        with self.state:
+            self.queued -= 1
+            self.active += 1
+            self.total_queue_wait += queue_wait
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.state:
+                self.active -= 1
+                self.handled += 1
+                self.state.notify_all()
+
+    def metrics(self):
+        '''
+            The number of requests waiting for a worker, being handled and
+            handled, and the max queue depth and the mean and max seconds
+            spent in the queue
+        '''
+        with self.state:
+            started = self.handled + self.active
+            return {"workers": self.workers,
+                    "queued": self.queued,
+                    "active": self.active,
+                    "handled": self.handled,
+                    "max_queue_depth": self.max_queue_depth,
+                    "mean_queue_wait": self.total_queue_wait / started if started else 0.0,
+                    "max_queue_wait": self.max_queue_wait}
+
+    def drain(self, timeout=drain_timeout):
+        '''
+            Stop accepting requests and wait up to timeout seconds for the
+            accepted ones to be handled. Must not be called from the thread
+            serving the requests. Returns False if some are not handled.
+        '''
+        self.shutdown()
+        with self.state:
+            drained = self.state.wait_for(lambda: (self.queued + self.active) == 0, timeout)
+        self.executor.shutdown(wait=drained)
+        self.server_close()
+        return drained
@@ -0,0 +1,81 @@
+import time
+import threading
+import collections
+from types import MappingProxyType
+
+# Number of robot statuses kept by RobotStatusBuffer
+default_capacity = 64
+
+# A robot status observed by the TH.
+#   seq:    1 for the first status observed, 2 for the next one, ...
+#           0 for the status the buffer is created with
+#   time:   time.monotonic() when the status was received
+#   status: a read-only view of the status returned from /observe,
+#           or False if the observation failed
+RobotStatusSnapshot = collections.namedtuple('RobotStatusSnapshot', ['seq', 'time', 'status'])
+
+
+def freeze(status):
+    if status == False:
+        return False
+    return MappingProxyType(dict(status))
+
+
+class RobotStatusBuffer:
+    '''
+        Ring buffer of the last capacity robot statuses.
+
+        There is a single writer, the thread observing the robot, and any
+        number of readers. The writer never waits for the readers: a
+        snapshot is never modified once published, so readers take the
+        latest one without locking. Readers that need a status newer than
+        the one they used wait for it with wait_newer().
+
+        The waiting readers are woken up through condition, which can be
+        shared with other state the readers wait for.
+    '''
+
+    def __init__(self, initial_status, capacity=default_capacity, condition=None):
+        self.capacity = capacity
+        self.condition = condition if condition is not None else threading.Condition()
+        self.slots = [None] * capacity
+        self.latest = RobotStatusSnapshot(0, time.monotonic(), freeze(initial_status))
+        self.slots[0] = self.latest
+
+    def publish(self, status):
+        '''
+            Store a new robot status and wake up the waiting readers
+        '''
+        snapshot = RobotStatusSnapshot(self.latest.seq + 1, time.monotonic(), freeze(status))
+        self.slots[snapshot.seq % self.capacity] = snapshot
+        self.latest = snapshot
+        with self.condition:
+            self.condition.notify_all()
+        return snapshot
+
+    def wait_newer(self, seq, timeout=None):
+        '''
+            The latest snapshot once its seq is larger than seq, or None if
+            there is none after timeout seconds
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest.seq > seq, timeout):
+                return None
+        return self.latest
+
+    def history(self, n=None):
+        '''
+            The last n observed snapshots (all the buffered ones if n is None),
+            oldest first
+        '''
+        latest = self.latest
+        n = self.capacity if n is None else min(n, self.capacity)
+        snapshots = []
+        for seq in range(latest.seq, max(latest.seq - n, 0), -1):
+            snapshot = self.slots[seq % self.capacity]
+            # stop at a slot already overwritten by a newer snapshot
+            if (snapshot is None) or (snapshot.seq != seq):
+                break
+            snapshots.append(snapshot)
+        snapshots.reverse()
+        return snapshots
@@ -0,0 +1,136 @@
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds of the requests to each TA endpoint.
+# The read timeout of /observe/stream bounds the wait for each line of the
+# stream; the TA sends a line every second at least.
+ta_endpoint_timeouts = {
+        "/start":                   (5, 60),
+        "/observe":                 (5, 10),
+        "/observe/stream":          (5, 5),
+        "/perturb/place-obstacle":  (5, 30),
+        "/perturb/remove-obstacle": (5, 30),
+        "/perturb/battery":         (5, 30)}
+
+# Endpoints whose requests can be sent again when the TA does not answer:
+# observing the robot or setting its battery to a given charge twice has
+# the same effect as doing it once. Placing or removing an obstacle and
+# starting the mission are not retried.
+idempotent_endpoints = {"/observe", "/perturb/battery"}
+
+# A failed request to an idempotent endpoint is retried up to max_retries
+# times, after a random delay of up to retry_backoff_base * 2^n seconds
+# (at most retry_backoff_max) before the n-th retry.
+max_retries = 3
+retry_backoff_base = 0.5
+retry_backoff_max = 4
+
+# Responses of a TA that may answer the same request later
+retry_status_codes = {502, 503, 504}
+
+# Connections kept open to the TA: the observer, a perturbation, the
+# mission thread and the robot status stream may send requests at once.
+pool_size = 4
+
+
+class EndpointLatency:
+    '''
+        Number of requests sent to a TA endpoint, of those that failed, and
+        their total and max latency in seconds
+    '''
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency, failed):
+        self.requests += 1
+        self.failures += int(failed)
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def summary(self):
+        mean = self.total / self.requests if self.requests else 0.0
+        return {"requests": self.requests, "failures": self.failures,
+                "mean_ms": round(mean * 1000, 1), "max_ms": round(self.max * 1000, 1)}
+
+
+class TAClient:
+    '''
+        The requests from the TH to one TA. They share a pool of keep-alive
+        connections, have per-endpoint timeouts (ta_endpoint_timeouts) and
+        are retried with a jittered exponential backoff when the endpoint is
+        idempotent. The latency of the requests is counted per endpoint.
+
+        A TAClient can be used by many threads at once.
+    '''
+
+    def __init__(self, ta_url, logger):
+        self.ta_url = ta_url
+        self.logger = logger
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.latencies = {path: EndpointLatency() for path in ta_endpoint_timeouts}
+        self.latencies_lock = threading.Lock()
+
+    def url(self, path):
+        return self.ta_url + path
+
+    def request(self, method, path, **kwargs):
+        '''
+            Send a request to the TA endpoint path and return the response.
+            Raises requests.RequestException if the TA does not answer, after
+            the retries for an idempotent endpoint.
+        '''
+        attempts = 1 + (max_retries if path in idempotent_endpoints else 0)
+        for attempt in range(attempts):
+            is_last = (attempt + 1 == attempts)
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, self.url(path), timeout=ta_endpoint_timeouts[path], **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_latency(path, time.monotonic() - start, True)
+                if is_last:
+                    raise
+                reason = str(e)
+            else:
+                retry = response.status_code in retry_status_codes
+                self.record_latency(path, time.monotonic() - start, retry)
+                if is_last or not retry:
+                    return response
+                response.close()
+                reason = f"response code {response.status_code}"
+
+            delay = random.uniform(0, min(retry_backoff_max, retry_backoff_base * (2 ** attempt)))
+            self.logger.warning(f"[TA Client] {method} {path} failed ({reason}). Retry in {delay:.2f} seconds.")
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def record_latency(self, path, latency, failed):
+        with self.latencies_lock:
+            self.latencies[path].record(latency, failed)
+
+    def latency_summary(self):
+        '''
+            {path: {"requests", "failures", "mean_ms", "max_ms"}} of the
+            endpoints that were sent a request
+        '''
+        with self.latencies_lock:
+            return {path: latency.summary() for path, latency in self.latencies.items() if latency.requests}
+
+    def close(self):
+        self.session.close()
@@ -191,6 +191,12 @@ do
     echo -e "[Upload the stdout.log for the test ${TEST_ID} to S3 bucket]"
     aws s3 cp ${STD_LOG_FP} "${S3_PATH}/${CUR_EVAL_ID}/${TEST_ID}/"
 
+    if [ ! -f "./th_log/mission_result_${TEST_ID}.json" ]
+    then
+        echo -e "[The TH did not save the mission result. Rebuild it from its checkpoint.]"
+        python3 mission_checkpoint.py ./th_log "${TEST_ID}"
+    fi
+
     echo -e "[Copy mission result file and used_budget file]"
     cp "./th_log/mission_result_${TEST_ID}.json" "${MISSION_RESULTS_DIR}"
     cp "./cp1/used_budget" "${MISSION_RESULTS_DIR}/used_budget_${TEST_ID}.txt"
@@ -0,0 +1,829 @@
+'''
+    The TH on asyncio: the same harness as th_server.py with the HTTP server,
+    the requests to the TA, the mission, the robot status observation and
+    the perturbations all running as coroutines in one thread.
+
+    The state that th_server.py keeps in threading.Events is kept in plain
+    flags of AsyncHarness that are changed through AsyncHarness.update(),
+    which wakes up every coroutine waiting in AsyncHarness.wait_until().
+    A perturbation runs in its own task that is cancelled as soon as the
+    current target or the mission is done.
+'''
+# Common System Packages
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+
+import numpy as np
+from numpy.linalg import norm # L2 norm
+
+# HTTP server and client
+import aiohttp
+from aiohttp import web
+
+# Local Packages
+from test_spec import perturbation_types
+from mapserver import MapServer
+from obstacle_placement import compute_obstacle_locations, infeasibility_reasons, placement_feasible, obstacle_target_safe_distance_threshold, waypoint_exclusion_radius
+from observation_cadence import ObservationCadence
+from robot_status_buffer import RobotStatusBuffer
+from mission_journal import MissionJournal, ta_statuses, perturbation_type_codes
+from mission_checkpoint import MissionCheckpoint
+from log_uploader import LogUploader, LogShipper, default_ship_interval
+from ta_client import EndpointLatency, ta_endpoint_timeouts, idempotent_endpoints, max_retries, retry_backoff_base, retry_backoff_max, retry_status_codes, pool_size
+from velocity_model import speed_along_plan, time_to_exit_waypoint_zone, time_to_placement, predict_location, velocity_window, obstacle_placement_latency, max_exit_wait
+from th_common import create_custom_logger, flush_logger, default_log_queue_size, default_log_overflow, wall_clock_ms, load_test_spec, new_mission_result, record_perturbation_result, record_target_reached
+
+
+def usage():
+    print("=================How To Run th_async.py=================================")
+    print("python3.6 th_async.py ta_url ta_port mission_map_file test_spec log_dir")
+    print("========================================================================")
+
+
+th_host = "0.0.0.0"
+th_port = 8081
+
+# Threshold of Battery level that can be set in perturbation
+battery_capacity = 32559
+battery_set_threshold_ratio = 0.1
+battery_set_threshold = int(battery_capacity * battery_set_threshold_ratio)
+
+# Seconds between two checkpoints of the mission result, see th_server.py
+checkpoint_interval = 5
+
+# Seconds between two perturbations of a target
+time_interval_perturbation = 2
+
+
+class AsyncHarness:
+
+    def __init__(self, ta_url, test_map, test_spec, test_ID, log_dir, s3_bucket_url, logger, log_ship_interval=default_ship_interval):
+        self.ta_url         = ta_url
+        self.test_map       = test_map
+        self.test_spec      = test_spec
+        self.test_ID        = test_ID
+        self.log_dir        = log_dir
+        self.s3_bucket_url  = s3_bucket_url
+        self.logger         = logger
+
+        self.case_level     = test_spec['test_configuration']['level']
+        self.targets        = test_spec["test_configuration"]["target-locs"]
+        self.num_targets    = len(self.targets)
+        self.perturbation_seqs = None # used by Case B, C and D
+        if self.case_level != 'a':
+            self.perturbation_seqs = test_spec["perturbation"]["perturbSeqs"]
+
+        self.mission_result = new_mission_result(test_spec)
+        # see journal in th_server.py
+        self.journal = MissionJournal(os.path.join(log_dir, f"mission_journal_{test_ID}.bin"))
+        # see log_uploader, log_shipper and checkpoint in th_server.py
+        self.log_uploader = LogUploader(s3_bucket_url + "/" + test_ID, logger)
+        self.log_ship_interval = log_ship_interval
+        self.log_shipper = None
+        self.checkpoint = MissionCheckpoint(log_dir, test_ID, self.mission_result, logger)
+
+        self.ta_endpoints = {
+                "start_mission": ta_url+"/start",
+                "robot_status": ta_url+"/observe",
+                "place_obstacle": ta_url+"/perturb/place-obstacle",
+                "remove_obstacle": ta_url+"/perturb/remove-obstacle",
+                "set_battery": ta_url+"/perturb/battery"}
+        # see TAClient.latencies in ta_client.py
+        self.ta_latencies = {path: EndpointLatency() for path in ta_endpoint_timeouts}
+
+        # The plan towards the current target, see cur_mov_plan in th_server.py
+        self.cur_mov_plan = {'plan':[], 'sentByTAStatus': ""}
+        self.cur_mov_plan_since = 0
+        self.cur_target_ID = 0
+        self.placed_obstacle_ID = None
+        # The task of the perturbation request sent to the TA by the running
+        # perturbation, see send_perturbation()
+        self.perturbation_request = None
+
+        # The same meaning as the events of th_server.py.
+        # Before the mission starts, robot does not aim for any target.
+        self.ta_alive           = False
+        self.can_perturb        = False
+        self.is_adapting        = False
+        self.mission_done       = True
+        self.cur_target_done    = True
+        self.last_target_done   = False
+        self.perturbation_armed = False
+
+        self.robot_status_buffer = RobotStatusBuffer({'sim-time': 0, 'plan': [], 'y': 0, 'x': 0, 'status': '', 'charge': 0})
+        # see observation_hold_until in th_server.py
+        self.observation_hold_until = 0
+
+        # Set (and replaced) by update() to wake up wait_until()
+        self.changed = asyncio.Event()
+        self.session = None
+
+    # [State]
+    @property
+    def robot_status(self):
+        return self.robot_status_buffer.latest.status
+
+    def robot_speed(self):
+        ''' see HarnessSession.robot_speed() in th_server.py '''
+        snapshots = [s for s in self.robot_status_buffer.history(velocity_window) if s.time >= self.cur_mov_plan_since]
+        return speed_along_plan(self.test_map, snapshots, self.cur_mov_plan["plan"])
+
+    @property
+    def robot_observation_num(self):
+        return self.robot_status_buffer.latest.seq
+
+    def update(self, **flags):
+        '''
+            Set the given flags, e.g. update(can_perturb=False), and wake up
+            the coroutines waiting in wait_until()
+        '''
+        for name, value in flags.items():
+            setattr(self, name, value)
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def wait_until(self, predicate, timeout=None):
+        '''
+            Wait until predicate() is true. Returns False if it is still
+            false after timeout seconds.
+        '''
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - loop.time()
+            if (remaining is not None) and (remaining <= 0):
+                return False
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+    def perturbation_cancel_reason(self):
+        if self.mission_done:
+            return "mission_done"
+        elif self.cur_target_done:
+            return "cur_target_done"
+        return None
+
+    # [Routes - Process Requests Sent From TA]
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/index', self.th_alive)
+        app.router.add_post('/ready', self.ta_is_ready)
+        app.router.add_post('/status', self.ta_status)
+        app.router.add_post('/error', self.ta_non_recoverable_error)
+        app.router.add_post('/done', self.test_done)
+        return app
+
+    async def th_alive(self, request):
+        return web.Response(text="TH server is running!\n")
+
+    async def ta_is_ready(self, request):
+        '''
+            Listen to the '/ready' requst from TA and then send mission to TA
+        '''
+        self.logger.info("received /ready from TA.")
+        return web.json_response(self.test_spec["test_configuration"])
+
+    async def ta_status(self, request):
+        '''
+            Acknowledge TA status
+        '''
+        status_content = None
+        try:
+            status_content = await request.json()
+            status = status_content['status']
+            if status in ta_statuses:
+                self.journal_event("ta_status", ta_statuses.index(status), self.cur_target_ID)
+
+            if status in ["live", "at-waypoint", "adapt-done"]:
+                if (status == "at-waypoint"):
+                    # Log into mission result if the current target is actually reached.
+                    x = status_content['x']
+                    y = status_content['y']
+                    robot_loc = np.array([x, y])
+
+                    cur_target_waypoint_name = self.cur_mov_plan["plan"][-1]
+                    target_loc = self.test_map.waypoint_to_coord_array(cur_target_waypoint_name)
+
+                    distance_robot_to_target = norm(robot_loc-target_loc)
+                    self.logger.info("[at-waypoint] distance between robot (%s) and the current target %s (%s) : %s.", robot_loc, cur_target_waypoint_name, target_loc, distance_robot_to_target)
+                    if distance_robot_to_target < obstacle_target_safe_distance_threshold:
+                        record_target_reached(self.mission_result, self.cur_target_ID, x, y, self.cur_mov_plan["plan"])
+                        self.journal_event("target_reached", self.cur_target_ID, x, y)
+                        self.checkpoint.update()
+
+                    if (self.cur_target_ID == self.num_targets):
+                        self.update(last_target_done=True)
+
+                # A new plan is set by the TA.
+                self.logger.debug("[%s] [old plan - %s", status, self.cur_mov_plan)
+                self.cur_mov_plan = {"plan": status_content['plan'], "sentByTAStatus": status}
+                self.cur_mov_plan_since = time.monotonic()
+                self.logger.debug("[%s] [new plan - %s", status, self.cur_mov_plan)
+
+                if status == "live":
+                    self.update(ta_alive=True)
+                elif status == "at-waypoint":
+                    self.update(cur_target_done=True)
+                else:
+                    self.update(is_adapting=False, can_perturb=True)
+            elif status == "adapt-started":
+                self.update(is_adapting=True, can_perturb=False)
+
+            self.logger.info("[TA Status Message] %s", status_content)
+
+            return web.Response(text=f"[CP1_TH ACK - TA Status Message] {status}.")
+        except Exception as e:
+            exception_msg = "[TA Status] TH encountered an error with the TA status message.\nTA status message: {}.\nTH error: {}".format(status_content, str(e))
+            self.logger.error(exception_msg, exc_info=True)
+            return web.Response(text=exception_msg, status=400)
+
+    def finish_mission(self, sim_time):
+        self.mission_result['mission_done']['wall_clock']   = wall_clock_ms()
+        self.mission_result['mission_done']['sim_time']     = sim_time
+        self.update(mission_done=True, last_target_done=True, cur_target_done=True, can_perturb=False)
+
+    async def ta_non_recoverable_error(self, request):
+        error_content = await request.json()
+        error_type = error_content['error']
+        error_msg = error_content['message']
+        self.logger.error(f"Error_Type: {error_type}, error_msg: {error_msg}", exc_info=True)
+
+        self.journal_event("ta_status", ta_statuses.index("error"), self.cur_target_ID)
+        self.finish_mission(self.robot_status['sim-time'] if self.robot_status != False else 0)
+
+        return web.Response(text=f"TH has stop the test due to the reported non-recoverable error {error_type}: {error_msg}")
+
+    async def test_done(self, request):
+        '''
+            Process '/done' request from TA, which indicates the test is done.
+        '''
+        self.journal_event("ta_status", ta_statuses.index("done"), self.cur_target_ID)
+        try:
+            content = await request.json()
+            mission_outcome = content['outcome']
+            tasks_finished = content['tasks-finished']
+            num_tasks_finished = len(tasks_finished)
+
+            mission_msg = ""
+            if mission_outcome == "at-goal":
+                if num_tasks_finished == self.num_targets:
+                    mission_msg = f"[Test Done: Mission Completed] {num_tasks_finished} tasks finished:\n"
+                else:
+                    mission_msg = f"[Test Done: Mission Incompleted] {num_tasks_finished} tasks finished:\n"
+            elif mission_outcome == "out-of-battery":
+                mission_msg = f"[Test Done: Abrupt - Low Energy] {num_tasks_finished} tasks finished:\n"
+            else: # unknown mission outcome message
+                raise ValueError(f"Unknown Mission Outcome Message: {mission_outcome}.\nFull request content: {content}")
+
+            for task_status in tasks_finished:
+                mission_msg += f"\tReached the target location {task_status['name']} ({task_status['x']}, {task_status['y']}) at the sim-time, {task_status['sim-time']}\n"
+
+            mission_msg += f"Final robot's status: charge = {content['charge']} mAh,  ({content['x']}, {content['y']}) at the sim-time, {content['sim-time']}\n"
+
+            self.logger.info(mission_msg)
+            self.finish_mission(content['sim-time'])
+
+            return web.Response(text=f"[CP1_TH] ACK - Test Done.")
+        except Exception as e:
+            exception_msg = "TH encountered an error at the completion of the mission: "+str(e)
+            self.logger.error(exception_msg, exc_info=True)
+            self.finish_mission(0)
+            return web.Response(text=exception_msg, status=400)
+
+    # [Requests Sent To TA]
+    async def ta_request(self, src, req_name, endpoint, method="GET", payload=None, has_content=True):
+        '''
+            Send a request to the TA with the timeouts of req_name and retry
+            it if req_name is idempotent, see TAClient in ta_client.py.
+            Returns the json content of the response ({} if has_content is
+            False) or False if the request fails.
+        '''
+        connect_timeout, read_timeout = ta_endpoint_timeouts[req_name]
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        attempts = 1 + (max_retries if req_name in idempotent_endpoints else 0)
+        for attempt in range(attempts):
+            is_last = (attempt + 1 == attempts)
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, endpoint, json=payload, timeout=timeout) as response:
+                    status_code = response.status
+                    if is_last or (status_code not in retry_status_codes):
+                        self.ta_latencies[req_name].record(time.monotonic() - start, status_code in retry_status_codes)
+                        if status_code == 200 or status_code == 204: # 204 - response body has no content
+                            if not has_content:
+                                return {}
+                            return await response.json(content_type=None)
+                        elif status_code == 400:
+                            self.logger.error(await response.text(), exc_info=True)
+                        else:
+                            self.logger.error("#%s# Unknown response code of %s request: %s", src, req_name, status_code, exc_info=True)
+                        return False
+                    reason = f"response code {status_code}"
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if is_last:
+                    self.ta_latencies[req_name].record(time.monotonic() - start, True)
+                    self.logger.error("#%s# Fatal error when sending %s request", src, req_name, exc_info=True)
+                    return False
+                reason = repr(e)
+            except (aiohttp.ClientError, ValueError):
+                self.logger.error("#%s# Fatal error when sending %s request", src, req_name, exc_info=True)
+                return False
+            self.ta_latencies[req_name].record(time.monotonic() - start, True)
+
+            delay = random.uniform(0, min(retry_backoff_max, retry_backoff_base * (2 ** attempt)))
+            self.logger.warning("[TA Client] %s %s failed (%s). Retry in %.2f seconds.", method, req_name, reason, delay)
+            await asyncio.sleep(delay)
+
+    async def observe_req(self, src, is_periodical=False):
+        if not is_periodical:
+            self.logger.info("#%s# Sending /observe request to TA: %s", src, self.ta_endpoints['robot_status'])
+        robot_status = await self.ta_request(src, "/observe", self.ta_endpoints["robot_status"])
+        if (robot_status != False) and (not is_periodical):
+            self.logger.info("[Robot Status] %s", robot_status)
+        return robot_status
+
+    async def place_obstacle_req(self, src, obstacle_cood):
+        '''
+            obstacle_cood: a dict, {'x': x_cood, 'y': y_cood}
+        '''
+        if self.placed_obstacle_ID != None:
+            self.logger.error("#%s# The TH tries to place an obstacle while the obstacle, %s, already exists on the map.", src, self.placed_obstacle_ID, exc_info=True)
+            return False
+
+        self.logger.info("#%s# Sending /perturb/place-obstacle to TA: %s", src, self.ta_endpoints['place_obstacle'])
+        data = await self.ta_request(src, "/perturb/place-obstacle", self.ta_endpoints["place_obstacle"], "POST", obstacle_cood)
+        if data == False:
+            return False
+        self.placed_obstacle_ID = data["obstacleid"]
+        self.logger.info("[Perturb - Place Obstacle] %s is placed at the location %s at sim-time %s", self.placed_obstacle_ID, obstacle_cood, data['sim-time'])
+        return True
+
+    async def remove_obstacle_req(self, src, obstacle_id):
+        self.logger.info("#%s#Sending /perturb/remove-obstacle request to TA: %s", src, self.ta_endpoints['remove_obstacle'])
+        data = await self.ta_request(src, "/perturb/remove-obstacle", self.ta_endpoints["remove_obstacle"], "POST", {"obstacleid":obstacle_id})
+        if data == False:
+            return False
+        self.logger.info("[Perturb - Remove Obstacle] %s is removed at sim-time %s", obstacle_id, data['sim-time'])
+        return True
+
+    async def set_battery_req(self, src, charge):
+        self.logger.info("#%s# Sending /perturb/battery request to TA: %s", src, self.ta_endpoints['set_battery'])
+        data = await self.ta_request(src, "/perturb/battery", self.ta_endpoints["set_battery"], "POST", {"charge":charge})
+        if data == False:
+            return False
+        self.logger.info("[Perturb - Set Battery] Battery charge is set to %s at sim-time %s", charge, data['sim-time'])
+        return True
+
+    async def start_mission_req(self, src):
+        self.logger.info(f"#{src}# Sending /start request to TA: {self.ta_endpoints['start_mission']}")
+        await asyncio.sleep(3)
+        if await self.ta_request(src, "/start", self.ta_endpoints["start_mission"], "POST", has_content=False) == False:
+            return False
+        self.logger.info(f"Mission is started in TA")
+        self.update(can_perturb=True)
+        return True
+
+    # [Perturbations]
+    async def run_perturbation(self, perturbation):
+        '''
+            Run a perturbation in its own task and cancel it as soon as the
+            current target or the mission is done. A perturbation request
+            already sent to the TA is shielded from the cancellation; it is
+            awaited and its response is the result of the perturbation.
+        '''
+        self.perturbation_request = None
+        perturbation_task = asyncio.ensure_future(self.do_perturbation(perturbation))
+        cancel_task = asyncio.ensure_future(self.wait_until(lambda: self.perturbation_cancel_reason() is not None))
+        self.update(perturbation_armed=True)
+        try:
+            done, pending = await asyncio.wait([perturbation_task, cancel_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.update(perturbation_armed=False)
+        for task in pending:
+            task.cancel()
+
+        if perturbation_task in done:
+            return perturbation_task.result()
+        if self.perturbation_request is not None:
+            # the TA may have perturbed the robot already, e.g. placed an
+            # obstacle that run_mission() has to remove
+            self.logger.info("[Perturbation] (%s, %s) is cancelled because %s is set. Wait for the response of the request sent to the TA.", perturbation['type'], perturbation['ratio'], self.perturbation_cancel_reason())
+            return await self.perturbation_request
+        self.logger.error("[Perturbation] (%s, %s) is cancelled because %s is set.", perturbation['type'], perturbation['ratio'], self.perturbation_cancel_reason(), exc_info=True)
+        return False
+
+    async def send_perturbation(self, request):
+        '''
+            Run the coroutine request, which sends a perturbation request to
+            the TA and records its result, in a task that cancelling the
+            perturbation does not cancel. See run_perturbation().
+        '''
+        self.perturbation_request = asyncio.ensure_future(request)
+        return await asyncio.shield(self.perturbation_request)
+
+    async def do_perturbation(self, perturbation):
+        perturbation_type = perturbation['type']
+        if perturbation_type in perturbation_types["obstacle"]:
+            return await self.obstacle_perturbation(perturbation)
+        elif perturbation_type in perturbation_types["battery"]:
+            return await self.battery_perturbation(perturbation)
+        else:
+            self.logger.error("[Do Perturbation] Unsupported perturbation type: %s", perturbation_type, exc_info=True)
+            return False
+
+    async def wait_for_perturbation_window(self, observation_num, not_before=0):
+        '''
+            Wait until can_perturb is set and a robot status newer than the
+            observation_num-th one is received after the time.monotonic() time
+            not_before. Returns the latest RobotStatusSnapshot.
+        '''
+        if not self.can_perturb:
+            self.logger.info("[Perturbation] Charging or adaptation happens. Wait until it is over.")
+        buffer = self.robot_status_buffer
+        await self.wait_until(lambda: self.can_perturb and (buffer.latest.seq > observation_num) and (buffer.latest.time >= not_before))
+        return buffer.latest
+
+    async def battery_perturbation(self, perturbation):
+        p_type = perturbation['type']
+        ratio  = perturbation['ratio']
+
+        status = (await self.wait_for_perturbation_window(self.robot_observation_num)).status
+        if status == False: # perturbation fails because of the failure of /observe request to the TA
+            self.logger.error("[Battery Perturbation] fail because /observe request fails.", exc_info=True)
+            return False
+
+        battery = status['battery']
+        if battery <= battery_set_threshold:
+            self.logger.error("[Battery Perturbation] fail because the robot's battery level, %s, is <= the threshold, %s.", battery, battery_set_threshold, exc_info=True)
+            return False
+
+        new_battery = battery - ratio*(battery-battery_set_threshold)
+        self.logger.info("[Battery Perturbation] (%s, %s) starts to setting battery level from %s to %s.", p_type, ratio, battery, new_battery)
+        return await self.send_perturbation(self.set_battery(p_type, ratio, new_battery, status['sim-time'], self.cur_target_ID))
+
+    async def set_battery(self, p_type, ratio, new_battery, sim_time, target_ID):
+        if await self.set_battery_req("battery_perturbation", new_battery):
+            self.logger.info("[Battery Perturbation] (%s, %s) succeeds", p_type, ratio)
+            self.journal.append("battery_set", sim_time, new_battery, target_ID, ratio)
+            return True
+        self.logger.error("[Battery Perturbation] (%s, %s) fails", p_type, ratio, exc_info=True)
+        return False
+
+    def compute_obstacle_location(self, x, y, ratio, mov_plan):
+        obstacle_coords, reasons = compute_obstacle_locations(self.test_map, [[x, y]], [ratio], [0], [mov_plan])
+        if reasons[0] != placement_feasible:
+            raise ValueError(f"[Compute Obstacle Loc] {infeasibility_reasons[reasons[0]]} Robot: ({x}, {y}), plan: {mov_plan}.")
+        ob_x, ob_y = obstacle_coords[0].tolist()
+        return {"x":ob_x, "y":ob_y}
+
+    async def obstacle_perturbation(self, perturbation):
+        p_type = perturbation['type']
+        ratio  = perturbation['ratio']
+
+        self.logger.info("[Obstacle Perturbation] (%s, %s) Starts", p_type, ratio)
+
+        robot_dist_check_counter = 0
+        observation_num = self.robot_observation_num
+        resume_time = 0 # when the robot is predicted to reach a point the obstacle can be placed from
+        while True:
+            snapshot = await self.wait_for_perturbation_window(observation_num, resume_time)
+            status, observation_num = snapshot.status, snapshot.seq
+            if status == False: # perturbation fails because of the failure of /observe request to the TA
+                self.logger.error("[Obstacle Perturbation] (%s, %s) fails because the /observe request fails", p_type, ratio)
+                return False
+
+            cur_loc = {'x':status['x'], 'y':status['y']}
+            closet_waypoint = self.test_map.coords_to_waypoint(cur_loc)
+            if closet_waypoint["dist"] > waypoint_exclusion_radius:
+                break
+
+            # Predict when the robot can be perturbed from its speed along the
+            # plan, see obstacle_perturbation() in th_server.py
+            plan = self.cur_mov_plan["plan"]
+            speed = self.robot_speed()
+            wait = time_to_placement(self.test_map, self.cur_mov_plan, (cur_loc['x'], cur_loc['y']), speed, ratio)
+            if wait is None:
+                wait = time_to_exit_waypoint_zone(self.test_map, plan, (cur_loc['x'], cur_loc['y']), speed)
+            if (wait is not None) and (wait <= max_exit_wait):
+                resume_time = snapshot.time + wait
+                self.observation_hold_until = resume_time
+                self.logger.info("[Obstacle Perturbation] The distance of the robot %s to the waypoint %s is %s. Moving at %.2f m/s, the robot can be perturbed in %.2f seconds. So, check again then.", cur_loc, closet_waypoint['id'], closet_waypoint['dist'], speed, wait)
+            else:
+                resume_time = 0
+                if (robot_dist_check_counter % 10) == 0:
+                    self.logger.info("[Obstacle Perturbation] The distance of the robot %s to the waypoint %s is %s. It is too close such that makes the inference of which segment the robot locates very difficulty. So, wait for the next observation and check again.", cur_loc, closet_waypoint['id'], closet_waypoint['dist'])
+            robot_dist_check_counter += 1
+
+        try:
+            self.logger.info("[Obstacle Perturbation]  (%s, %s) starts to calculating obstacle location.", p_type, ratio)
+            obstacle_coord = None
+            # Place the obstacle from where the robot will be when the TA places it
+            plan = self.cur_mov_plan["plan"]
+            speed = self.robot_speed()
+            dt = time.monotonic() - snapshot.time + obstacle_placement_latency
+            predicted_x, predicted_y = predict_location(self.test_map, plan, (cur_loc['x'], cur_loc['y']), speed, dt)
+            if (predicted_x, predicted_y) != (cur_loc['x'], cur_loc['y']):
+                try:
+                    obstacle_coord = self.compute_obstacle_location(predicted_x, predicted_y, ratio, self.cur_mov_plan)
+                    self.logger.info("[Obstacle Perturbation] The robot at %s moving at %.2f m/s is predicted at (%s, %s) in %.2f seconds.", cur_loc, speed, predicted_x, predicted_y, dt)
+                except ValueError as e:
+                    self.logger.debug("[Obstacle Perturbation] Cannot place the obstacle from the predicted location (%s, %s) of the robot. Use its observed location. %s", predicted_x, predicted_y, e)
+            if obstacle_coord is None:
+                obstacle_coord = self.compute_obstacle_location(cur_loc['x'], cur_loc['y'], ratio, self.cur_mov_plan)
+        except Exception as e:
+            self.logger.error("[Obstacle Perturbation] fail to comptue the location of the obstacle to place. %s", e, exc_info=True)
+            return False
+
+        self.logger.info("[Obstacle Perturbation] starts to place the obstacle, %s.", obstacle_coord)
+        return await self.send_perturbation(self.place_obstacle(p_type, ratio, obstacle_coord, self.cur_target_ID))
+
+    async def place_obstacle(self, p_type, ratio, obstacle_coord, target_ID):
+        if await self.place_obstacle_req('obstacle_perturbation', obstacle_coord):
+            self.logger.info("[Obstacle Perturbation] (%s, %s) succeeds. The current plan is %s", p_type, ratio, self.cur_mov_plan)
+            self.journal_event("obstacle_placed", obstacle_coord['x'], obstacle_coord['y'], target_ID, ratio)
+            return True
+        self.logger.error("[Obstacle Perturbation] (%s, %s) fails. The current plan is %s", p_type, ratio, self.cur_mov_plan, exc_info=True)
+        return False
+
+    # [Mission]
+    async def check_robot_status(self):
+        '''
+            Observe the robot from the start of the mission until the mission
+            or the last target is done, and stop perturbations while the robot
+            is charging. See ObservationCadence for how often.
+        '''
+        observation_stopped = lambda: self.mission_done or self.last_target_done
+        cadence = ObservationCadence(self.test_map)
+
+        cadence.record_observation()
+        robot_status = await self.observe_req("check_robot_battery")
+        self.publish_robot_status(robot_status)
+        if robot_status == False:
+            self.logger.error("[Robot Status] failed to observe the robot's status. Wait for mission_done signal to stop the test.", exc_info=True)
+            return
+
+        self.logger.info("[Robot Status] initial status: %s", robot_status)
+        robot_battery = robot_status['battery']
+        self.mission_result['mission_start']['wall_clock']   = wall_clock_ms()
+        self.mission_result['mission_start']['sim_time']     = robot_status['sim-time']
+
+        robot_observation_counter = 0
+        while not observation_stopped():
+            # compute the delay again when a perturbation starts or ends or
+            # when perturbations are allowed or not
+            armed = self.perturbation_armed
+            paused = not self.can_perturb
+            delay = cadence.next_delay(self.robot_status, armed, paused, self.cur_mov_plan["plan"], self.observation_hold_until)
+            if await self.wait_until(lambda: observation_stopped() or (self.perturbation_armed != armed) or (self.can_perturb == paused), timeout=delay):
+                continue
+
+            cadence.record_observation()
+            robot_status = await self.observe_req("check_robot_battery", is_periodical=True)
+            self.publish_robot_status(robot_status)
+            if robot_status == False:
+                self.logger.error("[Robot Status] failed to observe the robot's status. Wait for mission_done signal to stop the test.", exc_info=True)
+                self.mission_result['observation'] = cadence.report()
+                return
+
+            if (robot_observation_counter % 10) == 0:
+                self.logger.info("[Robot Status] %s", robot_status)
+            robot_observation_counter += 1
+
+            cur_battery = robot_status['battery']
+            battery_change = cur_battery - robot_battery
+            robot_battery = cur_battery
+
+            # Perturbations are stopped by adaptations in case c and d
+            # and by charging in all the cases.
+            if not self.is_adapting:
+                if battery_change > 0: # charging now
+                    self.logger.info("[Robot Status] Charging: battery is increased to %s, can not perturb.", cur_battery)
+                    self.update(can_perturb=False)
+                elif not self.can_perturb:
+                    self.update(can_perturb=True)
+
+        self.mission_result['observation'] = cadence.report()
+        self.logger.info("[Robot Status] stopped because mission_done is set. observation rate: %s", self.mission_result['observation'])
+
+    def publish_robot_status(self, robot_status):
+        snapshot = self.robot_status_buffer.publish(robot_status)
+        if robot_status != False:
+            self.journal.append("observation", robot_status['sim-time'], robot_status['x'], robot_status['y'], robot_status['battery'], snapshot.seq)
+        else:
+            self.journal_event("observation_failed", snapshot.seq)
+        self.update()
+
+    def journal_event(self, event, *payload):
+        '''
+            Append an event to the journal at the sim-time of the latest robot status
+        '''
+        status = self.robot_status
+        self.journal.append(event, status['sim-time'] if status != False else 0, *payload)
+
+    async def run_mission(self):
+        await self.wait_until(lambda: self.ta_alive)
+
+        if not await self.start_mission_req('run_mission'):
+            self.logger.error(f"Fail to start the mission. /start request to the TA is not successful.", exc_info=True)
+            return
+
+        self.update(mission_done=False)
+        self.journal_event("mission_start", self.num_targets)
+        observation = asyncio.ensure_future(self.check_robot_status())
+
+        try:
+            for target_ID in range(1, self.num_targets+1):
+                self.cur_target_ID = target_ID
+                self.logger.info(f"[Target {target_ID} ({self.targets[target_ID-1]})] starts ")
+                if self.case_level == 'a':
+                    self.update(cur_target_done=False)
+                else:
+                    self.update(cur_target_done=False, is_adapting=False, can_perturb=True)
+
+                self.mission_result['num_targets_tried'] += 1
+                self.mission_result[f"Target{target_ID}"]['is_tried'] = True
+
+                if self.case_level != 'a':
+                    await self.run_perturbations(target_ID)
+
+                # Wait for the 'at-waypoint' status message of the current target
+                await self.wait_until(lambda: self.cur_target_done)
+                if self.mission_done:
+                    if (target_ID != self.num_targets):
+                        self.logger.info(f"[Mission Done] Mission is done but not all targets are reached.")
+                    break
+                self.logger.info(f"[Target] Reach Target {target_ID}: {self.targets[target_ID-1]}.")
+
+                # Remove the placed obstacle for the current target
+                if self.placed_obstacle_ID != None:
+                    if await self.remove_obstacle_req('run_mission', self.placed_obstacle_ID):
+                        self.placed_obstacle_ID = None
+                        self.journal_event("obstacle_removed", target_ID)
+                    else:
+                        self.logger.error(f"[Obstacle Perturbation] Target {target_ID}, {self.targets[target_ID-1]}: failed to remove the obstacle, {self.placed_obstacle_ID}. Stop the test.", exc_info=True)
+                        break
+        except Exception as e:
+            self.logger.error(f"[Mission Failure] [Case {self.case_level}] {e}", exc_info=True)
+
+        # Wait for TA's '/done' request
+        await self.wait_until(lambda: self.mission_done)
+        await observation
+
+    async def run_perturbations(self, target_ID):
+        perturbation_seq = self.perturbation_seqs[f"Target{target_ID}"]
+        perturbations = self.mission_result[f"Target{target_ID}"]['perturbations']
+        for perturb_ID in range(len(perturbation_seq)):
+            perturb_type = perturbation_seq[perturb_ID]['type']
+            log_prefix = f"[Target {target_ID} ({self.targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})]"
+
+            if perturbation_seq[perturb_ID]['ratio'] == 0:
+                perturbations[perturb_ID]["status"] = "Not Tried - 0 Severity"
+                self.logger.info("%s Not tried - 0 Severity.", log_prefix)
+                continue
+
+            cancel_reason = self.perturbation_cancel_reason()
+            if cancel_reason is not None:
+                not_try_reason = "Mission Done" if cancel_reason == "mission_done" else "Current Target Done"
+                for not_tried_perturb_ID in range(perturb_ID, len(perturbation_seq)):
+                    perturbations[not_tried_perturb_ID]["status"] = f"Not Tried - {not_try_reason}"
+                self.logger.info("[Target %s (%s)] Perturbations from %s on are not tried - %s.", target_ID, self.targets[target_ID-1], 1+perturb_ID, not_try_reason)
+                break
+
+            self.logger.info("%s starts.", log_prefix)
+            result = await self.run_perturbation(perturbation_seq[perturb_ID])
+            record_perturbation_result(self.mission_result, target_ID, perturb_ID, perturb_type, result)
+            self.journal_event("perturbation", target_ID, perturb_ID, perturbation_type_codes.get(perturb_type, -1), int(result))
+            self.checkpoint.update()
+            self.logger.info("%s %s.", log_prefix, 'success' if result else 'failure')
+
+            await self.wait_until(lambda: self.perturbation_cancel_reason() is not None, timeout=time_interval_perturbation)
+
+        self.logger.info("[Target %s (%s)] Perturbations Done", target_ID, self.targets[target_ID-1])
+
+    async def save_results(self):
+        try:
+            self.checkpoint.update()
+            # dump the mission result into the log fold, see stop_session() in th_server.py
+            mission_result_filepath = os.path.join(self.log_dir, f"mission_result_{self.test_ID}.json")
+            with open(mission_result_filepath + ".tmp", "w") as fp:
+                json.dump(self.mission_result, fp, indent=4)
+            os.replace(mission_result_filepath + ".tmp", mission_result_filepath)
+            self.checkpoint.remove()
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+
+        # save TH log to S3 bucket, see stop_session() in th_server.py
+        if self.log_shipper is not None:
+            await asyncio.get_event_loop().run_in_executor(None, self.log_shipper.stop)
+        await asyncio.get_event_loop().run_in_executor(None, flush_logger, self.logger)
+        try:
+            num_failed = await asyncio.get_event_loop().run_in_executor(None, self.log_uploader.upload_dirs, [self.log_dir])
+        except Exception:
+            self.logger.error("Failed to upload the TH logs", exc_info=True)
+            num_failed = 1
+        self.log_uploader.close()
+        if num_failed != 0:
+            self.logger.error(f"Failed to save TH logs to S3 bucket at {self.s3_bucket_url}/{self.test_ID}", exc_info=True)
+        else:
+            self.logger.info(f"Successfully saved TH logs to S3 bucket at {self.s3_bucket_url}/{self.test_ID}")
+
+    async def checkpoint_mission_result(self):
+        while True:
+            await asyncio.sleep(checkpoint_interval)
+            try:
+                self.checkpoint.update()
+            except Exception:
+                self.logger.error("[Checkpoint] fail to checkpoint the mission result", exc_info=True)
+
+    async def run(self, host, port):
+        '''
+            Serve the TA and run the mission until it is done
+        '''
+        self.session = aiohttp.ClientSession(
+                headers={"Accept": "application/json"},
+                connector=aiohttp.TCPConnector(limit_per_host=pool_size))
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        self.logger.info('TH server is starting')
+        checkpointing = asyncio.ensure_future(self.checkpoint_mission_result())
+        # the uploads block, so they are shipped from a thread of their own
+        if self.log_ship_interval > 0:
+            self.log_shipper = LogShipper(self.log_uploader, [self.log_dir], self.logger,
+                    interval=self.log_ship_interval, name=f'log_shipper_{self.test_ID}')
+            self.log_shipper.start()
+
+        try:
+            await self.run_mission()
+            self.logger.info("Mission is done!")
+            self.journal_event("mission_done", self.mission_result['num_targets_reached'])
+            self.journal.close()
+            latencies = {path: latency.summary() for path, latency in self.ta_latencies.items() if latency.requests}
+            self.logger.info(f"[TA Client] latency of the requests to the TA: {json.dumps(latencies)}")
+            await self.save_results()
+        finally:
+            checkpointing.cancel()
+            self.logger.info('server is shutting down')
+            await runner.cleanup()
+            await self.session.close()
+
+
+if __name__=='__main__':
+    # Suppress the debug logs from urlib3 and aiohttp's access log
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    log_level_env = os.environ.get('TH_LOG_LEVEL', '').upper()
+    if log_level_env == 'INFO':
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.DEBUG)
+
+    # Parse Input Parameters
+    if len(sys.argv) != 6:
+        logging.error(f"Failed to parse input paramters to the TH server. The number of input paramters is not 6. Input parameters: {sys.argv}")
+        usage()
+        exit(1)
+
+    ta_url          = sys.argv[1] + ":" + sys.argv[2]
+    test_map_fp     = sys.argv[3]
+    test_spec_fp    = sys.argv[4]
+    log_dir         = sys.argv[5]
+
+    test_map = MapServer(test_map_fp)
+    test_spec = load_test_spec(test_spec_fp)
+
+    # Obtain test_ID and S3 bucket and create logger
+    test_ID = os.environ.get('TEST_ID')
+    if (not test_ID) or (len(test_ID) == 0):
+        raise Exception("Test ID undefined; Stop the test")
+    th_log_filename = os.path.join(log_dir, test_ID + ".log")
+    # Bound of the queue of the log records of a logger, and what to do
+    # when it is full, see create_custom_logger() in th_common.py
+    log_queue_size = int(os.environ.get('TH_LOG_QUEUE_SIZE') or default_log_queue_size)
+    log_overflow = (os.environ.get('TH_LOG_OVERFLOW') or default_log_overflow).lower()
+    logger = create_custom_logger("CP1_TH", th_log_filename, logging.DEBUG, enable_console=True, queue_size=log_queue_size, overflow=log_overflow)
+    logger.info('{:=^60}'.format(test_ID))
+    logger.info(f"Logging to {th_log_filename}")
+    logger.info("[test_spec]: test ID {}\n{}".format(test_ID, json.dumps(test_spec, indent=4)))
+
+    s3_bucket_url = os.environ.get('S3_BUCKET_CP1_PATH')
+    if (not s3_bucket_url) or (len(s3_bucket_url) == 0):
+        err_msg = "S3 bucket URL undefined; cannot sequester logs"
+        logger.error(err_msg, exc_info=True)
+        raise Exception(err_msg)
+
+    # Seconds between two uploads of the logs during the mission, see th_server.py
+    log_ship_interval = float(os.environ.get('TH_LOG_SHIP_INTERVAL') or default_ship_interval)
+
+    loop = asyncio.get_event_loop()
+    harness = AsyncHarness(ta_url, test_map, test_spec, test_ID, log_dir, s3_bucket_url, logger, log_ship_interval)
+    loop.run_until_complete(harness.run(th_host, th_port))
+    loop.close()
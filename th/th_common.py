@@ -0,0 +1,263 @@
+'''
+    Parts of the TH shared by the threaded server (th_server.py) and the
+    asyncio server (th_async.py): loggers, test specs and mission results.
+'''
+import time
+import json
+import queue
+import logging
+import logging.handlers
+import datetime
+import threading
+
+
+# [Setup logger]
+# Number of log records that can wait for the log writer thread
+default_log_queue_size = 10000
+
+# What a logger does with a record when its queue is full:
+#   drop:  drop records below WARNING, wait for room for the others
+#   block: wait for room
+log_overflow_policies = ["drop", "block"]
+default_log_overflow = "drop"
+
+# Number of records the log writer thread formats and writes at once
+log_batch_size = 256
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    '''
+        Puts the records of a logger into a bounded queue for its
+        LogWriter, so that the thread that logs never waits for file I/O.
+
+        Only the message is merged with its args in the logging thread, as
+        they may change afterwards. The time stamp and the traceback are
+        formatted and the record is written by the LogWriter. Calls below
+        the logger's level are dropped by logging before any formatting,
+        so use %-style args instead of f-strings on hot paths.
+    '''
+    def __init__(self, log_queue, overflow):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.overflow = overflow
+        self.num_dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if (self.overflow == "drop") and (record.levelno < logging.WARNING):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.num_dropped += 1
+        else:
+            self.queue.put(record)
+
+
+class LogWriter(threading.Thread):
+    '''
+        Writes the records queued by a LogQueueHandler to handlers, in
+        batches of up to log_batch_size records with a single flush per
+        batch. Reports the records dropped by the LogQueueHandler.
+    '''
+    def __init__(self, log_queue, queue_handler, handlers, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.queue = log_queue
+        self.queue_handler = queue_handler
+        self.handlers = handlers
+        self.num_reported_dropped = 0
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < log_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [item for item in batch if isinstance(item, logging.LogRecord)]
+            num_dropped = self.queue_handler.num_dropped
+            if num_dropped > self.num_reported_dropped:
+                records.append(logging.makeLogRecord({
+                        "name": self.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                        "msg": f"[Logger] {num_dropped - self.num_reported_dropped} log records are dropped because the log queue is full"}))
+                self.num_reported_dropped = num_dropped
+            self.write(records)
+
+            # flush() markers, set once the records queued before them are written
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def write(self, records):
+        for handler in self.handlers:
+            records_to_handle = [record for record in records if record.levelno >= handler.level]
+            if not records_to_handle:
+                continue
+            if isinstance(handler, logging.StreamHandler):
+                lines = [handler.format(record) + handler.terminator for record in records_to_handle]
+                with handler.lock:
+                    handler.stream.write("".join(lines))
+                    handler.flush()
+            else:
+                for record in records_to_handle:
+                    handler.handle(record)
+
+    def flush(self, timeout=None):
+        '''
+            Wait until the records queued so far are written.
+            Returns False if they are not written after timeout seconds.
+        '''
+        written = threading.Event()
+        self.queue.put(written)
+        return written.wait(timeout)
+
+
+def create_custom_logger(logger_name, log_filepath, log_level, enable_console=False, queue_size=default_log_queue_size, overflow=default_log_overflow):
+    '''
+        A logger writing to log_filepath, and the console if enable_console,
+        from a LogWriter thread, see LogQueueHandler for queue_size and
+        overflow. Call flush_logger() before reading the log file.
+    '''
+    if overflow not in log_overflow_policies:
+        raise ValueError(f"Unknown log overflow policy {overflow}; it must be one of {log_overflow_policies}")
+
+    ## Create a custom logger
+    logger = logging.getLogger(logger_name)
+    # The console output of the logger is written by its LogWriter, so keep
+    # the records from the handlers of the root logger, which write them
+    # from the logging thread
+    logger.propagate = False
+
+    ## Create handlers
+    handlers = []
+    f_handler = logging.FileHandler(log_filepath)
+    f_handler.setLevel(log_level)
+    ## Create formatters and add it to handlers
+    f_format = logging.Formatter('%(name)s\t| [%(levelname)s] [%(asctime)s] %(message)s ')
+    f_handler.setFormatter(f_format)
+    handlers.append(f_handler)
+
+    if enable_console:
+        ## Create handlers
+        c_handler = logging.StreamHandler()
+        c_handler.setLevel(log_level)
+        ## Create formatters and add it to handlers
+        c_format = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s ')
+        c_handler.setFormatter(c_format)
+        handlers.append(c_handler)
+
+    ## Write the records from a thread of the logger
+    log_queue = queue.Queue(maxsize=queue_size)
+    q_handler = LogQueueHandler(log_queue, overflow)
+    logger.log_writer = LogWriter(log_queue, q_handler, handlers, logger_name)
+    logger.log_writer.start()
+    ## Add handlers to the logger
+    logger.addHandler(q_handler)
+
+    return logger
+
+
+def flush_logger(logger, timeout=None):
+    '''
+        Wait until the records logged so far by a logger created by
+        create_custom_logger() are written. Returns False on timeout.
+    '''
+    return logger.log_writer.flush(timeout)
+
+
+def wall_clock_ms():
+    ''' the wall clock time in milliseconds, at a resolution of seconds, as stored in mission results '''
+    time_stamp=time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime())
+    dt = datetime.datetime.strptime(time_stamp, "%Y-%m-%d_%H-%M-%S")
+    return int(time.mktime(dt.timetuple()) * 1000) # millium seconds
+
+
+def load_test_spec(test_spec_fp):
+    try:
+        with open(test_spec_fp) as fp:
+            test_spec = json.load(fp)
+        for key in ['level', 'start-loc', 'target-locs', 'power-model']:
+            if key not in test_spec['test_configuration']:
+                raise KeyError(key)
+        if (test_spec['test_configuration']['level'] != 'a') and ("perturbSeqs" not in test_spec["perturbation"]):
+            raise KeyError("perturbSeqs")
+    except Exception as e:
+        err_msg = f"Failed to load test spec at {test_spec_fp}. Error is:\n{e}"
+        raise Exception(err_msg)
+    return test_spec
+
+
+def new_mission_result(test_spec):
+    '''
+        The mission result of a test before the mission starts
+    '''
+    case_level = test_spec['test_configuration']['level']
+    num_targets = len(test_spec["test_configuration"]["target-locs"])
+
+    mission_result = {}
+    mission_result['test_configuration'] = test_spec['test_configuration']
+    mission_result['mission_start'] = {'wall_clock': 0, 'sim_time': 0}
+    mission_result['mission_done'] = {'wall_clock': 0, 'sim_time': 0}
+    mission_result['num_targets_tried'] = 0
+    mission_result['num_targets_reached'] = 0
+    mission_result['observation'] = {'num_observations': 0, 'num_fast_observations': 0, 'num_backoff_observations': 0, 'duration': 0, 'effective_rate': 0}
+    if case_level != 'a':
+        mission_result['perturbation_stat'] = {}
+        mission_result['perturbation_stat']['num_perturbations_tried'] = 0
+        mission_result['perturbation_stat']['num_successful_perturbations'] = 0
+        mission_result['perturbation_stat']['num_successful_easy_perturbations'] = 0
+        mission_result['perturbation_stat']['num_successful_medium_perturbations'] = 0
+        mission_result['perturbation_stat']['num_successful_hard_perturbations'] = 0
+
+    for i in range(1, 1+num_targets):
+        mission_result[f"Target{i}"] = {
+                'is_tried': False,
+                'is_reached': False,
+                'robot_loc': {'x':0, 'y':0},
+                'plan': [], # the final plan of the robot for this target
+                }
+        if case_level != 'a':
+            mission_result[f"Target{i}"]['num_perturbations_tried'] = 0
+            mission_result[f"Target{i}"]['num_successful_perturbations'] = 0
+            mission_result[f"Target{i}"]['perturbations'] = []
+            for p in test_spec["perturbation"]["perturbSeqs"][f"Target{i}"]:
+                p["status"] = ""
+                mission_result[f"Target{i}"]["perturbations"].append(p)
+
+    return mission_result
+
+
+def record_perturbation_result(mission_result, target_ID, perturb_ID, perturb_type, result):
+    '''
+        Count a tried perturbation, the perturb_ID-th of Target<target_ID>, in the mission result
+    '''
+    mission_result['perturbation_stat']['num_perturbations_tried'] += 1
+    mission_result[f"Target{target_ID}"]['num_perturbations_tried'] += 1
+
+    if result:
+        mission_result['perturbation_stat']['num_successful_perturbations'] += 1
+        mission_result[f"Target{target_ID}"]['num_successful_perturbations'] += 1
+        mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = "Success"
+        if "easy" in perturb_type:
+            mission_result['perturbation_stat']['num_successful_easy_perturbations'] += 1
+        elif "medium" in perturb_type:
+            mission_result['perturbation_stat']['num_successful_medium_perturbations'] += 1
+        else: # hard perturbation
+            mission_result['perturbation_stat']['num_successful_hard_perturbations'] += 1
+    else:
+        mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = "Failure"
+
+
+def record_target_reached(mission_result, target_ID, x, y, plan):
+    mission_result[f"Target{target_ID}"]['is_reached'] = True
+    mission_result['num_targets_reached'] += 1
+
+    mission_result[f"Target{target_ID}"]['robot_loc']['x'] = x
+    mission_result[f"Target{target_ID}"]['robot_loc']['y'] = y
+
+    mission_result[f"Target{target_ID}"]['plan'] = plan
@@ -5,64 +5,60 @@ import time
 import random
 import logging
 import threading
-import subprocess
+import queue
+import collections
 import datetime
 
 import numpy as np
 from numpy.linalg import norm # L2 norm
 
-# HTTP server related Packages 
-import requests
-from flask import Flask, request, jsonify, make_response, redirect, url_for
+# HTTP server related Packages
+from flask import Flask, request, jsonify, make_response, redirect, url_for, abort
 import json
 from werkzeug.serving import make_server
-import traceback
-from werkzeug.wsgi import ClosingIterator
 
 # Local Packages
 from test_spec import TestSpec, perturbation_types
 from mapserver import MapServer
+from th_common import create_custom_logger, flush_logger, default_log_queue_size, default_log_overflow, wall_clock_ms, load_test_spec, new_mission_result, record_perturbation_result, record_target_reached
+from obstacle_placement import compute_obstacle_locations, infeasibility_reasons, placement_feasible, obstacle_target_safe_distance_threshold, waypoint_exclusion_radius
+from observation_cadence import ObservationCadence
+from robot_status_buffer import RobotStatusBuffer
+from ta_client import TAClient
+from pooled_server import PooledWSGIServer, default_workers
+from mission_journal import MissionJournal, ta_statuses, perturbation_type_codes
+from mission_checkpoint import MissionCheckpoint
+from log_uploader import LogUploader, LogShipper, default_ship_interval
+from velocity_model import speed_along_plan, time_to_exit_waypoint_zone, time_to_placement, predict_location, velocity_window, obstacle_placement_latency, max_exit_wait
+
+class StateEvent(threading.Event):
+    '''
+        A threading.Event that also notifies the threads waiting on the
+        given condition whenever it is set or cleared, so that a thread can
+        wait for a combination of events with condition.wait_for().
+    '''
+    def __init__(self, condition):
+        threading.Event.__init__(self)
+        self.condition = condition
 
-class AfterResponse:
-    def __init__(self, app=None):
-        self.callbacks = []
-        if app:
-            self.init_app(app)
-
-    def __call__(self, callback):
-        self.callbacks.append(callback)
-        return callback
-
-    def init_app(self, app):
-        # install extension
-        app.after_response = self
-
-        # install middleware
-        app.wsgi_app = AfterResponseMiddleware(app.wsgi_app, self)
-
-    def flush(self):
-        for fn in self.callbacks:
-            try:
-                fn()
-            except Exception:
-                traceback.print_exc()
-
-class AfterResponseMiddleware:
-    def __init__(self, application, after_response_ext):
-        self.application = application
-        self.after_response_ext = after_response_ext
+    def set(self):
+        with self.condition:
+            threading.Event.set(self)
+            self.condition.notify_all()
 
-    def __call__(self, environ, after_response):
-        iterator = self.application(environ, after_response)
-        try:
-            return ClosingIterator(iterator, [self.after_response_ext.flush])
-        except Exception:
-            traceback.print_exc()
-            return iterator
+    def clear(self):
+        with self.condition:
+            threading.Event.clear(self)
+            self.condition.notify_all()
 
 def usage():
     print("=================How To Run th_server.py================================")
     print("python3.6 th_server.py ta_url ta_port mission_map_file test_spec log_dir")
+    print("python3.6 th_server.py mission_map_file session_file log_dir")
+    print("")
+    print("The second form runs one session per test listed in session_file,")
+    print("a json list of {\"test_ID\": ..., \"ta_url\": ..., \"test_spec\": ...}.")
+    print("The TA of a test reaches its session at <TH url>/<test_ID>.")
     print("========================================================================")
 
 
@@ -70,423 +66,40 @@ def usage():
 th_host = "0.0.0.0"
 th_port = 8081
 
-# Setup Flask APP and Logger
-
-# Suppress the debug logs from urlib3
-logging.getLogger("urllib3").setLevel(logging.INFO)
-# Set up log level for TH
-log_level_env = os.environ.get('TH_LOG_LEVEL').upper()
-if log_level_env and (log_level_env == 'INFO'):
-    logging.basicConfig(level=logging.INFO)
-else:
-    logging.basicConfig(level=logging.DEBUG)
-
-
-app = Flask(__name__)
-AfterResponse(app)
-#   live            : TH send a request to start the mission
-#   at-waypoint     : It impacts TH's perturbation requests since the robot reaches a target.
-#   error           : TH should go to stop itself
-#   done            : TH should go to stop itself
-#   others          : no special handling is needed
-ta_req_type = "other"
-@app.after_response
-def event_trigger_for_special_ta_requests():
-    global ta_alive
-    global cur_target_done
-    global mission_done
-    global ta_req_type
-    logging.info(f"[After Response] ta_req_type is {ta_req_type}")
-
-    # if works, add 'live' case
-    if ta_req_type == "live":
-        ta_alive.set()
-    elif ta_req_type == "at-waypoint":
-        cur_target_done.set()
-    elif ta_req_type == "adapt-started":
-        is_adapting.set()
-        can_perturb.clear()
-    elif ta_req_type == "adapt-done":
-        is_adapting.clear()
-        can_perturb.set()
-    elif (ta_req_type == "error") or (ta_req_type == "done"):
-        mission_done.set()
-        last_target_done.set() # signal to stop battery observation
-        cur_target_done.set() # notify the running perturbation to stop
-        can_perturb.clear()
-
-    ta_req_type = "other"
-
-
-# [Setup logger]
-def create_custom_logger(logger_name, log_filepath, log_level, enable_console=False):
-    ## Create a custom logger
-    logger = logging.getLogger(logger_name)
-
-    ## Create handlers
-    f_handler = logging.FileHandler(log_filepath)
-    f_handler.setLevel(log_level)
-    ## Create formatters and add it to handlers
-    f_format = logging.Formatter('%(name)s\t| [%(levelname)s] [%(asctime)s] %(message)s ')
-    f_handler.setFormatter(f_format)
-    ## Add handlers to the logger
-    logger.addHandler(f_handler)
-
-    if enable_console:
-        ## Create handlers
-        c_handler = logging.StreamHandler()
-        c_handler.setLevel(log_level)
-        ## Create formatters and add it to handlers
-        c_format = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s ')
-        c_handler.setFormatter(c_format)
-        ## Add handlers to the logger
-        logger.addHandler(c_handler)
-
-    return logger
-
-# Parse Input Parameters
-if len(sys.argv) != 6:
-    logging.error(f"Failed to parse input paramters to the TH server. The number of input paramters is not 6. Input parameters: {sys.argv}")
-    usage()
-    exit(1)
-
-ta_url          = sys.argv[1]
-ta_port         = sys.argv[2]
-ta_url          = ta_url+":"+ta_port
-
-test_map_fp     = sys.argv[3]
-test_spec_fp    = sys.argv[4]
-log_dir         = sys.argv[5]
-
-if not log_dir.endswith("/"):
-    log_dir = log_dir + "/"
-
-# Parse Test Spec
-test_map = MapServer(test_map_fp)
-test_spec = None
-try:
-    with open(test_spec_fp) as fp:
-        test_spec = json.load(fp)
-    case_level = test_spec['test_configuration']['level']
-    start_loc = test_spec['test_configuration']['start-loc']
-    targets = test_spec["test_configuration"]["target-locs"]
-    num_targets = len(targets)
-    power_model = test_spec['test_configuration']['power-model']
-    perturbation_seqs = None # used by Case B, C and D
-    if case_level != 'a':
-         perturbation_seqs = test_spec["perturbation"]["perturbSeqs"]
-
-except Exception as e:
-    err_msg = f"Failed to load test spec at {test_spec_fp}. Error is:\n{e}"
-    raise Exception(err_msg)
-
-# Store the mission result
-mission_result = {}
-mission_result['test_configuration'] = test_spec['test_configuration']
-mission_result['mission_start'] = {'wall_clock': 0, 'sim_time': 0}
-mission_result['mission_done'] = {'wall_clock': 0, 'sim_time': 0}
-mission_result['num_targets_tried'] = 0
-mission_result['num_targets_reached'] = 0
-if case_level != 'a':
-    mission_result['perturbation_stat'] = {}
-    mission_result['perturbation_stat']['num_perturbations_tried'] = 0
-    mission_result['perturbation_stat']['num_successful_perturbations'] = 0
-    mission_result['perturbation_stat']['num_successful_easy_perturbations'] = 0
-    mission_result['perturbation_stat']['num_successful_medium_perturbations'] = 0
-    mission_result['perturbation_stat']['num_successful_hard_perturbations'] = 0
-
-for i in range(1, 1+num_targets):
-    mission_result[f"Target{i}"] = {
-            'is_tried': False,
-            'is_reached': False,
-            'robot_loc': {'x':0, 'y':0},
-            'plan': [], # the final plan of the robot for this target
-            }
-    if case_level != 'a':
-        mission_result[f"Target{i}"]['num_perturbations_tried'] = 0
-        mission_result[f"Target{i}"]['num_successful_perturbations'] = 0
-        mission_result[f"Target{i}"]['perturbations'] = []
-        for p in test_spec["perturbation"]["perturbSeqs"][f"Target{i}"]:
-            p["status"] = ""
-            mission_result[f"Target{i}"]["perturbations"].append(p)
-
-# Obtain test_ID and S3 bucket and create logger
-test_ID = os.environ.get('TEST_ID')
-if (not test_ID) or (len(test_ID) == 0):
-    err_msg = "Test ID undefined; Stop the test"
-    raise Exception(err_msg)
-th_log_filename = log_dir + test_ID + ".log"
-logger_th_server = create_custom_logger("CP1_TH", th_log_filename, logging.DEBUG)
-logger_th_server.info('{:=^60}'.format(test_ID))
-logger_th_server.info(f"Logging to {th_log_filename}")
-logger_th_server.info("[test_spec]: test ID {}\n{}".format(
-    test_ID,
-    json.dumps(test_spec, indent=4)))
-logger_th_server.info(f"[Log Level] {log_level_env}")
-
-s3_bucket_url = os.environ.get('S3_BUCKET_CP1_PATH')
-if (not s3_bucket_url) or (len(s3_bucket_url) == 0):
-    err_msg = "S3 bucket URL undefined; cannot sequester logs"
-    logger_th_server.error(err_msg, exc_info=True)
-    raise Exception(err_msg)
-else:
-    logger_th_server.info(f"S3 bucket URL is {s3_bucket_url}")
-
-
-# In the current test design, at most one obstacle will be exist in the map at a time.
-# It is used to remove the placed obstacle when a target is reached.
-placedObstacleID = None
-
-# cur_target_ID is used as one condition to stop the monitoring of robot battery in time.
-# Otherwise, battery checking keeps sending /observe request to the TA,
-# while the TA is shutting down. This makes the TH consider some error is
-# happening in the TA and thus go to shut down the TH before the TA sends
-# the /done message. cur_target_ID is updated in run_mission()
-cur_target_ID = 0
-
 # Threshold of Battery level that can be set in perturbation
 battery_set_unit = 3255 # 1% of battery_capacity
-battery_capacity = 32559 
+battery_capacity = 32559
 battery_set_threshold_ratio = 0.1
 battery_set_threshold = int(battery_capacity * battery_set_threshold_ratio)
 
-# The plan towards the current target.
-# TA will send it in /live, /at-waypoint and all status messages when TA is alive.
-# For case b: the plan carried in /live and /at-waypoint messages will be used
-# For case c and d: the plan carried in /live, /at-waypoint and /status (adapt-done) messages will be used
-cur_mov_plan = {'plan':[], 'sentByTAStatus': ""}
-
-# Events
-ta_alive = threading.Event() # trigger the mission start request /start from the TH to the TA
-# When perturbation is allowed:
-# case 'a': no perturbation
-# case 'b': allowed as long as TA is alive and the robot is not charging
-# case 'c': allowed when TA is alive and not in adaptation phase
-# case 'd': the same as case 'c'
-can_perturb = threading.Event() # guard TH's perturbation requests away from the adaptations in TA
-stop_th = threading.Event() # trigger the thread to shutting the TH
-mission_done = threading.Event() # trigger the event stop_th
-cur_target_done = threading.Event() # guard each task's perturbations
-is_adapting = threading.Event()
-last_target_done = threading.Event()
-robot_status_ready = threading.Event()
-robot_status_use = threading.Event()
-
-# Before the mission starts, robot does not aim for any target. So, set cur_target_done and mission_done.
-cur_target_done.set()
-mission_done.set()
-is_adapting.clear()
-last_target_done.clear()
-robot_status_ready.clear()
-robot_status_use.clear()
-
-# Used to store the robot status returned from /observe request 
-robot_status = {'sim-time': 0, 'plan': [], 'y': 0, 'x': 0, 'status': '', 'charge': 0}
-
-# Send /observe to the TA every <time_interval_observation> seconds
-time_interval_observation = 1
-
-# Used to throttle the messages that indicate the robot is too close
-# to a waypoint during the computation of an obstacle's location
-#can_perturb_check_counter       = 0
-#robot_dist_check_counter        = 0
-#robot_observation_counter       = 0
-#robot_status_use_check_counter  = 0
-#not_charging_check_counter      = 0
-
-
-# [Routes - Process Requests Sent From TA]
-@app.route('/index', methods=['GET'])
-def TH_alive():
-    return make_response("TH server is running!\n", 200)
-
-@app.route('/ready', methods=['POST'])
-def TA_is_ready():
-    '''
-        Listen to the '/ready' requst from TA and then send mission to TA
-    '''
-    global logger_th_server
-
-    logger_th_server.info("received /ready from TA.") # should display 'bar'
-    try:
-        data = test_spec["test_configuration"] 
-        return make_response(jsonify(data), 200)
-    except Exception as e:
-        exception_msg = "TH encountered an error producing configuration data: "+str(e)
-        logger_th_server.error(exception_msg, exc_info=True)
-        ta_req_type == "error"
-        return make_response(exception_msg, 400)
+# Seconds between two checkpoints of the mission result, which is also
+# checkpointed whenever a perturbation is done or a target is reached
+checkpoint_interval = 5
 
+# Seconds between two perturbations of a target
+time_interval_pertubation = 2
 
 # [CP1 Status sent by TA]
 # one of the possible status codes * learning-started - the learning phase has started * learning-done - the learning phase has been * adapt-started - the SUT has started adapting and cannot be perturbed * adapt-done - the SUT has finished adapting * charging-started - the turtlebot is currently charging * charging-done - the turtlebot has stopped charging * parsing-error - one or more of the function descriptions failed to parse * learning-error - an error was encountered in learning one or more of the hidden functions * other-error - an error was encountered that is not covered by the other error codees
 allowed_values = ["learning-started", "learning-done", "adapt-started", "adapt-done", "charging-started", "charging-done", "parsing-error", "learning-error", "other-error", "RAINBOW_READY"    , "MISSION_SUCCEEDED", "MISSION_FAILED", "ADAPTING", "ADAPTED", "ADAPTED_FAILED"]
 
-@app.route('/status', methods=['POST'])
-def ta_status():
-    '''
-        Acknowledge TA status
-    '''
-    global logger_th_server
-    global ta_alive
-    global cur_target_done
-    global ta_req_type
-
-    global cur_mov_plan
-    global num_targets
-    global last_target_done
-    global mission_result
-    global targets
-    global case_level
-
-    try:
-        status_content = request.json
-        status = status_content['status']
- 
-        if status in ["live", "at-waypoint", "adapt-done"]:
-            # "live"        : the TA is alive
-            # "at-waypoint" : reach to the current target location
-            # "adapt-done"  : adaptation is done. (case c and d)
-            ta_req_type = status
-
-            # when the current task is done.
-            if (status == "at-waypoint"):
-                # Log into mission result if the current target is actually reached.
-                logger_th_server.debug(f"[at-waypoint] cur_target_ID: {cur_target_ID}. num_targets: {num_targets}.")
-
-                x = status_content['x']
-                y = status_content['y']
-                robot_loc = np.array([x, y])
-
-                cur_target_waypoint_name = cur_mov_plan["plan"][-1] #targets[cur_target_ID-1]
-                target_loc_dict = test_map.waypoint_to_coords(cur_target_waypoint_name)
-                target_loc = np.array([target_loc_dict["x"], target_loc_dict["y"]])
-
-                distance_robot_to_target = norm(robot_loc-target_loc)
-                logger_th_server.info(f"[at-waypoint] distance between robot ({robot_loc}) and the current target {cur_target_waypoint_name} ({target_loc}) : {distance_robot_to_target}.")
-                if distance_robot_to_target < obstacle_target_safe_distance_threshold:
-                    mission_result[f"Target{cur_target_ID}"]['is_reached'] = True
-                    mission_result['num_targets_reached'] += 1
-
-                    mission_result[f"Target{cur_target_ID}"]['robot_loc']['x'] = x
-                    mission_result[f"Target{cur_target_ID}"]['robot_loc']['y'] = y
-
-                    mission_result[f"Target{cur_target_ID}"]['plan'] = cur_mov_plan["plan"]
-
-                if (cur_target_ID == num_targets):
-                    last_target_done.set()
-                    logger_th_server.debug(f"[at-waypoint] last_target_done is set. Battery monitoring should be stopped.")
-
-            # A new plan is set by the TA.
-            logger_th_server.debug(f"[{status}] [old plan - {cur_mov_plan}")
-            cur_mov_plan["plan"] = status_content['plan']
-            cur_mov_plan["sentByTAStatus"] = status
-            logger_th_server.debug(f"[{status}] [new plan - {cur_mov_plan}")
-
-        elif status == "adapt-started":
-            ta_req_type = status
-        else:
-            ta_req_type = "other"
-
-        logger_th_server.info(f"[TA Status Message] {status_content}")
-
-        ack_msg = f"[CP1_TH ACK - TA Status Message] {status}."
-        return make_response(ack_msg, 200)
-    except Exception as e:
-        exception_msg = "[TA Status] TH encountered an error with the TA status message.\nTA status message: {}.\nTH error: {}".format(request.json, str(e))
-        logger_th_server.error(exception_msg, exc_info=True)
-        ta_req_type == "error"
-        return make_response(exception_msg, 400)
-
-@app.route('/error', methods=['POST'])
-def ta_non_recoverable_error():
-    global logger_th_server
-    global ta_req_type
-    global robot_status
-
-    # save the time info when mission is done.
-    time_stamp=time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime())
-    dt = datetime.datetime.strptime(time_stamp, "%Y-%m-%d_%H-%M-%S")
-    time_stamp_ms = int(time.mktime(dt.timetuple()) * 1000) # millium seconds
-
-    mission_result['mission_done']['wall_clock']   = time_stamp_ms
-    mission_result['mission_done']['sim_time']     = robot_status['sim-time']
-
-    error_content = request.json
-    error_type = error_content['error']
-    error_msg = error_content['message']
-    logger_th_server.error(f"Error_Type: {error_type}, error_msg: {error_msg}", exc_info=True)
-    ack_msg = f"TH has stop the test due to the reported non-recoverable error {error_type}: {error_msg}"
-
-    ta_req_type = "error"
-
-    return make_response(ack_msg, 200)
 
-
-@app.route('/done', methods=['POST'])
-def test_done():
-    '''
-        Process '/done' request from TA, which indicates the test is done. 
-    '''
-    global logger_th_server
-    global ta_req_type
-    global num_targets
-
-    response = None
-    try:
-        content = request.json
-        mission_outcome = content['outcome']
-        tasks_finished = content['tasks-finished']
-        num_tasks_finished = len(tasks_finished)
-
-        # save the time info when mission is done.
-        time_stamp=time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime())
-        dt = datetime.datetime.strptime(time_stamp, "%Y-%m-%d_%H-%M-%S")
-        time_stamp_ms = int(time.mktime(dt.timetuple()) * 1000) # millium seconds
-
-        mission_result['mission_done']['wall_clock']   = time_stamp_ms
-        mission_result['mission_done']['sim_time']     = content['sim-time']
-
-        mission_msg = ""
-        if mission_outcome == "at-goal":
-            if num_tasks_finished == num_targets:
-                mission_msg = f"[Test Done: Mission Completed] {num_tasks_finished} tasks finished:\n"
-            else:
-                mission_msg = f"[Test Done: Mission Incompleted] {num_tasks_finished} tasks finished:\n"
-        elif mission_outcome == "out-of-battery":
-            mission_msg = f"[Test Done: Abrupt - Low Energy] {num_tasks_finished} tasks finished:\n"
-        else: # unknown mission outcome message
-            raise ValueError(f"Unknown Mission Outcome Message: {mission_outcome}.\nFull request content: {content}")
-
-        for task_status in tasks_finished:
-            mission_msg += f"\tReached the target location {task_status['name']} ({task_status['x']}, {task_status['y']}) at the sim-time, {task_status['sim-time']}\n"
-
-        mission_msg += f"Final robot's status: charge = {content['charge']} mAh,  ({content['x']}, {content['y']}) at the sim-time, {content['sim-time']}\n"
-
-        logger_th_server.info(mission_msg)
-
-        ack_msg = f"[CP1_TH] ACK - Test Done."
-        response = make_response(ack_msg, 200)
-    except Exception as e:
-        exception_msg = "TH encountered an error at the completion of the mission: "+str(e)
-        logger_th_server.error(exception_msg, exc_info=True)
-        ta_req_type == "error"
-        response = make_response(exception_msg, 400)
-
-    ta_req_type = "done"
-
-    return response
+# A transition of the TH's state requested by the TA, queued by the handler
+# of the TA request and applied by HarnessSession.dispatch_ta_transitions()
+#   kind:    "live", "at-waypoint", "adapt-started", "adapt-done", "error" or "done"
+#   content: the content of the TA request
+TATransition = collections.namedtuple('TATransition', ['kind', 'content'])
 
 
 # [Requests Sent To TA]
-def observe_req(src, endpoint, logger, is_periodical=False):
+def observe_req(src, ta_client, logger, is_periodical=False):
 
     req_name = "/observe"
     if not is_periodical:
-        logger.info(f"#{src}# Sending {req_name} request to TA: {endpoint}")
+        logger.info("#%s# Sending %s request to TA: %s", src, req_name, ta_client.url(req_name))
     try:
-        response = requests.get(
-                url = endpoint,
+        response = ta_client.get(
+                req_name,
                 headers = {"Accept": "application/json"})
     except Exception:
         logger.error("#{src}# Fatal error when sending {req_name} request", exc_info=True)
@@ -498,32 +111,25 @@ def observe_req(src, endpoint, logger, is_periodical=False):
         # If the /observe request is issued in an adhoc situation,
         # dump the status directly
         if not is_periodical:
-            logger.info("[Robot Status] "+str(robot_status))
+            logger.info("[Robot Status] %s", robot_status)
         return robot_status
     else:
         if status_code == 400:
             logger.error(response.json(), exc_info=True)
-        else: 
-            logger.error(f"#{src}# Unknown response code of {req_name} request: {status_code}", exc_info=True)
+        else:
+            logger.error("#%s# Unknown response code of %s request: %s", src, req_name, status_code, exc_info=True)
         return False
 
-def place_obstacle_req(src, endpoint, logger, obstacle_cood):
+def place_obstacle_req(src, ta_client, logger, obstacle_cood):
     '''
         obstacle_cood: a dict, {'x': x_cood, 'y': y_cood}
+        Returns the ID of the placed obstacle or False if the request fails.
     '''
-    global placedObstacleID
-    global cur_target_done
-    global can_perturb
-
-    if placedObstacleID != None:
-        logger.error(f"#{src}# The TH tries to place an obstacle while the obstacle, {placedObstacleID}, already exists on the map. Note: at most one obstacle should be on the map to avoid trapping the robto and also remove invalid (ineffective) obstacles.", exc_info=True)
-        return False
-
     req_name = "/perturb/place-obstacle"
-    logger.info(f"#{src}# Sending {req_name} to TA: {endpoint}")
+    logger.info("#%s# Sending %s to TA: %s", src, req_name, ta_client.url(req_name))
     try:
-        response = requests.post(
-                url = endpoint,
+        response = ta_client.post(
+                req_name,
                 headers = {
                     "Accept": "application/json",
                     'Content-Type': 'application/json'},
@@ -535,24 +141,24 @@ def place_obstacle_req(src, endpoint, logger, obstacle_cood):
     status_code = response.status_code
     if status_code == 200:
         data = response.json()
-        placedObstacleID = data["obstacleid"]
+        obstacle_ID = data["obstacleid"]
         sim_time = data['sim-time']
-        logger.info(f"[Perturb - Place Obstacle] {placedObstacleID} is placed at the location {obstacle_cood} at sim-time {sim_time}")
-        return True
+        logger.info("[Perturb - Place Obstacle] %s is placed at the location %s at sim-time %s", obstacle_ID, obstacle_cood, sim_time)
+        return obstacle_ID
     else:
         if status_code == 400:
             logger.error(response.json(), exc_info=True)
-        else: 
-            logger.error(f"#{src}# Unknown response code of {req_name} request: {status_code}", exc_info=True)
+        else:
+            logger.error("#%s# Unknown response code of %s request: %s", src, req_name, status_code, exc_info=True)
         return False
 
-def remove_obstacle_req(src, endpoint, logger, obstacle_id):
+def remove_obstacle_req(src, ta_client, logger, obstacle_id):
 
-    req_name= "/perturb/remove-obstacle "
-    logger.info(f"#{src}#Sending {req_name} request to TA: {endpoint}")
+    req_name = "/perturb/remove-obstacle"
+    logger.info("#%s#Sending %s request to TA: %s", src, req_name, ta_client.url(req_name))
     try:
-        response = requests.post(
-                url = endpoint,
+        response = ta_client.post(
+                req_name,
                 headers = {
                     "Accept": "application/json",
                     'Content-Type': 'application/json'},
@@ -565,22 +171,22 @@ def remove_obstacle_req(src, endpoint, logger, obstacle_id):
     if status_code == 200:
         data = response.json()
         sim_time = data['sim-time']
-        logger.info(f"[Perturb - Remove Obstacle] {obstacle_id} is removed at sim-time {sim_time}")
+        logger.info("[Perturb - Remove Obstacle] %s is removed at sim-time %s", obstacle_id, sim_time)
         return True
     else:
         if status_code == 400:
             logger.error(response.json(), exc_info=True)
-        else: 
-            logger.error(f"#{src}# Unknown response code of {req_name} request: {status_code}", exc_info=True)
+        else:
+            logger.error("#%s# Unknown response code of %s request: %s", src, req_name, status_code, exc_info=True)
         return False
 
-def set_battery_req(src, endpoint, logger, charge):
+def set_battery_req(src, ta_client, logger, charge):
 
     req_name = "/perturb/battery"
-    logger.info(f"#{src}# Sending {req_name} request to TA: {endpoint}")
+    logger.info("#%s# Sending %s request to TA: %s", src, req_name, ta_client.url(req_name))
     try:
-        response = requests.post(
-                url = endpoint,
+        response = ta_client.post(
+                req_name,
                 headers = {
                     "Accept": "application/json",
                     'Content-Type': 'application/json'},
@@ -593,25 +199,24 @@ def set_battery_req(src, endpoint, logger, charge):
     if status_code == 200:
         data = response.json()
         sim_time = data['sim-time']
-        logger.info(f"[Perturb - Set Battery] Battery charge is set to {charge} at sim-time {sim_time}")
+        logger.info("[Perturb - Set Battery] Battery charge is set to %s at sim-time %s", charge, sim_time)
         return True
     else:
         if status_code == 400:
             logger.error(response.json(), exc_info=True)
-        else: 
-            logger.error(f"#{src}# Unknown response code of {req_name} request: {status_code}", exc_info=True)
+        else:
+            logger.error("#%s# Unknown response code of %s request: %s", src, req_name, status_code, exc_info=True)
         return False
 
 
-def start_mission_req(src, endpoint, logger):
-    global can_perturb
+def start_mission_req(src, ta_client, logger):
 
     req_name = "/start"
-    logger.info(f"#{src}# Sending {req_name} request to TA: {endpoint}")
+    logger.info(f"#{src}# Sending {req_name} request to TA: {ta_client.url(req_name)}")
     try:
         time.sleep(3)
-        response = requests.post(
-                url = endpoint,
+        response = ta_client.post(
+                req_name,
                 headers = {"Accept": "application/json"})
     except Exception:
         logger.error(f"#{src}# Fatal error when sending {req_name} request", exc_info=True)
@@ -620,829 +225,859 @@ def start_mission_req(src, endpoint, logger):
     status_code = response.status_code
     if status_code == 200 or status_code == 204: # 204 - response body has no content
         logger.info(f"Mission is started in TA")
-        can_perturb.set()
         return True
     else:
         if status_code == 400:
             logger.error(response.json(), exc_info=True)
-        else: 
+        else:
             logger.error(f"#{src}# Unknown response code of {req_name} request: {status_code}", exc_info=True)
         return False
 
-ta_endpoints = {
-        "start_mission": ta_url+"/start",
-        "robot_status": ta_url+"/observe",
-        "place_obstacle": ta_url+"/perturb/place-obstacle",
-        "remove_obstacle": ta_url+"/perturb/remove-obstacle",
-        "set_battery": ta_url+"/perturb/battery"}
 
-
-# [Utility Functions]
-def do_perturbation(perturbation, logger):
+class HarnessSession:
     '''
-        Assumption: when calling do_perturbation, can_perturb is set.
+        The harness of one test: its test spec, the mission result, the
+        state of the mission and the threads that run the mission and
+        observe the robot. One TH process can run many sessions, keyed by
+        test ID, each driving its own TA.
     '''
 
-    perturbation_type = perturbation['type']
-    if perturbation_type in perturbation_types["obstacle"]: 
-        return obstacle_perturbation(perturbation, logger)
-    elif perturbation_type in perturbation_types["battery"]:
-        return battery_perturbation(perturbation, logger)
-    else:
-        logger.error(f"[Do Perturbation] Unsupported perturbation type: {perturbation_type}", exc_info=True)
-        return False
-
-def battery_perturbation(perturbation, logger):
-    global battery_set_threshold
-    global ta_endpoints
-
-    global can_perturb
-    global mission_done
-    global cur_target_done
-
-    global robot_status_ready
-    global robot_status_use
-    global robot_status
-    global time_interval_observation
-
-    p_type = perturbation['type']
-    ratio  = perturbation['ratio']
-    
-    perturbation_result = False
-
-    can_perturb_check_counter = 0
-    robot_status_ready_check_counter  = 0
-
-    while not perturbation_result:
-
-        if mission_done.is_set():
-            logger.error(f"[Battery Perturbation] mission_done is set when observing the robot's location. ({p_type}, {ratio}).", exc_info=True)
-            break
-        elif cur_target_done.is_set():
-            logger.error(f"[Battery Perturbation] cur_target_done is set when observing the robot's location. ({p_type}, {ratio}).", exc_info=True)
-            break
-        elif not can_perturb.is_set():
-            if (can_perturb_check_counter % 10) == 0:
-                logger.info(f"[Battery Perturbation] Charging or adaptation happens when observing the robot's location. ({p_type}, {ratio}).")
-            can_perturb_check_counter += 1
-            robot_status_use.clear()
-            time.sleep(time_interval_observation)
-            continue
-
-        logger.debug(f"[Battery Perturbation] Can perturb now.")
-
-        logger.debug(f"[Battery Perturbation] robot_status: ready - {robot_status_ready.is_set()}, use - {robot_status_use.is_set()}")
-        if not robot_status_ready.is_set():
-            if (robot_status_ready_check_counter % 10) == 0:
-                logger.info(f"[Battery Perturbation] robot_status is not ready for use.")
-            robot_status_ready_check_counter += 1
-            time.sleep(time_interval_observation)
-            continue
-        logger.debug(f"[Battery Perturbation] robot_status is ready.")
-
-        # use robot status
-        robot_status_use.set()
-
-        if robot_status != False:
-            x = robot_status['x']
-            y = robot_status['y']
-            battery = robot_status['battery']
-            sim_time = robot_status['sim-time']
-
-            if battery > battery_set_threshold:
-                new_battery = battery - ratio*(battery-battery_set_threshold)
-                if mission_done.is_set():
-                    logger.error(f"[Battery Perturbation] mission_done is set when doing battery perturbation, ({p_type}, {ratio}).", exc_info=True)
-                    break
-                elif cur_target_done.is_set():
-                    logger.error(f"[Battery Perturbation] cur_target_done is set when doing battery perturbation, ({p_type}, {ratio}).", exc_info=True)
-                    break
-                elif not can_perturb.is_set():
-                    if (can_perturb_check_counter % 10) == 0:
-                        logger.info(f"[Battery Perturbation] Charging or adaptation happens when doing battery perturbation, ({p_type}, {ratio}), at the sim-time, {sim_time}, and location ({x}, {y}). Resume the perturbation until the adaptation is done.")
-                    can_perturb_check_counter += 1
-                    robot_status_use.clear()
-                    time.sleep(time_interval_observation)
-                    continue
-                else:
-                    logger.info(f"[Battery Perturbation] ({p_type}, {ratio}) starts to setting battery level from {battery} to {new_battery}.")
-                    battery_set_result = set_battery_req("battery_perturbation", ta_endpoints['set_battery'], logger, new_battery) 
-                    if battery_set_result == False:
-                        logger.error(f"[Battery Perturbation] ({p_type}, {ratio}) fails", exc_info=True)
-                        break
-                    else:
-                        logger.info(f"[Battery Perturbation] ({p_type}, {ratio}) succeeds")
-                        perturbation_result = True
-            else:
-                logger.error(f"[Battery Perturbation] fail because the robot's battery level, {battery}, is <= the threshold, {battery_set_threshold}.", exc_info=True)
-                break
-
-        else: # perturbation fails because of the failure of /observe request to the TA
-            logger.error(f"[Battery Perturbation] fail because /observe request fails.", exc_info=True)
-            break
-
-        robot_status_use.clear()
-        
-    return perturbation_result # The battery perturbation is made successfully
-
-# In cp1_controller, robotcontrol/bot_controller.py considers robot is close
-# enough to a target waypoint if their distance is smaller than 2.
-# Source:   https://github.com/cmu-mars/cp1_controllers/blob/master/robotcontrol/bot_controller.py
-#
-# line 27   distance_threshold = 2
-# line 294  elif d <= distance_threshold and not success:
-#               rospy.logwarn(
-#                   "Apparently the robot could accomplish the task but ig_server reported differently!")
-#               start = target
-# line 298      success = True
-#
-# So, place the obstacle at least 2m and 3m away from the target and the robot respectively
-obstacle_target_safe_distance_threshold = 2
-obstacle_robot_safe_distance_threshold = 3
-
-# Used when determining which segment the robot locates.
-# When the distance between the robot and a segment is smaller
-# than the threshold, consider the robot is in the segment.
-to_seg_dist_threshold = 0.5
-
-# the difference threshold for either x-coordinates or y-coordianates of two endpoints of a segment in the map
-seg_same_coords_threshold = 1
-
-l1_coord = np.array([test_map.waypoint_to_coords("l1")["x"], test_map.waypoint_to_coords("l1")["y"]])
-l2_coord = np.array([test_map.waypoint_to_coords("l2")["x"], test_map.waypoint_to_coords("l2")["y"]])
-l7_coord = np.array([test_map.waypoint_to_coords("l7")["x"], test_map.waypoint_to_coords("l7")["y"]])
-l8_coord = np.array([test_map.waypoint_to_coords("l8")["x"], test_map.waypoint_to_coords("l8")["y"]])
-
-def point_to_line_dist(p3, p1, p2):
-    '''
-        calculate the distance between point p3 and the line
-        represented by the points, p1 and p2.
-        p1, p2 and p3 are 1D numpy array, (x, y)
-    '''
-    return norm(np.cross(p2-p1, p1-p3))/norm(p2-p1)
-
-
-def robot_in_horizontal_seg(robot_coord, w1_coord, w2_coord):
-    global to_seg_dist_threshold
-    max_x = max(w1_coord[0], w2_coord[0])
-    min_x = min(w1_coord[0], w2_coord[0])
-    dist = point_to_line_dist(robot_coord, w1_coord, w2_coord) 
-
-    logger_th_server.debug(f"[Horizontal Segment Location] dist {dist}, p1 {w1_coord}, p2 {w2_coord}, robot loc {robot_coord}")
-    if dist  < to_seg_dist_threshold:
-        if robot_coord[0] >= min_x and robot_coord[0] <= max_x:
-            return True
-    return False
+    def __init__(self, test_ID, ta_url, test_map, test_spec, log_dir, s3_bucket_url, logger, observation_mode="poll", log_ship_interval=default_ship_interval):
+        self.test_ID        = test_ID
+        self.ta_url         = ta_url
+        self.test_map       = test_map
+        self.test_spec      = test_spec
+        self.log_dir        = log_dir
+        self.s3_bucket_url  = s3_bucket_url
+        self.logger         = logger
+        self.observation_mode = observation_mode # "poll" or "stream", see check_robot_status()
+
+        self.case_level     = test_spec['test_configuration']['level']
+        self.start_loc      = test_spec['test_configuration']['start-loc']
+        self.targets        = test_spec["test_configuration"]["target-locs"]
+        self.num_targets    = len(self.targets)
+        self.power_model    = test_spec['test_configuration']['power-model']
+        self.perturbation_seqs = None # used by Case B, C and D
+        if self.case_level != 'a':
+             self.perturbation_seqs = test_spec["perturbation"]["perturbSeqs"]
+
+        # Store the mission result
+        self.mission_result = new_mission_result(test_spec)
+        # The events of the mission, see mission_journal.py
+        self.journal = MissionJournal(os.path.join(log_dir, f"mission_journal_{test_ID}.bin"))
+        # Uploads the log fold to the S3 bucket, see log_uploader.py
+        self.log_uploader = LogUploader(s3_bucket_url + "/" + test_ID, logger)
+        # Uploads the log fold every log_ship_interval seconds during the
+        # mission, so that only the tail is left to upload when it is done.
+        # No upload during the mission if it is 0.
+        self.log_ship_interval = log_ship_interval
+        self.log_shipper = None
+        # Rebuilds the mission result if the TH is killed before saving it
+        self.checkpoint = MissionCheckpoint(log_dir, test_ID, self.mission_result, logger)
+
+        # The requests to the TA share its pooled connections
+        self.ta_client = TAClient(ta_url, logger)
+
+        # TATransitions in the order the TA requests are received. A single
+        # dispatcher applies them, so that a burst of TA requests handled by
+        # many threads is neither lost nor reordered.
+        #   live            : TH send a request to start the mission
+        #   at-waypoint     : It impacts TH's perturbation requests since the robot reaches a target.
+        #   adapt-started   : perturbations are paused
+        #   adapt-done      : perturbations are resumed
+        #   error           : TH should go to stop itself
+        #   done            : TH should go to stop itself
+        self.ta_transitions = queue.Queue()
+
+        # In the current test design, at most one obstacle will be exist in the map at a time.
+        # It is used to remove the placed obstacle when a target is reached.
+        self.placedObstacleID = None
+
+        # cur_target_ID is used as one condition to stop the monitoring of robot battery in time.
+        # Otherwise, battery checking keeps sending /observe request to the TA,
+        # while the TA is shutting down. This makes the TH consider some error is
+        # happening in the TA and thus go to shut down the TH before the TA sends
+        # the /done message. cur_target_ID is updated in run_mission()
+        self.cur_target_ID = 0
+
+        # The plan towards the current target.
+        # TA will send it in /live, /at-waypoint and all status messages when TA is alive.
+        # For case b: the plan carried in /live and /at-waypoint messages will be used
+        # For case c and d: the plan carried in /live, /at-waypoint and /status (adapt-done) messages will be used
+        self.cur_mov_plan = {'plan':[], 'sentByTAStatus': ""}
+        # time.monotonic() when the current plan was set, the robot's speed
+        # along it is estimated from the robot statuses observed since then
+        self.cur_mov_plan_since = 0
+
+        # Notified whenever the state that enables or cancels a perturbation changes:
+        # can_perturb, mission_done, cur_target_done, last_target_done and a new robot status.
+        # Perturbations and the robot status observation wait on it instead of polling.
+        self.perturbation_state = threading.Condition()
+
+        # Events
+        self.ta_alive = threading.Event() # trigger the mission start request /start from the TH to the TA
+        # When perturbation is allowed:
+        # case 'a': no perturbation
+        # case 'b': allowed as long as TA is alive and the robot is not charging
+        # case 'c': allowed when TA is alive and not in adaptation phase
+        # case 'd': the same as case 'c'
+        self.can_perturb = StateEvent(self.perturbation_state) # guard TH's perturbation requests away from the adaptations in TA
+        self.stop_th = threading.Event() # trigger the thread to save the logs and stop the session
+        self.mission_done = StateEvent(self.perturbation_state) # trigger the event stop_th
+        self.cur_target_done = StateEvent(self.perturbation_state) # guard each task's perturbations
+        self.is_adapting = threading.Event()
+        self.last_target_done = StateEvent(self.perturbation_state)
+        self.perturbation_armed = StateEvent(self.perturbation_state) # a perturbation is running, observe the robot more often
+        self.session_done = threading.Event() # the logs are saved
+
+        # Before the mission starts, robot does not aim for any target. So, set cur_target_done and mission_done.
+        self.cur_target_done.set()
+        self.mission_done.set()
+
+        # Used to store the robot statuses returned from /observe request.
+        # A perturbation uses a robot status observed after it starts, i.e.,
+        # with a larger seq. See publish_robot_status().
+        self.robot_status_buffer = RobotStatusBuffer(
+                {'sim-time': 0, 'plan': [], 'y': 0, 'x': 0, 'status': '', 'charge': 0},
+                condition=self.perturbation_state)
+        # time.monotonic() before which the robot is not observed fast, set
+        # while an obstacle perturbation waits for the robot to reach a point
+        # it can place the obstacle from. See ObservationCadence.interval().
+        self.observation_hold_until = 0
+
+    @property
+    def robot_status(self):
+        ''' the latest robot status, False if the last /observe request failed '''
+        return self.robot_status_buffer.latest.status
+
+    def robot_speed(self):
+        '''
+            The robot's speed along the current plan, estimated from the
+            robot statuses observed since the plan was set, or None
+        '''
+        snapshots = [s for s in self.robot_status_buffer.history(velocity_window) if s.time >= self.cur_mov_plan_since]
+        return speed_along_plan(self.test_map, snapshots, self.cur_mov_plan["plan"])
+
+    def start(self):
+        '''
+            Start the threads that run the mission and save the logs when it is done
+        '''
+        t_dispatcher = threading.Thread(
+                name=f'ta_transitions_{self.test_ID}',
+                target=self.dispatch_ta_transitions)
+        t_dispatcher.daemon = True
+        t_dispatcher.start()
+
+        t_run_mission = threading.Thread(
+                name=f'run_mission_{self.test_ID}',
+                target=self.run_mission)
+        # Stop the thread of running 'run_mission' when stop_th is set
+        # because TA sends a status with a non-recoverable error message.
+        t_run_mission.daemon = True
+        t_run_mission.start()
+
+        t_stop_th = threading.Thread(
+                name=f'stop_th_{self.test_ID}',
+                target=self.stop_session)
+        t_stop_th.start()
+
+        t_checkpoint = threading.Thread(
+                name=f'checkpoint_{self.test_ID}',
+                target=self.checkpoint_mission_result)
+        t_checkpoint.daemon = True
+        t_checkpoint.start()
+
+        if self.log_ship_interval > 0:
+            self.log_shipper = LogShipper(self.log_uploader, [self.log_dir], self.logger,
+                    interval=self.log_ship_interval, name=f'log_shipper_{self.test_ID}')
+            self.log_shipper.start()
+
+    def checkpoint_mission_result(self):
+        '''
+            Checkpoint the mission result every checkpoint_interval seconds until stop_th is set
+        '''
+        while not self.stop_th.wait(checkpoint_interval):
+            try:
+                self.checkpoint.update()
+            except Exception:
+                self.logger.error("[Checkpoint] fail to checkpoint the mission result", exc_info=True)
+
+    def dispatch_ta_transitions(self):
+        '''
+            Apply the TATransitions queued by the TA requests one at a time in
+            the order they are received, until the mission is done
+        '''
+        while True:
+            transition = self.ta_transitions.get()
+            try:
+                self.apply_ta_transition(transition)
+            except Exception as e:
+                self.logger.error(f"[TA Transition] fail to apply {transition.kind}. {e}", exc_info=True)
+            if transition.kind in ["error", "done"]:
+                return
+
+    def apply_ta_transition(self, transition):
+        kind = transition.kind
+        content = transition.content
+        self.logger.info(f"[TA Transition] {kind}")
+        self.journal_event("ta_status", ta_statuses.index(kind), self.cur_target_ID)
+
+        if kind == "at-waypoint":
+            # Log into mission result if the current target is actually reached.
+            self.logger.debug(f"[at-waypoint] cur_target_ID: {self.cur_target_ID}. num_targets: {self.num_targets}.")
+
+            x = content['x']
+            y = content['y']
+            robot_loc = np.array([x, y])
+
+            cur_target_waypoint_name = self.cur_mov_plan["plan"][-1] #targets[cur_target_ID-1]
+            target_loc = self.test_map.waypoint_to_coord_array(cur_target_waypoint_name)
+
+            distance_robot_to_target = norm(robot_loc-target_loc)
+            self.logger.info(f"[at-waypoint] distance between robot ({robot_loc}) and the current target {cur_target_waypoint_name} ({target_loc}) : {distance_robot_to_target}.")
+            if distance_robot_to_target < obstacle_target_safe_distance_threshold:
+                record_target_reached(self.mission_result, self.cur_target_ID, x, y, self.cur_mov_plan["plan"])
+                self.journal_event("target_reached", self.cur_target_ID, x, y)
+                self.checkpoint.update()
+
+            if (self.cur_target_ID == self.num_targets):
+                self.last_target_done.set()
+                self.logger.debug(f"[at-waypoint] last_target_done is set. Battery monitoring should be stopped.")
+
+        if kind in ["live", "at-waypoint", "adapt-done"]:
+            # A new plan is set by the TA.
+            self.logger.debug("[%s] [old plan - %s", kind, self.cur_mov_plan)
+            self.cur_mov_plan["plan"] = content['plan']
+            self.cur_mov_plan["sentByTAStatus"] = kind
+            self.cur_mov_plan_since = time.monotonic()
+            self.logger.debug("[%s] [new plan - %s", kind, self.cur_mov_plan)
+
+        if kind == "live":
+            self.ta_alive.set()
+        elif kind == "at-waypoint":
+            self.cur_target_done.set()
+        elif kind == "adapt-started":
+            self.is_adapting.set()
+            self.can_perturb.clear()
+        elif kind == "adapt-done":
+            self.is_adapting.clear()
+            self.can_perturb.set()
+        elif (kind == "error") or (kind == "done"):
+            self.mission_done.set()
+            self.last_target_done.set() # signal to stop battery observation
+            self.cur_target_done.set() # notify the running perturbation to stop
+            self.can_perturb.clear()
+
+    # [Process Requests Sent From TA]
+    def ta_is_ready(self):
+        '''
+            Listen to the '/ready' requst from TA and then send mission to TA
+        '''
+        self.logger.info("received /ready from TA.") # should display 'bar'
+        try:
+            data = self.test_spec["test_configuration"]
+            return make_response(jsonify(data), 200)
+        except Exception as e:
+            exception_msg = "TH encountered an error producing configuration data: "+str(e)
+            self.logger.error(exception_msg, exc_info=True)
+            return make_response(exception_msg, 400)
+
+    def ta_status(self, status_content):
+        '''
+            Acknowledge TA status
+        '''
+        try:
+            status = status_content['status']
+
+            if status in ["live", "at-waypoint", "adapt-done"]:
+                # "live"        : the TA is alive
+                # "at-waypoint" : reach to the current target location
+                # "adapt-done"  : adaptation is done. (case c and d)
+                # All of them carry a new plan.
+                content = {'plan': status_content['plan']}
+                if status == "at-waypoint":
+                    content['x'] = status_content['x']
+                    content['y'] = status_content['y']
+                self.ta_transitions.put(TATransition(status, content))
+            elif status == "adapt-started":
+                self.ta_transitions.put(TATransition(status, status_content))
+
+            self.logger.info("[TA Status Message] %s", status_content)
+
+            ack_msg = f"[CP1_TH ACK - TA Status Message] {status}."
+            return make_response(ack_msg, 200)
+        except Exception as e:
+            exception_msg = "[TA Status] TH encountered an error with the TA status message.\nTA status message: {}.\nTH error: {}".format(status_content, str(e))
+            self.logger.error(exception_msg, exc_info=True)
+            return make_response(exception_msg, 400)
 
-def robot_in_vectical_seg(robot_coord, w1_coord, w2_coord):
-    global to_seg_dist_threshold
-    max_y = max(w1_coord[1], w2_coord[1])
-    min_y = min(w1_coord[1], w2_coord[1])
-    dist = point_to_line_dist(robot_coord, w1_coord, w2_coord) 
+    def ta_non_recoverable_error(self, error_content):
+        # save the time info when mission is done.
+        self.mission_result['mission_done']['wall_clock']   = wall_clock_ms()
+        self.mission_result['mission_done']['sim_time']     = self.robot_status['sim-time'] if self.robot_status != False else 0
 
-    logger_th_server.debug(f"[Vertical Segment Location] dist {dist}, p1 {w1_coord}, p2 {w2_coord}, robot loc {robot_coord}")
-    if dist  < to_seg_dist_threshold:
-        if robot_coord[1] >= min_y and robot_coord[1] <= max_y:
-            return True
-    return False
+        error_type = error_content['error']
+        error_msg = error_content['message']
+        self.logger.error(f"Error_Type: {error_type}, error_msg: {error_msg}", exc_info=True)
+        ack_msg = f"TH has stop the test due to the reported non-recoverable error {error_type}: {error_msg}"
 
+        self.ta_transitions.put(TATransition("error", error_content))
 
-def two_points_are_equal(p1, p2):
-    return (p1[0]==p2[0]) and (p1[1]==p2[1])
+        return make_response(ack_msg, 200)
 
-def compute_coord_in_line(p1, p2, d13, d12):
-    '''
-    # point 3 is in the segment of point 1 and point 2
-    '''
-    p3_x = p1[0] + (p2[0] - p1[0]) * d13 / d12
-    p3_y = p1[1] + (p2[1] - p1[1]) * d13 / d12
-
-    return p3_x, p3_y
-
-def compute_obstacle_location(x, y, ratio, mov_plan):
-    global test_map
-    global to_seg_dist_threshold
-    global obstacle_target_safe_distance_threshold
-    global obstacle_robot_safe_distance_threshold
-
-
-    
-    plan = mov_plan["plan"]
-    sent_by_TA_status = mov_plan["sentByTAStatus"]
-    coords = []
-
-    for waypoint in plan:
-        coord_dict = test_map.waypoint_to_coords(waypoint)
-        coords.append(np.array([coord_dict["x"], coord_dict["y"]]))
-    robot_coord = np.array([x, y])
-
-    # Determine which segment the robot locates
-    total_segments = len(plan)-1
-
-    # Determine where the obstacle should be placed
-    ## compute the distance from the obstacle to the robot
-    cur_segment_distances = [] # the first one is the distance between the robot and the current heading waypoint
-
-    logger_th_server.debug(f"[Compute Obstacle Loc] plan: {plan}")
-
-    # if the robot is in either segment l1-l2 (moving to l2) or l7-l8 (moving to l7),
-    # the distance from the robot to the its current heading waypoint
-    # (l2 or l7) is not considered in the obstacle placement.
-    logger_th_server.debug(f"[Compute Obstacle Loc] Check if the robot {robot_coord} is in either l1-l2 or l7-l8 segment.")
-    if (robot_in_horizontal_seg(robot_coord, l1_coord, l2_coord) or robot_in_horizontal_seg(robot_coord, l7_coord, l8_coord)):
-        logger_th_server.debug(f"[Compute Obstacle Loc] The robot {robot_coord} is either moving from l1->l2 or l7->l8.")
-
-        robot_coord = coords[0]
-        robot_segment_num = 1
-
-        for segment_ID in range(robot_segment_num, total_segments+1):
-                key1 = plan[segment_ID-1]+"-"+plan[segment_ID]
-                key2 = plan[segment_ID]+"-"+plan[segment_ID-1]
-                key = None       
-                if key1 in test_map.segment_distances:
-                    key = key1
-                elif key2 in test_map.segment_distances:
-                    key = key2
+    def test_done(self, content):
+        '''
+            Process '/done' request from TA, which indicates the test is done.
+        '''
+        response = None
+        try:
+            mission_outcome = content['outcome']
+            tasks_finished = content['tasks-finished']
+            num_tasks_finished = len(tasks_finished)
+
+            # save the time info when mission is done.
+            self.mission_result['mission_done']['wall_clock']   = wall_clock_ms()
+            self.mission_result['mission_done']['sim_time']     = content['sim-time']
+
+            mission_msg = ""
+            if mission_outcome == "at-goal":
+                if num_tasks_finished == self.num_targets:
+                    mission_msg = f"[Test Done: Mission Completed] {num_tasks_finished} tasks finished:\n"
                 else:
-                    raise ValueError(f"[Compute Obstacle Loc] The segment, {key1}, indicated in the current plan, {plan}, is not the test map.")
-                cur_segment_distances.append(test_map.segment_distances[key])
+                    mission_msg = f"[Test Done: Mission Incompleted] {num_tasks_finished} tasks finished:\n"
+            elif mission_outcome == "out-of-battery":
+                mission_msg = f"[Test Done: Abrupt - Low Energy] {num_tasks_finished} tasks finished:\n"
+            else: # unknown mission outcome message
+                raise ValueError(f"Unknown Mission Outcome Message: {mission_outcome}.\nFull request content: {content}")
 
-    else:
-        logger_th_server.debug(f"[Compute Obstacle Loc] The robot {robot_coord} locates in neither l1-l2 nor l7-l8 segment.")
-        if sent_by_TA_status == "adapt-done":
-            robot_segment_num = 0 # represent the segment from the robot location to the first waypoint in the new plan
-        else:
-            # live or at-waypoint status: assume the length of the plan >= 2
-            robot_segment_num = 1 # The segment number that the robot currently locates
-            while robot_segment_num <= total_segments:
-                if abs(coords[robot_segment_num-1][1] - coords[robot_segment_num][1]) < seg_same_coords_threshold:
-                    if robot_in_horizontal_seg(robot_coord, coords[robot_segment_num-1], coords[robot_segment_num]):
-                        break
-                elif abs(coords[robot_segment_num-1][0] - coords[robot_segment_num][0]) < seg_same_coords_threshold:
-                    if robot_in_vectical_seg(robot_coord, coords[robot_segment_num-1], coords[robot_segment_num]):
-                        break
-
-                robot_segment_num += 1
+            for task_status in tasks_finished:
+                mission_msg += f"\tReached the target location {task_status['name']} ({task_status['x']}, {task_status['y']}) at the sim-time, {task_status['sim-time']}\n"
 
+            mission_msg += f"Final robot's status: charge = {content['charge']} mAh,  ({content['x']}, {content['y']}) at the sim-time, {content['sim-time']}\n"
 
-            if robot_segment_num > total_segments:
-                raise ValueError(f"[Compute Obstacle Loc] The robot is not in any segment: the distance from the robot to any segment is larger than {to_seg_dist_threshold}.")
+            self.logger.info(mission_msg)
 
-        logger_th_server.debug(f"[Compute Obstacle Loc] robot_segment_num : {robot_segment_num}") 
+            ack_msg = f"[CP1_TH] ACK - Test Done."
+            response = make_response(ack_msg, 200)
+        except Exception as e:
+            exception_msg = "TH encountered an error at the completion of the mission: "+str(e)
+            self.logger.error(exception_msg, exc_info=True)
+            response = make_response(exception_msg, 400)
 
-        cur_segment_distances.append(norm(robot_coord - coords[robot_segment_num]))
+        self.ta_transitions.put(TATransition("done", content))
 
-        for segment_ID in range(robot_segment_num+1, total_segments+1):
-            key1 = plan[segment_ID-1]+"-"+plan[segment_ID]
-            key2 = plan[segment_ID]+"-"+plan[segment_ID-1]
-            key = None       
-            if key1 in test_map.segment_distances:
-                key = key1
-            elif key2 in test_map.segment_distances:
-                key = key2
-            else:
-                raise ValueError(f"[Compute Obstacle Loc] The segment, {key1}, indicated in the current plan, {plan}, is not the test map.")
-            cur_segment_distances.append(test_map.segment_distances[key])
-
-    distance_robot_to_current_target = 0 
-    for dist in cur_segment_distances:
-        distance_robot_to_current_target += dist
-
-    if distance_robot_to_current_target < (obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold):
-        raise ValueError(f"[Compute Obstacle Loc] The distance from the robot {robot_coord} to the current target ({plan[-1]}:{coords[-1]}) is {distance_robot_to_current_target} (<{obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold}) that is too close to place an obstacle in-between.")
-
-    distance_obstacle_to_robot = distance_robot_to_current_target * ratio
-    if distance_obstacle_to_robot < obstacle_robot_safe_distance_threshold:
-        distance_obstacle_to_robot = obstacle_robot_safe_distance_threshold
-
-    # the left point might be the robot or a waypoint
-    distance_obstacle_to_left_point = distance_obstacle_to_robot
-    # Calculate the coordinates of the obstacles
-    ob_x, ob_y = 0, 0
-    obstacle_segment_num = robot_segment_num
-    for d in cur_segment_distances:
-        if distance_obstacle_to_left_point > d:
-            distance_obstacle_to_left_point -= d
-            obstacle_segment_num += 1
-
-    # The starting and ending points of the segment
-    # for computing the coordinates of the obstacle
-    if obstacle_segment_num == robot_segment_num:
-        starting_point_coord = robot_coord
-    else:
-        starting_point_coord = coords[obstacle_segment_num-1]
-    ending_point_coord = coords[obstacle_segment_num]
-
-    dist_start_to_end = norm(starting_point_coord - ending_point_coord)
-
-    # Get the safe starting and ending points by moving the original
-    # starting and ending points <wapoint_safe_radius> towards to the obstacle
-    safe_start_x, safe_start_y = compute_coord_in_line(
-        starting_point_coord,
-        ending_point_coord,
-        obstacle_robot_safe_distance_threshold,
-        dist_start_to_end)
-    safe_start_point =  np.array([safe_start_x, safe_start_y])
-
-    distance_obstacle_to_left_point  -= obstacle_robot_safe_distance_threshold 
-
-    # the ending point is the target
-    if plan[-1] == plan[obstacle_segment_num]:
-        if dist_start_to_end < (obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold):
-            raise ValueError(f"[Compute Obstacle Loc] The coming waypoint is the target, while the length of the segment where the obstacle will be placed is {dist_star_to_end} (<{obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold}) that is too close to place an obstacle in-between.")
-        safe_end_x, safe_end_y = compute_coord_in_line(
-            starting_point_coord,
-            ending_point_coord,
-            dist_start_to_end - obstacle_target_safe_distance_threshold,
-            dist_start_to_end)
-        safe_end_point =  np.array([safe_end_x, safe_end_y])
-        dist_start_to_end -= (obstacle_robot_safe_distance_threshold+obstacle_target_safe_distance_threshold)
-    else:
-        if dist_start_to_end < obstacle_robot_safe_distance_threshold:
-            raise ValueError(f"[Compute Obstacle Loc] The length of the segment where the obstacle will be placed is {dist_start_to_end} (<{obstacle_robot_safe_distance_threshold}) that is too close such that the robot will get stuck if the obstacle is placed on the segment.")
-        safe_end_point = ending_point_coord
-        dist_start_to_end -= obstacle_robot_safe_distance_threshold
-
-
-    if distance_obstacle_to_left_point < 0:
-        logger_th_server.info(f"[Compute Obstacle Loc] The distance between the intended obstacle and the robot {robot_coord} is smaller than the predefined safe distance threshold, {obstacle_robot_safe_distance_threshold}. Set the distance to be {obstacle_robot_safe_distance_threshold}.")
-        distance_obstacle_to_left_point = 0
-    elif distance_obstacle_to_left_point > dist_start_to_end:
-        logger_th_server.info(f"[Compute Obstacle Loc] The distance between the intended obstacle and the target {coords[obstacle_segment_num]} is smaller than the predefined safe distance threshold, {obstacle_target_safe_distance_threshold}. Set the distance to be {obstacle_target_safe_distance_threshold}.")
-        distance_obstacle_to_left_point = dist_start_to_end
-
-    logger_th_server.debug(f"[Compute Obstacle Loc] obstacle_segment_num: {obstacle_segment_num}")
-    logger_th_server.debug(f"[Compute Obstacle Loc] ending_point_coord: {ending_point_coord}")
-    logger_th_server.debug(f"[Compute Obstacle Loc] starting_point_coord: {starting_point_coord}")
-
-    ob_x, ob_y = compute_coord_in_line(
-        safe_start_point,
-        safe_end_point,
-        distance_obstacle_to_left_point,
-        dist_start_to_end)
-
-    logger_th_server.debug(f"[Compute Obstacle Loc] obstacle location: ({ob_x}, {ob_y})")
-
-    return {"x":ob_x, "y":ob_y}
-
-
-def obstacle_perturbation(perturbation, logger):
-    global ta_endpoints
-    global cur_mov_plan
-    global placedObstacleID
-
-    global can_perturb
-    global mission_done
-    global cur_target_done
-    global robot_status
-
-    global robot_status_ready
-    global robot_status_use
-    global robot_status
-
-    global time_interval_observation
-
-    p_type = perturbation['type']
-    ratio  = perturbation['ratio']
-
-    logger.info(f"[Obstacle Perturbation] ({p_type}, {ratio}) Starts")
-
-    perturbation_result = False
-
-    can_perturb_check_counter = 0
-    robot_status_ready_check_counter = 0
-    robot_dist_check_counter = 0
-    while not perturbation_result:
-
-        if mission_done.is_set():
-            logger.error(f"[Obstacle Perturbation] mission_done is set when observing the robot's location. ({p_type}, {ratio}).", exc_info=True)
-            break
-        elif cur_target_done.is_set():
-            logger.error(f"[Obstacle Perturbation] cur_target_done is set when observing the robot's location. ({p_type}, {ratio}).", exc_info=True)
-            break
-        elif not can_perturb.is_set():
-            if (can_perturb_check_counter % 10) == 0:
-                logger.info(f"[Obstacle Perturbation] Charging or adaptation happens when observing the robot's location. ({p_type}, {ratio}).")
-            can_perturb_check_counter += 1
-            robot_status_use.clear()
-            time.sleep(time_interval_observation)
-            continue
-            logger.info(f"[Obstacle Perturbation] Can perturb now.")
-
-        #robot_status = observe_req("obstacle_perturbation", ta_endpoints["robot_status"], logger)
-        logger.debug(f"[Obstacle Perturbation] robot_status: ready - {robot_status_ready.is_set()}, use - {robot_status_use.is_set()}")
-
-        if not robot_status_ready.is_set():
-            if (robot_status_ready_check_counter % 10) == 0:
-                logger.debug(f"[Obstacle Perturbation] robot_status is not ready.")
-            robot_status_ready_check_counter += 1
-
-            time.sleep(time_interval_observation)
-            continue
-        logger.info(f"[Obstacle Perturbation] robot_status is ready")
-
-        # use robot_status
-        robot_status_use.set()
-
-        if robot_status != False:
-            x = robot_status['x']
-            y = robot_status['y']
-            battery = robot_status['battery']
-            sim_time = robot_status['sim-time'] 
-
-            cur_loc = {'x':x, 'y':y}
-            closet_waypoint = test_map.coords_to_waypoint(cur_loc)
-            if closet_waypoint["dist"] <= 1:
-                if (robot_dist_check_counter % 10) == 0:
-                    logger.info(f"[Obstacle Perturbation] The distance of the robot {cur_loc} to the waypoint {closet_waypoint['id']} is {closet_waypoint['dist']}. It is too close such that makes the inference of which segment the robot locates very difficulty. So, wait for 1 secnod and check again.")
-                robot_dist_check_counter += 1
-
-                robot_status_use.clear()
-                time.sleep(time_interval_observation)
-                continue 
-
-            if mission_done.is_set():
-                logger.error(f"[Obstacle Perturbation] mission_done is set when calculating obstacle location for the obstacle perturbation, ({p_type}, {ratio})", exc_info=True)
-                break
-            elif cur_target_done.is_set():
-                logger.error(f"[Obstacle Perturbation] cur_target_done is set when calculating obstacle location for the obstacle perturbation, ({p_type}, {ratio})", exc_info=True)
-                break
-            elif not can_perturb.is_set():
-                if (can_perturb_check_counter % 10) == 0:
-                    logger.info(f"[Obstacle Perturbation] Charing or adaptation happens when calculating obstacle location for the obstacle perturbation, ({p_type}, {ratio})")
-                can_perturb_check_counter += 1
-
-                robot_status_use.clear()
-                time.sleep(time_interval_observation)
-                continue
-            else:
-                if len(cur_mov_plan["plan"]) == 0:
-                    logger.error(f"[Obstacle Perturbation] The current plan {cur_mov_plan} is empty. Stopping the test.", exc_info=True)
-                    break
-                elif (len(cur_mov_plan["plan"]) == 1):
-                    logger.error(f"[Obstacle Perturbation] The current plan {cur_mov_plan} has only one target. Placeing an effective obstacle will trap the robot", exc_info=True)
-                    break
-                elif (len(cur_mov_plan["plan"]) == 2) and (("l1" in cur_mov_plan["plan"]) or ("l8" in cur_mov_plan["plan"])):
-                    logger.error(f"[Obstacle Perturbation] The current plan {cur_mov_plan} has two targets but one of them is 'l1' or 'l8'. Placeing an effective obstacle will trap the robot", exc_info=True)
-                    break
-                else:
-                    # Obstacles placed in the segments, l1-l2 and l7-l8, will trap the robot.
-                    # So, do not consider them
-                    mov_plan = {}
-                    mov_plan["plan"] = list(filter(lambda target: (target != "l1") and (target != "l8"), cur_mov_plan["plan"]))
-                    mov_plan["sentByTAStatus"] = cur_mov_plan["sentByTAStatus"]
-
-                    try:
-                        logger.info(f"[Obstacle Perturbation]  ({p_type}, {ratio}) starts to calculating obstacle location.")
-                        obstacle_coord = compute_obstacle_location(x, y, ratio, mov_plan)
-                    except Exception as e:
-                        logger.error(f"[Obstacle Perturbation] fail to comptue the location of the obstacle to place. {e}", exc_info=True)
-                        break
+        return response
 
-                logger.info(f"[Obstacle Perturbation]  ({p_type}, {ratio}) start to placing an obstacle at ({obstacle_coord['x']}, {obstacle_coord['y']}).")    
-                if mission_done.is_set():
-                    logger.error(f"[Obstacle Perturbation] mission_done is set when sending a request to place obstacle for obstacle perturbation, ({p_type}, {ratio}).", exc_info=True)
-                    break
-                elif cur_target_done.is_set():
-                    logger.error(f"[Obstacle Perturbation] cur_target_done is set when sending a request to place obstacle for obstacle perturbation, ({p_type}, {ratio}).", exc_info=True)
-                    break
-                elif not can_perturb.is_set():
-                    if (can_perturb_check_counter % 10) == 0:
-                        logger.info(f"[Obstacle Perturbation] Charging or adaptation happens when sending a request to place obstacle for obstacle perturbation, ({p_type}, {ratio}).")
-                    can_perturb_check_counter += 1
+    # [Utility Functions]
+    def do_perturbation(self, perturbation):
+        '''
+            Assumption: when calling do_perturbation, can_perturb is set.
+        '''
 
-                    robot_status_use.clear()
-                    time.sleep(time_interval_observation)
-                    continue
-                else:
-                    logger.info(f"[Obstacle Perturbation] starts to place the obstacle, {obstacle_coord}.")
-                    obstacle_placement_result = place_obstacle_req('obstacle_perturbation', ta_endpoints["place_obstacle"], logger, obstacle_coord)
-                    if obstacle_placement_result == False:
-                        logger.error(f"[Obstacle Perturbation] ({p_type}, {ratio}) succeeds. The current plan is {cur_mov_plan}", exc_info=True)
-                        break
-                    else:
-                        logger.info(f"[Obstacle Perturbation] ({p_type}, {ratio}) succeeds. The current plan is {cur_mov_plan}")                
-                        perturbation_result = True
-
-        else: # perturbation fails because of the failure of /observe request to the TA
-            logger.error(f"[Obstacle Perturbation] ({p_type}, {ratio}) fails because the /observe request fails")
-            break
-
-    robot_status_use.clear()
-    
-    return perturbation_result # The battery perturbation is made successfully
-
-
-
-def run_mission(ta_url, logger):
-
-    global placedObstacleID
-
-    global ta_alive
-    global can_perturb
-    global stop_th
-    global mission_done
-    global cur_target_done
-    global robot_status_ready
-    global robot_status_use
-
-    global num_targets
-    global case_level
-    global targets
-    global mission_result
-    global cur_target_ID
-    global perturbation_seqs
- 
-    ta_alive.wait()
-
-    # Start the mission
-    endpoint = ta_endpoints["start_mission"]
-    req_result = start_mission_req('run_mission', endpoint, logger)
-    if req_result == False: # request fails
-        logger.error(f"Fail to start the mission. /start request to the TA is not successful.", exc_info=True)
-    else: # mission is started successfully
-        mission_done.clear()
-
-        logger.debug(f"[run_mission] mission starts. robot_status: ready - {robot_status_ready.is_set()}, use - {robot_status_use.is_set()}")
-        # setup battery monitoring
-        t_battery_check = threading.Thread(
-                name='check_robot_status',
-                target=check_robot_status,
-                args=(logger,))
-        t_battery_check.start()
-
-        # Perturbations
-        if case_level == 'a':
-            try:
-                for target_ID in range(1, num_targets+1):
-                    cur_target_done.clear()
-                    cur_target_ID = target_ID
-                    mission_result['num_targets_tried'] += 1
-                    mission_result[f"Target{target_ID}"]["is_tried"] = True
-
-                    logger.info(f"[Target] Starts moving to Target {target_ID}: {targets[target_ID-1]}.")
-                    # Waiting for TH to set the event, cur_target_done.
-                    # TH will set it when TA sends the 'at-waypoint' status message
-                    # that indicates that the current target is reached
-                    cur_target_done.wait()
-                    if mission_done.is_set() and (target_ID != num_targets):
-                        logger.info("[Mission Done] Mission is done but not all targets are reached.")
-                        break
-                    logger.info(f"[Target] Reach Target {target_ID}: {targets[target_ID-1]}.")
-            except Exception as e:
-                logger.error(f"[Mission Failure] [Case {case_level}] {e}", exc_info=True)
+        perturbation_type = perturbation['type']
+        if perturbation_type in perturbation_types["obstacle"]:
+            return self.obstacle_perturbation(perturbation)
+        elif perturbation_type in perturbation_types["battery"]:
+            return self.battery_perturbation(perturbation)
         else:
-            # For case 'b':
-            #   No adaptation but has charging option.
-            # For case 'c' and 'd':
-            #   Planner does not run adaptation in the beginning of the
-            #   mission when the 'live' status message is sent by TA.
-            #   TH will clear the event, can_perturb, when receiving the
-            #   'adapt-started' status message from TA and reset it when
-            #   receiving the 'adapt-done' status message from TA.
-            # So, set the event, can_perturb, at this point.
-
-            time_interval_pertubation = 2
+            self.logger.error("[Do Perturbation] Unsupported perturbation type: %s", perturbation_type, exc_info=True)
+            return False
+
+    def publish_robot_status(self, status):
+        '''
+            Store a robot status returned from /observe (False if the request
+            fails) and wake up the perturbations waiting for it.
+        '''
+        snapshot = self.robot_status_buffer.publish(status)
+        if status != False:
+            self.journal.append("observation", status['sim-time'], status['x'], status['y'], status['battery'], snapshot.seq)
+        else:
+            self.journal_event("observation_failed", snapshot.seq)
+
+    def journal_event(self, event, *payload):
+        '''
+            Append an event to the journal at the sim-time of the latest robot status
+        '''
+        status = self.robot_status
+        self.journal.append(event, status['sim-time'] if status != False else 0, *payload)
+
+    def perturbation_cancel_reason(self):
+        '''
+            The name of the event that cancels the running perturbation, or None.
+        '''
+        if self.mission_done.is_set():
+            return "mission_done"
+        elif self.cur_target_done.is_set():
+            return "cur_target_done"
+        return None
+
+    def wait_for_perturbation_window(self, observation_num, not_before=0):
+        '''
+            Block until a perturbation can be made on a robot status newer than
+            the observation_num-th one and received after the time.monotonic()
+            time not_before, i.e., can_perturb is set and such a robot status
+            has been observed, or until the perturbation is cancelled because
+            the current target or the mission is done.
+
+            Returns (cancel_reason, snapshot), where cancel_reason is None
+            unless the perturbation is cancelled and snapshot is the latest
+            RobotStatusSnapshot.
+        '''
+        buffer = self.robot_status_buffer
+        with self.perturbation_state:
+            self.perturbation_state.wait_for(lambda: (self.perturbation_cancel_reason() is not None)
+                    or (self.can_perturb.is_set() and (buffer.latest.seq > observation_num) and (buffer.latest.time >= not_before)))
+            return self.perturbation_cancel_reason(), buffer.latest
+
+    def battery_perturbation(self, perturbation):
+        logger = self.logger
+
+        p_type = perturbation['type']
+        ratio  = perturbation['ratio']
+
+        perturbation_result = False
+
+        observation_num = self.robot_status_buffer.latest.seq
+        while not perturbation_result:
+
+            if not self.can_perturb.is_set():
+                logger.info("[Battery Perturbation] Charging or adaptation happens when observing the robot's location. (%s, %s).", p_type, ratio)
+
+            cancel_reason, snapshot = self.wait_for_perturbation_window(observation_num)
+            status, observation_num = snapshot.status, snapshot.seq
+            if cancel_reason is not None:
+                logger.error("[Battery Perturbation] %s is set when observing the robot's location. (%s, %s).", cancel_reason, p_type, ratio, exc_info=True)
+                break
 
-            try:
-                for target_ID in range(1, num_targets+1):
-                    cur_target_ID = target_ID
-                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] starts ")
-                    cur_target_done.clear()
-                    is_adapting.clear()
-                    can_perturb.set()
-                    robot_status_ready.clear()
-                    robot_status_use.clear()
-
-                    mission_result['num_targets_tried'] += 1
-                    mission_result[f"Target{target_ID}"]['is_tried'] = True
-
-                    perturbation_seq = perturbation_seqs[f"Target{target_ID}"]
-                    for perturb_ID in range(len(perturbation_seq)):
-                        perturb_type = perturbation_seq[perturb_ID]['type']
-                        if (not mission_done.is_set()) and (not cur_target_done.is_set()) and (perturbation_seq[perturb_ID]['ratio'] != 0):
-                            logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] starts.")
-                            result = do_perturbation(perturbation_seq[perturb_ID], logger)
-
-                            mission_result['perturbation_stat']['num_perturbations_tried'] += 1
-                            mission_result[f"Target{target_ID}"]['num_perturbations_tried'] += 1
+            logger.debug("[Battery Perturbation] Can perturb now. robot_status #%s is ready.", observation_num)
 
-                            if result:
-                                mission_result['perturbation_stat']['num_successful_perturbations'] += 1
-                                mission_result[f"Target{target_ID}"]['num_successful_perturbations'] += 1
-                                mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = "Success"
-                                if "easy" in perturb_type:
-                                    mission_result['perturbation_stat']['num_successful_easy_perturbations'] += 1
-                                elif "medium" in perturb_type:
-                                    mission_result['perturbation_stat']['num_successful_medium_perturbations'] += 1
-                                else: # hard perturbation
-                                    mission_result['perturbation_stat']['num_successful_hard_perturbations'] += 1
-
-                                logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] success.")
-                            else:
-                                mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = "Failure"
-                                logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] failure.")
+            if status != False:
+                x = status['x']
+                y = status['y']
+                battery = status['battery']
+                sim_time = status['sim-time']
 
-                            time.sleep(time_interval_pertubation)
+                if battery > battery_set_threshold:
+                    new_battery = battery - ratio*(battery-battery_set_threshold)
+                    cancel_reason = self.perturbation_cancel_reason()
+                    if cancel_reason is not None:
+                        logger.error("[Battery Perturbation] %s is set when doing battery perturbation, (%s, %s).", cancel_reason, p_type, ratio, exc_info=True)
+                        break
+                    elif not self.can_perturb.is_set():
+                        logger.info("[Battery Perturbation] Charging or adaptation happens when doing battery perturbation, (%s, %s), at the sim-time, %s, and location (%s, %s). Resume the perturbation until the adaptation is done.", p_type, ratio, sim_time, x, y)
+                        continue
+                    else:
+                        logger.info("[Battery Perturbation] (%s, %s) starts to setting battery level from %s to %s.", p_type, ratio, battery, new_battery)
+                        battery_set_result = set_battery_req("battery_perturbation", self.ta_client, logger, new_battery)
+                        if battery_set_result == False:
+                            logger.error("[Battery Perturbation] (%s, %s) fails", p_type, ratio, exc_info=True)
+                            break
                         else:
-                            if perturbation_seq[perturb_ID]['ratio'] == 0:
-                                not_try_reason = "0 Severity"
-                                mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = f"Not Tried - {not_try_reason}"
-                                logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] Not tried - {not_try_reason}.")
-                            else:
-                                not_try_reason = ""
-                                if mission_done.is_set():
-                                    not_try_reason = "Mission Done"
-                                    cur_target_done.set()
-                                elif cur_target_done.is_set():
-                                    not_try_reason = "Current Target Done"
-                                else:
-                                    not_try_reason = "Unknown"
-
-                                for not_tried_perturb_ID in range(perturb_ID, len(perturbation_seq)):
-                                    perturb_type = perturbation_seq[not_tried_perturb_ID]['type']
-                                    mission_result[f"Target{target_ID}"]['perturbations'][not_tried_perturb_ID]["status"] = f"Not Tried - {not_try_reason}"
+                            logger.info("[Battery Perturbation] (%s, %s) succeeds", p_type, ratio)
+                            self.journal.append("battery_set", sim_time, new_battery, self.cur_target_ID, ratio)
+                            perturbation_result = True
+                else:
+                    logger.error("[Battery Perturbation] fail because the robot's battery level, %s, is <= the threshold, %s.", battery, battery_set_threshold, exc_info=True)
+                    break
 
-                                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+not_tried_perturb_ID} ({perturb_type})] Not tried - {not_try_reason}.")
-                                break 
+            else: # perturbation fails because of the failure of /observe request to the TA
+                logger.error("[Battery Perturbation] fail because /observe request fails.", exc_info=True)
+                break
 
-                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] Perturbations Done")
+        return perturbation_result # The battery perturbation is made successfully
 
-                    cur_target_done.wait()
-                    if mission_done.is_set():
-                        if (target_ID != num_targets):
-                            logger.info(f"[Mission Done] while doing perturbation for target {target_ID}, {targets[target_ID-1]}.")
-                        break
+    def compute_obstacle_location(self, x, y, ratio, mov_plan):
+        '''
+            The location to place an obstacle at for the robot at (x, y).
+            See obstacle_placement.compute_obstacle_locations() for how it is computed.
+        '''
+        self.logger.debug("[Compute Obstacle Loc] plan: %s", mov_plan['plan'])
 
-                    # Remove the placed obstacle for the current target
-                    if placedObstacleID != None:
-                        # remove it
-                        result  = remove_obstacle_req('run_mission', ta_endpoints["remove_obstacle"], logger, placedObstacleID) 
-                        if result:
-                            placedObstacleID = None
-                        else:
-                            logger.error(f"[Obstacle Perturbation] Target {target_ID}, {targets[target_ID-1]}: failed to remove the obstacle, {placedObstacleID}. Stop the test.", exc_info=True)
-                            break
-            except Exception as e:
-                logger.error(f"[Mission Failure] [Case {case_level}] {e}", exc_info=True)
+        obstacle_coords, reasons = compute_obstacle_locations(self.test_map, [[x, y]], [ratio], [0], [mov_plan])
+        if reasons[0] != placement_feasible:
+            raise ValueError(f"[Compute Obstacle Loc] {infeasibility_reasons[reasons[0]]} Robot: ({x}, {y}), plan: {mov_plan}.")
 
-        # Wait for TA's '/done' request
-        mission_done.wait()
+        ob_x, ob_y = obstacle_coords[0].tolist()
+        self.logger.debug("[Compute Obstacle Loc] obstacle location: (%s, %s)", ob_x, ob_y)
 
+        return {"x":ob_x, "y":ob_y}
 
-    logger.info("Mission is done!")
+    def obstacle_perturbation(self, perturbation):
+        logger = self.logger
+        cur_mov_plan = self.cur_mov_plan
 
-    # Trigger event to save logs to S3 bucket and shutting down the TH.
-    stop_th.set()
+        p_type = perturbation['type']
+        ratio  = perturbation['ratio']
 
-class ServerThread(threading.Thread):
+        logger.info("[Obstacle Perturbation] (%s, %s) Starts", p_type, ratio)
 
-    def __init__(self, app, hostname, port):
-        threading.Thread.__init__(self)
-        self.srv = make_server(hostname, port, app)
-        self.ctx = app.app_context()
-        self.ctx.push()
+        perturbation_result = False
 
-    def run(self):
-        self.srv.serve_forever()
+        robot_dist_check_counter = 0
+        observation_num = self.robot_status_buffer.latest.seq
+        resume_time = 0 # when the robot is predicted to reach a point the obstacle can be placed from
+        while not perturbation_result:
 
-    def shutdown(self):
-        self.srv.shutdown()
+            if not self.can_perturb.is_set():
+                logger.info("[Obstacle Perturbation] Charging or adaptation happens when observing the robot's location. (%s, %s).", p_type, ratio)
 
-def start_server(host, port, logger):
-    global server
-    global app
-
-    logger.info('TH server is starting')
+            cancel_reason, snapshot = self.wait_for_perturbation_window(observation_num, resume_time)
+            status, observation_num = snapshot.status, snapshot.seq
+            if cancel_reason is not None:
+                logger.error("[Obstacle Perturbation] %s is set when observing the robot's location. (%s, %s).", cancel_reason, p_type, ratio, exc_info=True)
+                break
 
-    server = ServerThread(app, host, port)
-    server.run()
+            logger.debug("[Obstacle Perturbation] Can perturb now. robot_status #%s is ready.", observation_num)
+
+            if status != False:
+                x = status['x']
+                y = status['y']
+                battery = status['battery']
+                sim_time = status['sim-time']
+
+                cur_loc = {'x':x, 'y':y}
+                closet_waypoint = self.test_map.coords_to_waypoint(cur_loc)
+                if closet_waypoint["dist"] <= waypoint_exclusion_radius:
+                    # Predict from its speed along the plan when the robot
+                    # reaches a point the obstacle can be placed from at the
+                    # ratio, or else when it leaves the zone, and use the
+                    # first robot status observed after then.
+                    speed = self.robot_speed()
+                    wait = time_to_placement(self.test_map, cur_mov_plan, (x, y), speed, ratio)
+                    if wait is None:
+                        wait = time_to_exit_waypoint_zone(self.test_map, cur_mov_plan["plan"], (x, y), speed)
+                    if (wait is not None) and (wait <= max_exit_wait):
+                        resume_time = snapshot.time + wait
+                        self.observation_hold_until = resume_time
+                        logger.info("[Obstacle Perturbation] The distance of the robot %s to the waypoint %s is %s. It is too close such that makes the inference of which segment the robot locates very difficulty. Moving at %.2f m/s, the robot can be perturbed in %.2f seconds. So, check again then.", cur_loc, closet_waypoint['id'], closet_waypoint['dist'], speed, wait)
+                    else:
+                        resume_time = 0
+                        if (robot_dist_check_counter % 10) == 0:
+                            logger.info("[Obstacle Perturbation] The distance of the robot %s to the waypoint %s is %s. It is too close such that makes the inference of which segment the robot locates very difficulty. So, wait for the next observation and check again.", cur_loc, closet_waypoint['id'], closet_waypoint['dist'])
+                    robot_dist_check_counter += 1
+                    continue
 
+                cancel_reason = self.perturbation_cancel_reason()
+                if cancel_reason is not None:
+                    logger.error("[Obstacle Perturbation] %s is set when calculating obstacle location for the obstacle perturbation, (%s, %s)", cancel_reason, p_type, ratio, exc_info=True)
+                    break
+                elif not self.can_perturb.is_set():
+                    logger.info("[Obstacle Perturbation] Charing or adaptation happens when calculating obstacle location for the obstacle perturbation, (%s, %s)", p_type, ratio)
+                    continue
+                else:
+                    if len(cur_mov_plan["plan"]) == 0:
+                        logger.error("[Obstacle Perturbation] The current plan %s is empty. Stopping the test.", cur_mov_plan, exc_info=True)
+                        break
+                    elif (len(cur_mov_plan["plan"]) == 1):
+                        logger.error("[Obstacle Perturbation] The current plan %s has only one target. Placeing an effective obstacle will trap the robot", cur_mov_plan, exc_info=True)
+                        break
+                    elif (len(cur_mov_plan["plan"]) == 2) and (("l1" in cur_mov_plan["plan"]) or ("l8" in cur_mov_plan["plan"])):
+                        logger.error("[Obstacle Perturbation] The current plan %s has two targets but one of them is 'l1' or 'l8'. Placeing an effective obstacle will trap the robot", cur_mov_plan, exc_info=True)
+                        break
+                    else:
+                        # Obstacles placed in the segments, l1-l2 and l7-l8, will trap the robot.
+                        # So, do not consider them
+                        mov_plan = {}
+                        mov_plan["plan"] = list(filter(lambda target: (target != "l1") and (target != "l8"), cur_mov_plan["plan"]))
+                        mov_plan["sentByTAStatus"] = cur_mov_plan["sentByTAStatus"]
+
+                        try:
+                            logger.info("[Obstacle Perturbation]  (%s, %s) starts to calculating obstacle location.", p_type, ratio)
+                            obstacle_coord = None
+                            # Place the obstacle from where the robot will be when the TA places it
+                            speed = self.robot_speed()
+                            dt = time.monotonic() - snapshot.time + obstacle_placement_latency
+                            predicted_x, predicted_y = predict_location(self.test_map, cur_mov_plan["plan"], (x, y), speed, dt)
+                            if (predicted_x, predicted_y) != (x, y):
+                                try:
+                                    obstacle_coord = self.compute_obstacle_location(predicted_x, predicted_y, ratio, mov_plan)
+                                    logger.info("[Obstacle Perturbation] The robot at (%s, %s) moving at %.2f m/s is predicted at (%s, %s) in %.2f seconds.", x, y, speed, predicted_x, predicted_y, dt)
+                                except ValueError as e:
+                                    logger.debug("[Obstacle Perturbation] Cannot place the obstacle from the predicted location (%s, %s) of the robot. Use its observed location. %s", predicted_x, predicted_y, e)
+                            if obstacle_coord is None:
+                                obstacle_coord = self.compute_obstacle_location(x, y, ratio, mov_plan)
+                        except Exception as e:
+                            logger.error("[Obstacle Perturbation] fail to comptue the location of the obstacle to place. %s", e, exc_info=True)
+                            break
 
-def stop_server(logger):
-    global server
-    global stop_th
-    global mission_result
-    global test_ID
-    global log_dir
-    global mission_result
+                    logger.info("[Obstacle Perturbation]  (%s, %s) start to placing an obstacle at (%s, %s).", p_type, ratio, obstacle_coord['x'], obstacle_coord['y'])
+                    cancel_reason = self.perturbation_cancel_reason()
+                    if cancel_reason is not None:
+                        logger.error("[Obstacle Perturbation] %s is set when sending a request to place obstacle for obstacle perturbation, (%s, %s).", cancel_reason, p_type, ratio, exc_info=True)
+                        break
+                    elif not self.can_perturb.is_set():
+                        logger.info("[Obstacle Perturbation] Charging or adaptation happens when sending a request to place obstacle for obstacle perturbation, (%s, %s).", p_type, ratio)
+                        continue
+                    elif self.placedObstacleID != None:
+                        logger.error("[Obstacle Perturbation] The TH tries to place an obstacle while the obstacle, %s, already exists on the map. Note: at most one obstacle should be on the map to avoid trapping the robto and also remove invalid (ineffective) obstacles.", self.placedObstacleID, exc_info=True)
+                        break
+                    else:
+                        logger.info("[Obstacle Perturbation] starts to place the obstacle, %s.", obstacle_coord)
+                        obstacle_ID = place_obstacle_req('obstacle_perturbation', self.ta_client, logger, obstacle_coord)
+                        if obstacle_ID == False:
+                            logger.error("[Obstacle Perturbation] (%s, %s) fails. The current plan is %s", p_type, ratio, cur_mov_plan, exc_info=True)
+                            break
+                        else:
+                            self.placedObstacleID = obstacle_ID
+                            self.journal_event("obstacle_placed", obstacle_coord['x'], obstacle_coord['y'], self.cur_target_ID, ratio)
+                            logger.info("[Obstacle Perturbation] (%s, %s) succeeds. The current plan is %s", p_type, ratio, cur_mov_plan)
+                            perturbation_result = True
 
-    stop_th.wait()
+            else: # perturbation fails because of the failure of /observe request to the TA
+                logger.error("[Obstacle Perturbation] (%s, %s) fails because the /observe request fails", p_type, ratio)
+                break
 
-    try:
-        # dump the mission result into the log fold
-        mission_result_filepath = os.path.join(log_dir, f"mission_result_{test_ID}.json")
-        with open(mission_result_filepath, "w") as fp:
-            json.dump(mission_result, fp, indent=4)
-    except Exception as e:
-        logger.error(e, exc_info=True)
-
-    # save TH log to S3 bucket
-    ld=log_dir #"/logs/"
-
-    res = subprocess.call([
-        "aws", "s3", "cp", ld,
-        s3_bucket_url + "/" + test_ID + "/",
-        "--recursive"])
-    if not res == 0:
-        logger.error(f"Failed to save TH logs to S3 bucket at {s3_bucket_url}/{test_ID}", exc_info=True)
-    else:
-        logger.info(f"Successfully saved TH logs to S3 bucket at {s3_bucket_url}/{test_ID}")
+        return perturbation_result # The battery perturbation is made successfully
+
+    def run_mission(self):
+        logger = self.logger
+        targets = self.targets
+        num_targets = self.num_targets
+        mission_result = self.mission_result
+
+        self.ta_alive.wait()
+
+        # Start the mission
+        req_result = start_mission_req('run_mission', self.ta_client, logger)
+        if req_result == False: # request fails
+            logger.error(f"Fail to start the mission. /start request to the TA is not successful.", exc_info=True)
+        else: # mission is started successfully
+            self.can_perturb.set()
+            self.mission_done.clear()
+            self.journal_event("mission_start", num_targets)
+
+            logger.debug(f"[run_mission] mission starts. robot_status #{self.robot_status_buffer.latest.seq}")
+            # setup battery monitoring
+            t_battery_check = threading.Thread(
+                    name=f'check_robot_status_{self.test_ID}',
+                    target=self.check_robot_status)
+            t_battery_check.start()
+
+            # Perturbations
+            if self.case_level == 'a':
+                try:
+                    for target_ID in range(1, num_targets+1):
+                        self.cur_target_done.clear()
+                        self.cur_target_ID = target_ID
+                        mission_result['num_targets_tried'] += 1
+                        mission_result[f"Target{target_ID}"]["is_tried"] = True
+
+                        logger.info(f"[Target] Starts moving to Target {target_ID}: {targets[target_ID-1]}.")
+                        # Waiting for TH to set the event, cur_target_done.
+                        # TH will set it when TA sends the 'at-waypoint' status message
+                        # that indicates that the current target is reached
+                        self.cur_target_done.wait()
+                        if self.mission_done.is_set() and (target_ID != num_targets):
+                            logger.info("[Mission Done] Mission is done but not all targets are reached.")
+                            break
+                        logger.info(f"[Target] Reach Target {target_ID}: {targets[target_ID-1]}.")
+                except Exception as e:
+                    logger.error(f"[Mission Failure] [Case {self.case_level}] {e}", exc_info=True)
+            else:
+                # For case 'b':
+                #   No adaptation but has charging option.
+                # For case 'c' and 'd':
+                #   Planner does not run adaptation in the beginning of the
+                #   mission when the 'live' status message is sent by TA.
+                #   TH will clear the event, can_perturb, when receiving the
+                #   'adapt-started' status message from TA and reset it when
+                #   receiving the 'adapt-done' status message from TA.
+                # So, set the event, can_perturb, at this point.
+
+                try:
+                    for target_ID in range(1, num_targets+1):
+                        self.cur_target_ID = target_ID
+                        logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] starts ")
+                        self.cur_target_done.clear()
+                        self.is_adapting.clear()
+                        self.can_perturb.set()
+
+                        mission_result['num_targets_tried'] += 1
+                        mission_result[f"Target{target_ID}"]['is_tried'] = True
+
+                        perturbation_seq = self.perturbation_seqs[f"Target{target_ID}"]
+                        for perturb_ID in range(len(perturbation_seq)):
+                            perturb_type = perturbation_seq[perturb_ID]['type']
+                            if (not self.mission_done.is_set()) and (not self.cur_target_done.is_set()) and (perturbation_seq[perturb_ID]['ratio'] != 0):
+                                logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] starts.")
+                                self.perturbation_armed.set()
+                                try:
+                                    result = self.do_perturbation(perturbation_seq[perturb_ID])
+                                finally:
+                                    self.perturbation_armed.clear()
+                                record_perturbation_result(mission_result, target_ID, perturb_ID, perturb_type, result)
+                                self.journal_event("perturbation", target_ID, perturb_ID, perturbation_type_codes.get(perturb_type, -1), int(result))
+                                self.checkpoint.update()
+
+                                if result:
+                                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] success.")
+                                else:
+                                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] failure.")
 
-    server.shutdown()
-    logger.info('server is shutting down')
- 
-def check_robot_status(logger):
-    '''
-        1. Monitor the battery charing event in the robot.
-        2. The monitoring should be started when the mission
-           is started and shutdown when the mission is done.
-    '''
-    global mission_done
-    global can_perturb
-    global is_adapting
-    global last_target_done
+                                # Returns as soon as the current target or the mission is done
+                                self.cur_target_done.wait(time_interval_pertubation)
+                            else:
+                                if perturbation_seq[perturb_ID]['ratio'] == 0:
+                                    not_try_reason = "0 Severity"
+                                    mission_result[f"Target{target_ID}"]['perturbations'][perturb_ID]["status"] = f"Not Tried - {not_try_reason}"
+                                    logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+perturb_ID} ({perturb_type})] Not tried - {not_try_reason}.")
+                                else:
+                                    not_try_reason = ""
+                                    if self.mission_done.is_set():
+                                        not_try_reason = "Mission Done"
+                                        self.cur_target_done.set()
+                                    elif self.cur_target_done.is_set():
+                                        not_try_reason = "Current Target Done"
+                                    else:
+                                        not_try_reason = "Unknown"
+
+                                    for not_tried_perturb_ID in range(perturb_ID, len(perturbation_seq)):
+                                        perturb_type = perturbation_seq[not_tried_perturb_ID]['type']
+                                        mission_result[f"Target{target_ID}"]['perturbations'][not_tried_perturb_ID]["status"] = f"Not Tried - {not_try_reason}"
+
+                                        logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] [Perturbation {1+not_tried_perturb_ID} ({perturb_type})] Not tried - {not_try_reason}.")
+                                    break
+
+                        logger.info(f"[Target {target_ID} ({targets[target_ID-1]})] Perturbations Done")
+
+                        self.cur_target_done.wait()
+                        if self.mission_done.is_set():
+                            if (target_ID != num_targets):
+                                logger.info(f"[Mission Done] while doing perturbation for target {target_ID}, {targets[target_ID-1]}.")
+                            break
 
-    global robot_status_ready
-    global robot_status_use
-    global robot_status
+                        # Remove the placed obstacle for the current target
+                        if self.placedObstacleID != None:
+                            # remove it
+                            result  = remove_obstacle_req('run_mission', self.ta_client, logger, self.placedObstacleID)
+                            if result:
+                                self.placedObstacleID = None
+                                self.journal_event("obstacle_removed", target_ID)
+                            else:
+                                logger.error(f"[Obstacle Perturbation] Target {target_ID}, {targets[target_ID-1]}: failed to remove the obstacle, {self.placedObstacleID}. Stop the test.", exc_info=True)
+                                break
+                except Exception as e:
+                    logger.error(f"[Mission Failure] [Case {self.case_level}] {e}", exc_info=True)
 
-    global ta_endpoints
-    global robot_status
+            # Wait for TA's '/done' request
+            self.mission_done.wait()
 
-    global time_interval_observation
 
-    encountered_error = False
+        logger.info("Mission is done!")
 
-    # Initialize robot status when the mission starts
-    try:
-        robot_status = observe_req("check_robot_battery", ta_endpoints["robot_status"], logger)
-    except Exception as e:
-        logger.error(f"[Robot Status] failed to initialize robot_status: {e}. Stop monitoring and wait for the mission signal from the TA.", exc_info=True)
-        return
+        # Trigger event to save logs to S3 bucket and stop the session.
+        self.stop_th.set()
 
-    robot_battery = 0
+    def stop_session(self):
+        '''
+            Save the mission result and the logs of the session when the mission is done
+        '''
+        logger = self.logger
 
-    if robot_status == False:
-        encountered_error = True
-    else:
-        logger.info(f"[Robot Status] initial status: {robot_status}")
-        robot_battery = robot_status['battery']
+        self.stop_th.wait()
 
-        time_stamp=time.strftime("%Y-%m-%d_%H-%M-%S", time.gmtime())
-        dt = datetime.datetime.strptime(time_stamp, "%Y-%m-%d_%H-%M-%S")
-        time_stamp_ms = int(time.mktime(dt.timetuple()) * 1000) # millium seconds
+        logger.info(f"[TA Client] latency of the requests to the TA: {json.dumps(self.ta_client.latency_summary())}")
+        self.ta_client.close()
 
-        mission_result['mission_start']['wall_clock']   = time_stamp_ms
-        mission_result['mission_start']['sim_time']     = robot_status['sim-time']
+        self.journal_event("mission_done", self.mission_result['num_targets_reached'])
+        self.journal.close()
 
-        logger.info(f"[Robot Status] periodical observation starts")
+        try:
+            self.checkpoint.update()
+            # dump the mission result into the log fold. Replace the file
+            # at once so that it is never seen half written.
+            mission_result_filepath = os.path.join(self.log_dir, f"mission_result_{self.test_ID}.json")
+            with open(mission_result_filepath + ".tmp", "w") as fp:
+                json.dump(self.mission_result, fp, indent=4)
+            os.replace(mission_result_filepath + ".tmp", mission_result_filepath)
+            self.checkpoint.remove()
+        except Exception as e:
+            logger.error(e, exc_info=True)
 
-        robot_status_use_check_counter  = 0
-        robot_observation_counter       = 0
-        not_charging_check_counter      = 0
+        # save TH log to S3 bucket. Most of it is shipped already, only the
+        # files changed since the last shipping are uploaded.
+        ld=self.log_dir #"/logs/"
+        if self.log_shipper is not None:
+            self.log_shipper.stop()
+        flush_logger(logger)
 
         try:
-            # Periodically observe the robot's battery
-            while (not mission_done.is_set()) and (not last_target_done.is_set()):
-                #logger.debug(f"[Robot Status] before sleeping - mission_done: {mission_done.is_set()}, last_target_done: {last_target_done.is_set()}")
+            num_failed = self.log_uploader.upload_dirs([ld])
+        except Exception:
+            # the server waits for every session, so do not let a session die here
+            logger.error("Failed to upload the TH logs", exc_info=True)
+            num_failed = 1
+        self.log_uploader.close()
+        if num_failed != 0:
+            logger.error(f"Failed to save TH logs to S3 bucket at {self.s3_bucket_url}/{self.test_ID}", exc_info=True)
+        else:
+            logger.info(f"Successfully saved TH logs to S3 bucket at {self.s3_bucket_url}/{self.test_ID}")
+
+        self.session_done.set()
+
+    def check_robot_status(self):
+        '''
+            1. Monitor the battery charing event in the robot.
+            2. The monitoring should be started when the mission
+               is started and shutdown when the mission is done.
+            3. The robot status is either polled from /observe, see
+               poll_robot_status(), or pushed by the TA on /observe/stream,
+               see stream_robot_status().
+        '''
+        logger = self.logger
+        mission_done = self.mission_done
+        last_target_done = self.last_target_done
+        can_perturb = self.can_perturb
+
+        encountered_error = False
+        cadence = ObservationCadence(self.test_map)
+
+        # Initialize robot status when the mission starts
+        try:
+            cadence.record_observation()
+            self.publish_robot_status(observe_req("check_robot_battery", self.ta_client, logger))
+        except Exception as e:
+            logger.error("[Robot Status] failed to initialize robot_status: %s. Stop monitoring and wait for the mission signal from the TA.", e, exc_info=True)
+            return
+
+        robot_status = self.robot_status
+        robot_battery = 0
 
-                #time.sleep(time_interval_observation)
+        if robot_status == False:
+            encountered_error = True
+        else:
+            logger.info("[Robot Status] initial status: %s", dict(robot_status))
+            robot_battery = robot_status['battery']
 
-                #logger.debug(f"[Robot Status] after sleeping - mission_done: {mission_done.is_set()}, last_target_done: {last_target_done.is_set()}")
+            self.mission_result['mission_start']['wall_clock']   = wall_clock_ms()
+            self.mission_result['mission_start']['sim_time']     = robot_status['sim-time']
 
-                #if (mission_done.is_set() or last_target_done.is_set()):
-                #    break
+            logger.info("[Robot Status] periodical observation starts")
 
-                #logger.debug(f"[Robot Status] ready - {robot_status_ready.is_set()}, use - {robot_status_use.is_set()}")
-                if robot_status_use.is_set():
-                    if (robot_status_use_check_counter % 10) == 0:
-                        logger.debug(f"[Robot Status] robot_status is in use. Do not observe new one for now.")
-                    robot_status_use_check_counter += 1
-                    time.sleep(time_interval_observation)
-                    continue
-                else:       
-                    # It's time to observe a new robot_status
-                    if (robot_status_use_check_counter % 10) == 0:
-                        logger.debug(f"[Robot Status] robot_status is not in use. Observe a new one.")
-                    robot_status_use_check_counter += 1
+            robot_observation_counter       = 0
+            not_charging_check_counter      = 0
 
-                    robot_status_ready.clear()
-                    robot_status = observe_req("check_robot_battery",ta_endpoints["robot_status"], logger, is_periodical=True)
-                    robot_status_ready.set()
+            observation_stopped = lambda: mission_done.is_set() or last_target_done.is_set()
+            if self.observation_mode == "stream":
+                observations = self.stream_robot_status(cadence, observation_stopped)
+            else:
+                observations = self.poll_robot_status(cadence, observation_stopped)
+            try:
+                for status in observations:
+                    self.publish_robot_status(status)
 
-                    if robot_status == False:
+                    if status == False:
                         encountered_error = True
                         break
                     else:
                         if (robot_observation_counter % 10) == 0:
-                            logger.info(f"[Robot Status] {robot_status}")
+                            logger.info("[Robot Status] %s", status)
                         robot_observation_counter += 1
 
-                        cur_battery = robot_status['battery']
+                        cur_battery = status['battery']
                         battery_change = cur_battery - robot_battery
                         if battery_change > 0:
-                            logger.info(f"[Robot Status] Charging: battery is increased from {robot_battery} to {cur_battery}")
+                            logger.info("[Robot Status] Charging: battery is increased from %s to %s", robot_battery, cur_battery)
 
                         robot_battery = cur_battery
 
@@ -1452,65 +1087,326 @@ def check_robot_status(logger):
                         # for perturbation permission.
                         # In B case, there is no adapation. But charging
                         # could happens. So, we need to monitor charging event.
-                        if not is_adapting.set():
+                        if not self.is_adapting.is_set():
                             if battery_change > 0: # charging now
-                                logger.info(f"[Robot Status] Charing now, can not perturb.")
+                                logger.info("[Robot Status] Charing now, can not perturb.")
                                 can_perturb.clear()
-                            else: # not charging
+                            elif not can_perturb.is_set(): # not charging
                                 if (not_charging_check_counter % 10) == 0:
-                                    logger.debug(f"[Robot Status] Not Charing now.")
+                                    logger.debug("[Robot Status] Not Charing now.")
                                 can_perturb.set()
                         not_charging_check_counter += 1
 
-                # Control the /observe request frequence
-                time.sleep(time_interval_observation)
+            except Exception as e:
+                logger.error("[Robot Status] observation failure: %s", e, exc_info=True)
+
+            self.mission_result['observation'] = cadence.report()
+            logger.info("[Robot Status] observation rate: %s", self.mission_result['observation'])
+
+        if encountered_error:
+            logger.error("[Robot Status] failed to observe the robot's status. Wait for mission_done signal to stop the test.", exc_info=True)
+
+        if mission_done.is_set() or last_target_done.is_set():
+            logger.info("[Robot Status] stopped because mission_done is set.")
+
+    def poll_robot_status(self, cadence, observation_stopped):
+        '''
+            Robot statuses returned from /observe (False if the request fails)
+            until observation_stopped(). The robot is observed more often while
+            a perturbation is running and less often while it is charging or
+            adapting. See ObservationCadence.
+        '''
+        can_perturb = self.can_perturb
+
+        while not observation_stopped():
+            # Control the /observe request frequence. Stop waiting as soon
+            # as the mission or the last target is done and compute the
+            # delay again when a perturbation starts or ends or when
+            # perturbations are allowed or not.
+            armed = self.perturbation_armed.is_set()
+            paused = not can_perturb.is_set()
+            delay = cadence.next_delay(self.robot_status, armed, paused, self.cur_mov_plan["plan"], self.observation_hold_until)
+            state_changed = lambda: (self.perturbation_armed.is_set() != armed) or (can_perturb.is_set() == paused)
+            with self.perturbation_state:
+                if self.perturbation_state.wait_for(lambda: observation_stopped() or state_changed(), timeout=delay):
+                    continue
+
+            cadence.record_observation()
+            yield observe_req("check_robot_battery", self.ta_client, self.logger, is_periodical=True)
 
-        except Exception as e:
-            logger.error(f"[Robot Status] observation failure: {e}", exc_info=True)
+    def stream_robot_status(self, cadence, observation_stopped):
+        '''
+            Robot statuses pushed by the TA on /observe/stream, one json object
+            per line, until observation_stopped(). Yields False if the stream
+            breaks. Falls back to poll_robot_status() if the TA does not
+            stream the robot status.
+        '''
+        logger = self.logger
+        endpoint = self.ta_client.url("/observe/stream")
+
+        try:
+            response = self.ta_client.get(
+                    "/observe/stream",
+                    headers = {"Accept": "application/x-ndjson"},
+                    stream = True)
+            response.raise_for_status()
+        except Exception:
+            logger.error("[Robot Status] failed to subscribe to %s. Poll /observe instead.", endpoint, exc_info=True)
+            yield from self.poll_robot_status(cadence, observation_stopped)
+            return
+
+        logger.info("[Robot Status] subscribed to %s", endpoint)
+        try:
+            # read byte by byte: the TA writes a line per status without
+            # padding, so waiting for a larger chunk would delay the status
+            for line in response.iter_lines(chunk_size=1):
+                if observation_stopped():
+                    return
+                if not line: # keep-alive
+                    continue
+                cadence.record_observation()
+                yield json.loads(line)
+            logger.error("[Robot Status] the TA closed %s.", endpoint, exc_info=True)
+        except Exception:
+            logger.error("[Robot Status] failed to read the robot status from %s.", endpoint, exc_info=True)
+        finally:
+            response.close()
 
+        if not observation_stopped():
+            yield False
 
-    if encountered_error:
-        logger.error(f"[Robot Status] failed to observe the robot's status. Wait for mission_done signal to stop the test.", exc_info=True)
+    def reset_events_when_mission_done(self):
+        self.mission_done.wait()
 
-    if mission_done.is_set() or last_target_done.is_set():
-        logger.info(f"[Robot Status] stopped because mission_done is set.")
-        robot_status_ready.clear()
-        robot_status_use.clear()
+        self.cur_target_done.set()
+        self.last_target_done.set()
+        self.can_perturb.clear()
 
-def reset_events_when_mission_done(logger):
-    global mission_done
-    global cur_target_done
-    global last_target_done
-    global can_perturb
+        self.logger.info(f"[Mission Done] cur_target_done and last_target_done are set while can_perturb is cleared.")
 
-    mission_done.wait()
 
-    cur_target_done.set()
-    last_target_done.set()
-    can_perturb.clear()
+# The sessions run by this TH, keyed by test ID. The TA of a test sends its
+# requests to /<test_ID>/..., or to /... when the TH runs a single session.
+sessions = {}
 
-    logger.info(f"[Mission Done] cur_target_done and last_target_done are set while can_perturb is cleared.")
+def get_session(test_ID):
+    if test_ID is None:
+        if len(sessions) != 1:
+            abort(404)
+        return next(iter(sessions.values()))
+    if test_ID not in sessions:
+        abort(404)
+    return sessions[test_ID]
+
+
+# Setup Flask APP
+app = Flask(__name__)
+
+
+# [Routes - Process Requests Sent From TA]
+@app.route('/index', methods=['GET'])
+def TH_alive():
+    return make_response("TH server is running!\n", 200)
 
+@app.route('/ready', methods=['POST'], defaults={'test_ID': None})
+@app.route('/<test_ID>/ready', methods=['POST'])
+def TA_is_ready(test_ID):
+    return get_session(test_ID).ta_is_ready()
 
+@app.route('/status', methods=['POST'], defaults={'test_ID': None})
+@app.route('/<test_ID>/status', methods=['POST'])
+def ta_status(test_ID):
+    return get_session(test_ID).ta_status(request.json)
+
+@app.route('/error', methods=['POST'], defaults={'test_ID': None})
+@app.route('/<test_ID>/error', methods=['POST'])
+def ta_non_recoverable_error(test_ID):
+    return get_session(test_ID).ta_non_recoverable_error(request.json)
+
+@app.route('/done', methods=['POST'], defaults={'test_ID': None})
+@app.route('/<test_ID>/done', methods=['POST'])
+def test_done(test_ID):
+    return get_session(test_ID).test_done(request.json)
+
+
+@app.route('/metrics', methods=['GET'])
+def server_metrics():
+    return jsonify(server.metrics())
+
+
+class ServerThread(threading.Thread):
+    '''
+        Serves the TH app with a pool of workers threads (see
+        PooledWSGIServer), or one request at a time if workers is 0
+    '''
+
+    def __init__(self, app, hostname, port, workers=default_workers):
+        threading.Thread.__init__(self)
+        if workers > 0:
+            self.srv = PooledWSGIServer(hostname, port, app, workers)
+        else:
+            self.srv = make_server(hostname, port, app)
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def run(self):
+        self.srv.serve_forever()
+
+    def metrics(self):
+        if isinstance(self.srv, PooledWSGIServer):
+            return self.srv.metrics()
+        return {"workers": 0}
+
+    def shutdown(self):
+        '''
+            Stop serving. The pooled server first handles the requests it
+            has accepted. Returns False if some of them are not handled.
+        '''
+        if isinstance(self.srv, PooledWSGIServer):
+            return self.srv.drain()
+        self.srv.shutdown()
+        return True
+
+def start_server(host, port, logger, workers=default_workers):
+    global server
+    global app
+
+    logger.info(f'TH server is starting with {workers} workers')
+
+    server = ServerThread(app, host, port, workers)
+    server.run()
+
+
+def stop_server(logger):
+    '''
+        Shut the TH server down once every session has saved its logs
+    '''
+    global server
+
+    for session in list(sessions.values()):
+        session.session_done.wait()
+
+    logger.info('server is shutting down')
+    if not server.shutdown():
+        logger.error(f"The TH server stopped before handling all the accepted requests.")
+    logger.info(f"[Server Metrics] {json.dumps(server.metrics())}")
+
+
+def create_session(test_ID, ta_url, test_map, test_spec_fp, log_dir, s3_bucket_url, logger_name, log_level_env, observation_mode, log_queue_size, log_overflow, log_ship_interval):
+    test_spec = load_test_spec(test_spec_fp)
+
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    th_log_filename = os.path.join(log_dir, test_ID + ".log")
+    logger = create_custom_logger(logger_name, th_log_filename, logging.DEBUG, enable_console=True, queue_size=log_queue_size, overflow=log_overflow)
+    logger.info('{:=^60}'.format(test_ID))
+    logger.info(f"Logging to {th_log_filename}")
+    logger.info("[test_spec]: test ID {}\n{}".format(
+        test_ID,
+        json.dumps(test_spec, indent=4)))
+    logger.info(f"[Log Level] {log_level_env}")
+    logger.info(f"S3 bucket URL is {s3_bucket_url}")
+    logger.info(f"[Observation Mode] {observation_mode}")
+
+    return HarnessSession(test_ID, ta_url, test_map, test_spec, log_dir, s3_bucket_url, logger, observation_mode, log_ship_interval)
 
 
 if __name__=='__main__':
-    
-    t_run_mission = threading.Thread(
-            name='run_mission', 
-            target=run_mission,
-            args=(ta_url, logger_th_server))
-    # Stop the thread of running 'run_mission' when stop_th is set
-    # because TA sends a status with a non-recoverable error message.
-    t_run_mission.daemon = True
-    t_run_mission.start()
-      
+
+    # Suppress the debug logs from urlib3
+    logging.getLogger("urllib3").setLevel(logging.INFO)
+    # Set up log level for TH
+    log_level_env = os.environ.get('TH_LOG_LEVEL', '').upper()
+    if log_level_env and (log_level_env == 'INFO'):
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.DEBUG)
+
+    s3_bucket_url = os.environ.get('S3_BUCKET_CP1_PATH')
+    if (not s3_bucket_url) or (len(s3_bucket_url) == 0):
+        err_msg = "S3 bucket URL undefined; cannot sequester logs"
+        logging.error(err_msg)
+        raise Exception(err_msg)
+
+    # How the robot status is observed: "poll" sends /observe requests to the
+    # TA and "stream" subscribes to the robot status pushed by the TA
+    observation_mode = (os.environ.get('TH_OBSERVATION_MODE') or 'poll').lower()
+    if observation_mode not in ["poll", "stream"]:
+        err_msg = f"Unknown observation mode {observation_mode}; it must be either poll or stream"
+        logging.error(err_msg)
+        raise Exception(err_msg)
+
+    # Bound of the queue of the log records of a logger, and what to do
+    # when it is full, see create_custom_logger() in th_common.py
+    log_queue_size = int(os.environ.get('TH_LOG_QUEUE_SIZE') or default_log_queue_size)
+    log_overflow = (os.environ.get('TH_LOG_OVERFLOW') or default_log_overflow).lower()
+
+    # Seconds between two uploads of the logs during a mission, 0 to
+    # upload them only when the mission is done
+    log_ship_interval = float(os.environ.get('TH_LOG_SHIP_INTERVAL') or default_ship_interval)
+
+    # Number of threads handling the requests from the TAs, 0 to handle
+    # one request at a time
+    server_workers = int(os.environ.get('TH_SERVER_WORKERS') or default_workers)
+
+    # Parse Input Parameters
+    if len(sys.argv) == 6:
+        ta_url          = sys.argv[1]
+        ta_port         = sys.argv[2]
+        ta_url          = ta_url+":"+ta_port
+
+        test_map_fp     = sys.argv[3]
+        test_spec_fp    = sys.argv[4]
+        log_dir         = sys.argv[5]
+
+        # Obtain test_ID
+        test_ID = os.environ.get('TEST_ID')
+        if (not test_ID) or (len(test_ID) == 0):
+            err_msg = "Test ID undefined; Stop the test"
+            raise Exception(err_msg)
+
+        session_configs = [{"test_ID": test_ID, "ta_url": ta_url, "test_spec": test_spec_fp}]
+    elif len(sys.argv) == 4:
+        test_map_fp     = sys.argv[1]
+        session_fp      = sys.argv[2]
+        log_dir         = sys.argv[3]
+
+        with open(session_fp) as fp:
+            session_configs = json.load(fp)
+    else:
+        logging.error(f"Failed to parse input paramters to the TH server. The number of input paramters is neither 6 nor 4. Input parameters: {sys.argv}")
+        usage()
+        exit(1)
+
+    if not log_dir.endswith("/"):
+        log_dir = log_dir + "/"
+
+    # All the sessions share the map
+    test_map = MapServer(test_map_fp)
+
+    single_session = (len(session_configs) == 1)
+    for config in session_configs:
+        test_ID = config["test_ID"]
+        if test_ID in sessions:
+            raise Exception(f"Test ID {test_ID} is used by more than one session")
+        if single_session:
+            # keep the log layout of a TH that runs one test
+            sessions[test_ID] = create_session(test_ID, config["ta_url"], test_map, config["test_spec"], log_dir, s3_bucket_url, "CP1_TH", log_level_env, observation_mode, log_queue_size, log_overflow, log_ship_interval)
+        else:
+            sessions[test_ID] = create_session(test_ID, config["ta_url"], test_map, config["test_spec"], os.path.join(log_dir, test_ID) + "/", s3_bucket_url, f"CP1_TH_{test_ID}", log_level_env, observation_mode, log_queue_size, log_overflow, log_ship_interval)
+
+    if single_session:
+        logger_th_server = sessions[test_ID].logger
+    else:
+        logger_th_server = create_custom_logger("CP1_TH_SERVER", os.path.join(log_dir, "th_server.log"), logging.DEBUG, enable_console=True, queue_size=log_queue_size, overflow=log_overflow)
+
+    for session in sessions.values():
+        session.start()
+
     t_stop_th = threading.Thread(
             name='stop_th',
             target=stop_server,
             args=(logger_th_server,))
     t_stop_th.start()
 
-
-
-    start_server(th_host, th_port, logger_th_server)
+    start_server(th_host, th_port, logger_th_server, server_workers)
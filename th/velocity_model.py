@@ -0,0 +1,137 @@
+import numpy as np
+
+from obstacle_placement import waypoint_exclusion_radius, to_seg_dist_threshold, compute_obstacle_locations, placement_feasible
+
+# Number of the latest robot statuses used to estimate the robot's speed
+velocity_window = 5
+
+# Seconds between reading a robot status and the obstacle being placed by
+# the TA, used to place the obstacle from where the robot will be then
+obstacle_placement_latency = 0.2
+
+# Longest wait for the robot to reach a point an obstacle can be placed
+# from. A longer predicted wait means the robot is (almost) not moving, so
+# observe it again.
+max_exit_wait = 5
+
+# Seconds between the predicted robot locations searched for the first one
+# an obstacle can be placed from, see time_to_placement()
+placement_search_step = 0.25
+
+
+def arc_lengths(test_map, snapshots, plan):
+    '''
+        (times, offsets) of the snapshots whose robot location is on the
+        plan, offsets being the arc lengths from plan[0] to the robot
+    '''
+    snapshots = [s for s in snapshots if s.status != False]
+    if (len(plan) < 2) or (len(snapshots) == 0):
+        return np.empty(0), np.empty(0)
+    coords = np.array([[s.status['x'], s.status['y']] for s in snapshots])
+    try:
+        _, offsets, dists = test_map.project_onto_plan(coords, plan)
+    except (KeyError, ValueError):
+        return np.empty(0), np.empty(0)
+    on_plan = dists < to_seg_dist_threshold
+    times = np.array([s.time for s in snapshots])
+    return times[on_plan], offsets[on_plan]
+
+
+def speed_along_plan(test_map, snapshots, plan):
+    '''
+        The robot's speed along the plan in meters per second, estimated
+        from the robot statuses of the snapshots (see RobotStatusSnapshot)
+        by least squares, or None if there are not enough statuses on the
+        plan. It is negative if the robot goes backwards.
+    '''
+    times, offsets = arc_lengths(test_map, snapshots, plan)
+    if len(times) < 2:
+        return None
+    times = times - times.mean()
+    if not np.any(times):
+        return None
+    return ((times @ (offsets - offsets.mean())) / (times @ times)).item()
+
+
+def time_to_exit_waypoint_zone(test_map, plan, robot_loc, speed, radius=waypoint_exclusion_radius):
+    '''
+        Seconds until the robot moving at speed along the plan is farther
+        than radius from the plan's waypoint it is close to, or None if it
+        cannot be predicted: the robot is not on the plan, it is not
+        moving forward or it is close to none of the plan's waypoints.
+    '''
+    if (speed is None) or (speed <= 0) or (len(plan) < 2):
+        return None
+    try:
+        geometry = test_map.get_plan_geometry(plan)
+        _, offset, dist = test_map.project_onto_plan(robot_loc, plan)
+    except (KeyError, ValueError):
+        return None
+    if dist >= to_seg_dist_threshold:
+        return None
+
+    # the waypoints of the plan are at the arc lengths cum_lengths
+    to_waypoints = geometry.cum_lengths - offset
+    in_zone = np.abs(to_waypoints) <= radius
+    if not np.any(in_zone):
+        return None
+    exit_offset = np.max(to_waypoints[in_zone]) + radius
+    return (exit_offset / speed).item()
+
+
+def time_to_placement(test_map, mov_plan, robot_loc, speed, ratio,
+        max_wait=max_exit_wait, step=placement_search_step, radius=waypoint_exclusion_radius):
+    '''
+        Seconds until the robot moving at speed along mov_plan (like the
+        TH's cur_mov_plan) reaches a point from which an obstacle can be
+        placed at ratio: farther than radius from every waypoint and with
+        the obstacle's segment long enough, see compute_obstacle_locations().
+        None if it cannot be predicted or is more than max_wait seconds away.
+    '''
+    if (speed is None) or (speed <= 0):
+        return None
+    dts = np.arange(0, max_wait + step / 2, step)
+    locs = predict_locations(test_map, mov_plan["plan"], robot_loc, speed, dts)
+    if locs is None:
+        return None
+    _, waypoint_dists = test_map.coords_to_waypoints(locs)
+    _, reasons = compute_obstacle_locations(test_map, locs, np.full(len(locs), ratio), np.zeros(len(locs)), [mov_plan])
+    placeable = np.flatnonzero((waypoint_dists[:, 0] > radius) & (reasons == placement_feasible))
+    if len(placeable) == 0:
+        return None
+    return dts[placeable[0]].item()
+
+
+def predict_locations(test_map, plan, robot_loc, speed, dts):
+    '''
+        Where the robot at robot_loc will be after each of dts seconds moving
+        at speed along the plan, as an (N x 2) array. The robot stops at the
+        end of the plan. Returns None if it cannot be predicted.
+    '''
+    if (speed is None) or (len(plan) < 2):
+        return None
+    try:
+        geometry = test_map.get_plan_geometry(plan)
+        _, offset, dist = test_map.project_onto_plan(robot_loc, plan)
+    except (KeyError, ValueError):
+        return None
+    if dist >= to_seg_dist_threshold:
+        return None
+
+    cum = geometry.cum_lengths
+    offsets = np.clip(offset + speed * np.asarray(dts, dtype=float), 0, cum[-1])
+    segment_nums = np.minimum(np.searchsorted(cum, offsets, side='right') - 1, len(geometry.lengths) - 1)
+    return geometry.starts[segment_nums] + geometry.units[segment_nums] * (offsets - cum[segment_nums])[:, None]
+
+
+def predict_location(test_map, plan, robot_loc, speed, dt):
+    '''
+        Where the robot at robot_loc will be after dt seconds moving at speed
+        along the plan, as (x, y). The robot stops at the end of the plan.
+        Returns robot_loc if it cannot be predicted.
+    '''
+    locs = predict_locations(test_map, plan, robot_loc, speed, [dt])
+    if locs is None:
+        return robot_loc
+    x, y = locs[0].tolist()
+    return (x, y)